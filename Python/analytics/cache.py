@@ -0,0 +1,186 @@
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from apps.core.cache import DjangoCache, build_cache
+
+
+class SessionCache(object):
+    """
+    Maps (shop_id, customer_id, session_id) to TrackSession.pk,
+    so events of a known session don't need a TrackSession lookup.
+    """
+
+    key_prefix = 'track-session'
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def make_key(self, key):
+        return '%s:%s:%s:%s' % ((self.key_prefix, ) + tuple(key))
+
+    def get_many(self, keys):
+        """
+        :param keys: iterable of (shop_id, customer_id, session_id)
+        :return: dict key -> TrackSession.pk for cached keys
+        """
+
+        cache_keys = {self.make_key(key): key for key in keys}
+        return {cache_keys[cache_key]: pk for cache_key, pk in self.cache.get_many(list(cache_keys)).items()}
+
+    def set_many(self, sessions):
+        """
+        :param sessions: dict (shop_id, customer_id, session_id) -> TrackSession.pk
+        :return: None
+        """
+
+        self.cache.set_many({self.make_key(key): pk for key, pk in sessions.items()})
+
+    def delete_many(self, keys):
+        self.cache.delete_many([self.make_key(key) for key in keys])
+
+
+class LatestActionCache(object):
+    """
+    Maps (shop_id, customer_id) to the latest TrackData per type of the
+    customer's most recent sessions, see apps.analytics.latest_actions.
+    Every entry is stored with the version of its customer, writers replace
+    the version with every change. An entry is only valid while its version
+    is the current one, so a reader which loaded the entry before a write
+    can't store stale data. Writers change an entry under a per customer
+    lock, so concurrent writers don't lose each other's changes.
+    """
+
+    key_prefix = 'latest-action'
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def make_key(self, key):
+        return '%s:%s:%s' % ((self.key_prefix, ) + tuple(key))
+
+    def make_version_key(self, key):
+        return '%s-version:%s:%s' % ((self.key_prefix, ) + tuple(key))
+
+    def get(self, key):
+        """
+        :param key: (shop_id, customer_id)
+        :return: (entry or None if missing or outdated, current version)
+        """
+
+        entry_key = self.make_key(key)
+        version_key = self.make_version_key(key)
+        values = self.cache.get_many([entry_key, version_key])
+
+        version = values.get(version_key)
+        item = values.get(entry_key)
+        if item is None or item['version'] != version:
+            return None, version
+
+        return item['entry'], version
+
+    def set(self, key, entry, version):
+        """
+        :param version: version returned by get() before the entry was loaded
+        """
+
+        self.cache.set(self.make_key(key), {'version': version, 'entry': entry})
+
+    def update(self, key, function, wait=1, lock_timeout=5):
+        """
+        Replace the cached entry with function(entry) and a new version.
+        Missing entries and entries function returns None for are invalidated,
+        as well as entries which stay locked by another writer for `wait`
+        seconds. The lock is held for two cache round trips, far below `wait`.
+        :param key: (shop_id, customer_id)
+        :param function: entry -> new entry or None
+        :return: None
+        """
+
+        lock_key = self.make_key(key) + ':lock'
+        deadline = time.monotonic() + wait
+        while not self.cache.add(lock_key, 1, lock_timeout):
+            if time.monotonic() >= deadline:
+                self.invalidate_many([key])
+                return
+            time.sleep(0.01)
+
+        try:
+            entry, version = self.get(key)
+            entry = function(entry) if entry is not None else None
+            if entry is None:
+                self.invalidate_many([key])
+                return
+
+            version = uuid.uuid4().hex
+            self.cache.set_many({
+                self.make_version_key(key): version,
+                self.make_key(key): {'version': version, 'entry': entry},
+            })
+        finally:
+            self.cache.delete(lock_key)
+
+    def invalidate_many(self, keys):
+        self.cache.set_many({self.make_version_key(key): uuid.uuid4().hex for key in keys})
+
+
+_session_cache = None
+_session_cache_lock = threading.Lock()
+
+
+def get_session_cache():
+    """
+    Process wide SessionCache configured from ANALYTICS_SESSION_CACHE settings.
+    :return: SessionCache or None if caching is disabled
+    """
+
+    global _session_cache
+
+    if _session_cache is None:
+        with _session_cache_lock:
+            if _session_cache is None:
+                cache = build_cache(getattr(settings, 'ANALYTICS_SESSION_CACHE', {}))
+                _session_cache = SessionCache(cache) if cache is not None else False
+
+    return _session_cache or None
+
+
+_latest_action_cache = None
+_latest_action_cache_lock = threading.Lock()
+
+
+def get_latest_action_cache():
+    """
+    Process wide LatestActionCache configured from ANALYTICS_LATEST_ACTION_CACHE settings.
+    :return: LatestActionCache or None if caching is disabled
+    """
+
+    global _latest_action_cache
+
+    if _latest_action_cache is None:
+        with _latest_action_cache_lock:
+            if _latest_action_cache is None:
+                cache = build_cache(getattr(settings, 'ANALYTICS_LATEST_ACTION_CACHE', {}))
+                if cache is not None and not is_shared_cache(cache):
+                    raise ImproperlyConfigured(
+                        'ANALYTICS_LATEST_ACTION_CACHE must use a cache shared by all workers, '
+                        'BACKEND "django" with a memcached or redis ALIAS'
+                    )
+                _latest_action_cache = LatestActionCache(cache) if cache is not None else False
+
+    return _latest_action_cache or None
+
+
+def is_shared_cache(cache):
+    """
+    :param cache: LocalCache or DjangoCache
+    :return: False for caches which only live in the current process
+    """
+
+    if not isinstance(cache, DjangoCache):
+        return False
+
+    return type(cache.cache).__name__ not in ('LocMemCache', 'DummyCache')
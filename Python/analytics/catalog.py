@@ -0,0 +1,97 @@
+import datetime
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from apps.aggregations.models import TransactionItems
+from apps.analytics.models import ArticleTitle, RollupState
+
+STATE_NAME = 'article_titles'
+
+VARIANTS = {'XS', 'S', 'M', 'L', 'XL', 'XXL', 'XS/S', 'S/M', 'M/L', 'L/XL', 'XL/XXL'}
+
+
+def normalize_title(title):
+    """
+    Strip size variant from the end of article title
+    :param title:
+    :return: str
+    """
+
+    parts = title.split()
+    if parts and parts[-1].upper() in VARIANTS:
+        return title.rsplit(' ', 1)[0]
+
+    return title
+
+
+def update_article_titles(keys):
+    """
+    Rebuild ArticleTitle of the given articles from all their TransactionItems.
+    :param keys: iterable of (shop_id, articleID)
+    :return: dict (shop_id, articleID) -> name of the updated articles
+    """
+
+    articles = defaultdict(set)
+    for shop_id, article_id in keys:
+        articles[shop_id].add(article_id)
+
+    titles = {}
+    for shop_id, article_ids in articles.items():
+        for article_id, title in TransactionItems.objects.filter(
+            transaction__shop_id=shop_id,
+            articleID__in=article_ids
+        ).order_by('articleID', 'number').distinct('articleID').values_list('articleID', 'title'):
+            titles[(shop_id, article_id)] = normalize_title(title or article_id)
+
+    if not titles:
+        return titles
+
+    existing = {}
+    for shop_id, article_ids in articles.items():
+        for article in ArticleTitle.objects.filter(shop_id=shop_id, articleID__in=article_ids):
+            existing[(article.shop_id, article.articleID)] = article
+
+    to_update = []
+    to_create = []
+    for (shop_id, article_id), name in titles.items():
+        article = existing.get((shop_id, article_id))
+        if article is None:
+            to_create.append(ArticleTitle(shop_id=shop_id, articleID=article_id, name=name))
+        elif article.name != name:
+            article.name = name
+            to_update.append(article)
+
+    ArticleTitle.objects.bulk_create(to_create, ignore_conflicts=True)
+    ArticleTitle.objects.bulk_update(to_update, ['name'])
+
+    return titles
+
+
+def refresh_article_titles(now=None, chunk_size=1000):
+    """
+    Update titles of all articles with TransactionItems since the last run.
+    :param now: aware datetime, defaults to now
+    :param chunk_size: articles per transaction
+    :return: number of refreshed articles
+    """
+
+    until = now or timezone.now()
+    state, created = RollupState.objects.get_or_create(name=STATE_NAME)
+
+    items = TransactionItems.objects.filter(transaction__created_at__lt=until)
+    if state.rolled_up_to is not None:
+        # overlap for transactions committed late with an older created_at
+        items = items.filter(transaction__created_at__gte=state.rolled_up_to - datetime.timedelta(minutes=5))
+
+    keys = list(items.values_list('transaction__shop_id', 'articleID').distinct())
+
+    for index in range(0, len(keys), chunk_size):
+        with transaction.atomic():
+            update_article_titles(keys[index:index + chunk_size])
+
+    RollupState.objects.filter(pk=state.pk).update(rolled_up_to=until)
+
+    return len(keys)
+
@@ -0,0 +1,32 @@
+"""
+Expression indexes on TrackData.data which were created outside of migrations
+by earlier versions, replaced by the partial indexes on the typed columns
+(trackdata_prd_articleid_idx, trackdata_product_vtime_idx).
+Add the operation to the migration which adds the typed columns:
+
+    from apps.analytics.indexes import drop_expression_indexes
+
+    operations = [
+        drop_expression_indexes,
+        ...
+    ]
+"""
+from django.db import migrations
+
+EXPRESSION_INDEXES = [
+    (
+        'trackdata_product_article_idx',
+        "CREATE INDEX IF NOT EXISTS trackdata_product_article_idx "
+        "ON analytics_trackdata (session_id, (data ->> 'articleID')) WHERE type = 1",
+    ),
+    (
+        'trackdata_product_view_time_idx',
+        "CREATE INDEX IF NOT EXISTS trackdata_product_view_time_idx "
+        "ON analytics_trackdata (session_id, ((data ->> 'view_time')::integer) DESC) WHERE type = 1",
+    ),
+]
+
+drop_expression_indexes = migrations.RunSQL(
+    ['DROP INDEX IF EXISTS %s' % name for name, sql in EXPRESSION_INDEXES],
+    [sql for name, sql in EXPRESSION_INDEXES],
+)
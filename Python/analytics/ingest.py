@@ -0,0 +1,509 @@
+import atexit
+import datetime
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+from django.db.models import Q
+
+from apps.analytics.cache import get_session_cache
+from apps.analytics.latest_actions import write_latest_actions
+from apps.analytics.models import TrackSession, TrackData
+from apps.analytics.top_products import product_row, update_top_products
+from apps.core.expressions import JSONBMerge
+from apps.core.models import BulkCreateManager
+
+logger = logging.getLogger(__name__)
+
+# track time customer spent on product
+VIEW_TIME_TYPES = (
+    TrackData.types['other'],
+    TrackData.types['product'],
+    TrackData.types['category'],
+)
+
+
+def resolve_sessions(keys, use_cache=True):
+    """
+    Get or create TrackSession for every (shop_id, customer_id, session_id).
+    Keys found in the session cache need no query at all. The rest is loaded
+    with one upsert, which also creates the missing sessions. So `updated_at`
+    is refreshed at most once per cache timeout.
+    :param keys: iterable of (shop_id, customer_id, session_id)
+    :param use_cache: read cached session ids
+    :return: dict (shop_id, customer_id, session_id) -> TrackSession.pk
+    """
+
+    keys = set(keys)
+    if not keys:
+        return {}
+
+    session_cache = get_session_cache()
+
+    sessions = {}
+    if session_cache is not None and use_cache:
+        sessions = session_cache.get_many(keys)
+
+    missing = keys - set(sessions)
+    if not missing:
+        return sessions
+
+    # one INSERT ... ON CONFLICT DO UPDATE touches existing sessions,
+    # creates the missing ones and returns all ids
+    manager = BulkCreateManager(chunk_size=len(missing) + 1)
+    created = [
+        TrackSession(shop_id=shop_id, customer_id=customer_id, session_id=session_id)
+        for shop_id, customer_id, session_id in missing
+    ]
+    for session in created:
+        manager.upsert(session, ['updated_at'])
+    manager.done()
+
+    loaded = dict(
+        ((session.shop_id, session.customer_id, session.session_id), session.pk)
+        for session in created
+    )
+
+    if session_cache is not None:
+        session_cache.set_many(loaded)
+
+    sessions.update(loaded)
+
+    return sessions
+
+
+def invalidate_sessions(keys):
+    """
+    Remove (shop_id, customer_id, session_id) keys from the session cache.
+    Must be called whenever TrackSession keys are changed or sessions are deleted.
+    :param keys: iterable of (shop_id, customer_id, session_id)
+    :return: None
+    """
+
+    session_cache = get_session_cache()
+    if session_cache is not None:
+        session_cache.delete_many(keys)
+
+
+def store_events(events):
+    """
+    Persist validated track events.
+    Sessions of all events are resolved together with `resolve_sessions`,
+    `duration` and `view_time` are calculated from the time the event was received
+    and all TrackData rows are created with `bulk_create`.
+    :param events: list of TrackDataSerializer data dicts with `received_at` timestamp
+    :return: list of created TrackData objects, in the order of `events`
+    """
+
+    # processed in time order, returned in input order
+    order = sorted(range(len(events)), key=lambda index: events[index]['received_at'])
+    events = [events[index] for index in order]
+
+    sessions = resolve_sessions(
+        (event['shop_id'], event['customer_id'], event['session_id']) for event in events
+    )
+
+    # latest view action per session, loaded from TrackSession and then moved to pending events
+    last_actions = load_last_actions(set(
+        sessions[(event['shop_id'], event['customer_id'], event['session_id'])]
+        for event in events if event['type'] in VIEW_TIME_TYPES
+    ))
+    last_signs = {}
+    view_times = {}
+    track_data = []
+
+    for event in events:
+        session_id = event['session_id']
+        session_pk = sessions[(event['shop_id'], event['customer_id'], session_id)]
+        data = event['data'] if event['data'] is not None else {}
+
+        if event['type'] == TrackData.types['register']:
+            if session_id not in last_signs:
+                last_sign = TrackData.objects.filter(
+                    session__session_id=session_id,
+                    type=TrackData.types['sign']
+                ).order_by('-created_at').values('created_at').first()
+                last_signs[session_id] = last_sign['created_at'].timestamp() if last_sign else None
+
+            if last_signs[session_id] is not None:
+                data.update({'duration': max(round(event['received_at'] - last_signs[session_id]), 0)})
+
+        item = TrackData(
+            session_id=session_pk,
+            url=event['url'],
+            uuid=event['uuid'],
+            type=event['type'],
+            data=data,
+            **TrackData.typed_fields(data)
+        )
+        track_data.append(item)
+
+        if event['type'] == TrackData.types['sign']:
+            last_signs[session_id] = event['received_at']
+
+        if event['type'] in VIEW_TIME_TYPES:
+            last_action = last_actions.get(session_pk)
+            if last_action and not last_action['has_view_time']:
+                # events of a batch can be older than the last stored action
+                view_time = max(round(event['received_at'] - last_action['timestamp']), 0)
+                if last_action['item'] is not None:
+                    last_action['item'].data.update({'view_time': view_time})
+                    last_action['item'].view_time = view_time
+                else:
+                    view_times[last_action['id']] = view_time
+
+            last_actions[session_pk] = {
+                'id': None,
+                'item': item,
+                'timestamp': event['received_at'],
+                'has_view_time': 'view_time' in data,
+            }
+
+    # one UPDATE for all rows, data is merged in the database without loading it
+    with BulkCreateManager(chunk_size=500) as manager:
+        for track_id, view_time in view_times.items():
+            manager.update(
+                TrackData(pk=track_id, data=JSONBMerge('data', {'view_time': view_time}), view_time=view_time),
+                ['data', 'view_time']
+            )
+
+    try:
+        _create_track_data(track_data)
+    except IntegrityError:
+        # a cached session was deleted, resolve sessions from the db and try once more
+        keys = set((event['shop_id'], event['customer_id'], event['session_id']) for event in events)
+        invalidate_sessions(keys)
+        sessions = resolve_sessions(keys, use_cache=False)
+        for event, item in zip(events, track_data):
+            item.session_id = sessions[(event['shop_id'], event['customer_id'], event['session_id'])]
+        # rows of already committed chunks got their pk
+        _create_track_data([item for item in track_data if item.pk is None])
+
+    for last_action in last_actions.values():
+        if last_action['item'] is not None:
+            save_last_action(last_action)
+
+    product_rows = [product_row(item) for item in track_data if item.type == TrackData.types['product']]
+    if view_times:
+        product_rows += [
+            product_row(row) for row in TrackData.objects.filter(
+                pk__in=view_times, type=TrackData.types['product']
+            ).values('id', 'session_id', 'created_at', 'data', 'article_id', 'view_time')
+        ]
+    update_top_products(product_rows)
+
+    write_latest_actions(events, track_data, view_times)
+
+    result = [None] * len(track_data)
+    for index, item in zip(order, track_data):
+        result[index] = item
+
+    return result
+
+
+def load_last_actions(session_pks):
+    """
+    Latest TrackData of VIEW_TIME_TYPES for every session.
+    Read from the TrackSession last action columns with one query. Sessions
+    tracked before those columns existed are looked up once in TrackData.
+    :param session_pks: set of TrackSession.pk
+    :return: dict session pk -> {'id', 'item', 'timestamp', 'has_view_time'}
+    """
+
+    if not session_pks:
+        return {}
+
+    last_actions = {}
+    unknown = []
+
+    for session in TrackSession.objects.filter(pk__in=session_pks).values(
+        'pk', 'last_action_id', 'last_action_at', 'last_action_has_view_time'
+    ):
+        if session['last_action_id'] is None:
+            unknown.append(session['pk'])
+            continue
+
+        last_actions[session['pk']] = {
+            'id': session['last_action_id'],
+            'item': None,
+            'timestamp': session['last_action_at'].timestamp(),
+            'has_view_time': session['last_action_has_view_time'],
+        }
+
+    if unknown:
+        for action in TrackData.objects.filter(
+            session_id__in=unknown,
+            type__in=VIEW_TIME_TYPES
+        ).order_by('session_id', '-created_at').distinct('session_id').values('id', 'session_id', 'created_at', 'data', 'view_time'):
+            last_actions[action['session_id']] = {
+                'id': action['id'],
+                'item': None,
+                'timestamp': action['created_at'].timestamp(),
+                # rows from before the typed columns were backfilled only have data['view_time']
+                'has_view_time': action['view_time'] is not None or 'view_time' in (action['data'] or {}),
+            }
+
+    return last_actions
+
+
+def save_last_action(last_action):
+    """
+    Point TrackSession to its latest view action, unless a newer one was saved meanwhile.
+    :param last_action: dict with created `item`
+    :return: None
+    """
+
+    item = last_action['item']
+    last_action_at = datetime.datetime.fromtimestamp(last_action['timestamp'], tz=datetime.timezone.utc)
+
+    TrackSession.objects.filter(
+        Q(last_action_at__isnull=True) | Q(last_action_at__lte=last_action_at),
+        pk=item.session_id
+    ).update(
+        last_action_id=item.pk,
+        last_action_at=last_action_at,
+        last_action_has_view_time=last_action['has_view_time'],
+    )
+
+
+def move_track_data(session_pk, target_pk):
+    """
+    Move all TrackData of a session into another session of the customer and
+    merge the moved products and view actions into the top products and last
+    action of the target session.
+    :param session_pk: TrackSession.pk the rows are taken from
+    :param target_pk: TrackSession.pk the rows are moved to
+    :return: None
+    """
+
+    moved = list(TrackData.objects.filter(
+        session_id=session_pk,
+        type__in=VIEW_TIME_TYPES
+    ).values('id', 'created_at', 'type', 'data', 'article_id', 'view_time'))
+
+    TrackData.objects.filter(session_id=session_pk).update(session_id=target_pk)
+
+    update_top_products([
+        product_row(dict(row, session_id=target_pk)) for row in moved if row['type'] == TrackData.types['product']
+    ])
+
+    last = max((row for row in moved if row['created_at']), key=lambda row: row['created_at'], default=None)
+    if last is not None:
+        # sessions without a last action find theirs in TrackData, see load_last_actions
+        TrackSession.objects.filter(pk=target_pk, last_action_at__lte=last['created_at']).update(
+            last_action_id=last['id'],
+            last_action_at=last['created_at'],
+            last_action_has_view_time=last['view_time'] is not None or 'view_time' in (last['data'] or {}),
+        )
+
+
+def _create_track_data(track_data):
+    manager = BulkCreateManager(chunk_size=getattr(settings, 'ANALYTICS_INGEST', {}).get('FLUSH_SIZE', 500))
+    for item in track_data:
+        manager.add(item)
+    manager.done()
+
+
+class IngestBuffer(object):
+    """
+    In-process queue for track events.
+    Events are acknowledged as soon as they are queued and written with `store_events`
+    when `flush_size` events are waiting or every `flush_interval` seconds.
+    When `spool_dir` is set every queued event is appended to a per-process spool file
+    first, so events of a crashed worker can be stored with `flush_track_spool`.
+    With `flush_interval=None` no background thread is started and the buffer is
+    only flushed by size or by calling `flush()`.
+    """
+
+    def __init__(self, flush_size=500, flush_interval=2, spool_dir=None):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir
+        self._events = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._spool_file = None
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, 'ANALYTICS_INGEST', {})
+        return cls(
+            flush_size=config.get('FLUSH_SIZE', 500),
+            flush_interval=config.get('FLUSH_INTERVAL', 2),
+            spool_dir=config.get('SPOOL_DIR'),
+        )
+
+    def add(self, event):
+        """
+        Queue validated event data.
+        :param event: TrackDataSerializer data, optionally with `received_at` timestamp
+        :return: None
+        """
+
+        event = dict(event)
+        event.setdefault('received_at', time.time())
+
+        with self._lock:
+            self._events.append(event)
+            if self.spool_dir:
+                self._write_spool(event)
+            size_reached = len(self._events) >= self.flush_size
+
+        if not self.flush_interval:
+            if size_reached:
+                self.flush()
+            return
+
+        self._ensure_thread()
+        if size_reached:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Store all queued events.
+        :return: number of stored events
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+                spool_path = self._rotate_spool()
+
+            if not events:
+                return 0
+
+            try:
+                store_events(events)
+            except Exception:
+                # spooled events stay on disk and can be stored later with flush_track_spool
+                logger.exception('Failed to store %d track events', len(events))
+                if spool_path:
+                    os.rename(spool_path, spool_path.replace('.flushing', '.failed'))
+                return 0
+
+            if spool_path:
+                os.remove(spool_path)
+
+            return len(events)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is None:
+                    atexit.register(self.flush)
+                self._thread = threading.Thread(target=self._run, name='track-ingest', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                # this thread owns its own db connection
+                close_old_connections()
+
+    def _spool_path(self):
+        return os.path.join(self.spool_dir, 'track-%d.spool' % os.getpid())
+
+    def _write_spool(self, event):
+        if self._spool_file is None:
+            self._spool_file = open(self._spool_path(), 'a')
+
+        self._spool_file.write(json.dumps(event) + '\n')
+        self._spool_file.flush()
+
+    def _rotate_spool(self):
+        """
+        Move current spool file aside so new events go to a fresh file.
+        Must be called with the queue lock held.
+        :return: path of the rotated file or None
+        """
+
+        if self._spool_file is None:
+            return None
+
+        self._spool_file.close()
+        self._spool_file = None
+
+        spool_path = self._spool_path()
+        flushing_path = '%s.%d.flushing' % (spool_path, int(time.time() * 1000))
+        os.rename(spool_path, flushing_path)
+
+        return flushing_path
+
+
+def read_spool_file(path):
+    """
+    Read queued events from spool file. Incomplete last line is skipped.
+    :param path:
+    :return: list of events
+    """
+
+    events = []
+    with open(path) as spool_file:
+        for line in spool_file:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return events
+
+
+def orphaned_spool_files(spool_dir):
+    """
+    Spool files which are not owned by a running worker process.
+    :param spool_dir:
+    :return: list of paths
+    """
+
+    paths = []
+    for path in glob.glob(os.path.join(spool_dir, 'track-*.spool*')):
+        pid = int(os.path.basename(path).split('.')[0].split('-')[1])
+        if path.endswith('.failed') or not _pid_alive(pid):
+            paths.append(path)
+
+    return sorted(paths)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+_ingest_buffer = None
+_ingest_buffer_lock = threading.Lock()
+
+
+def get_ingest_buffer():
+    """
+    Process wide IngestBuffer configured from ANALYTICS_INGEST settings.
+    :return: IngestBuffer
+    """
+
+    global _ingest_buffer
+
+    if _ingest_buffer is None:
+        with _ingest_buffer_lock:
+            if _ingest_buffer is None:
+                _ingest_buffer = IngestBuffer.from_settings()
+
+    return _ingest_buffer
@@ -0,0 +1,194 @@
+"""
+Latest TrackData per type of a customer's most recent sessions, used by
+LastActionByType on every storefront page.
+
+Entries are loaded from the database on a cache miss. Track-data ingest writes
+new actions through to the cached entries after commit, events of sessions
+which are not cached and customer merges invalidate the entries instead
+(see LatestActionCache), so lookups between writes need no query:
+
+    {'sessions': [{'session_id': str, 'created_at': timestamp or None,
+                   'actions': {type: {'id', 'created_at', 'data'}}}]}
+
+The two latest sessions are kept, which answers requests excluding the
+current session as well.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Subquery
+
+from apps.analytics.cache import get_latest_action_cache
+from apps.analytics.models import TrackSession, TrackData
+from apps.core.cache import latest_action_cache_stats
+
+SESSIONS_PER_CUSTOMER = 2
+
+
+def get_latest_action(shop_id, customer_id, types, exclude_session_id=None):
+    """
+    Data of the latest action with one of `types` in the latest session of the customer.
+    :param shop_id:
+    :param customer_id:
+    :param types: list of TrackData.types values
+    :param exclude_session_id: session_id which is not considered (current session)
+    :return: TrackData.data, None if there is no such action
+    """
+
+    cache = get_latest_action_cache()
+    if cache is None:
+        return query_latest_action(shop_id, customer_id, types, exclude_session_id)
+
+    key = (shop_id, customer_id)
+    entry, version = cache.get(key)
+    if entry is None:
+        latest_action_cache_stats.incr('latest_action', 'miss')
+        entry = load_entry(shop_id, customer_id)
+        cache.set(key, entry, version)
+    else:
+        latest_action_cache_stats.incr('latest_action', 'hit')
+
+    sessions = [
+        session for session in entry['sessions']
+        if exclude_session_id is None or session['session_id'] != str(exclude_session_id)
+    ]
+    if not sessions:
+        return None
+
+    actions = [sessions[0]['actions'][type] for type in types if type in sessions[0]['actions']]
+    if not actions:
+        return None
+
+    return max(actions, key=lambda action: action['created_at'] or 0)['data']
+
+
+def query_latest_action(shop_id, customer_id, types, exclude_session_id=None):
+    """
+    Same as get_latest_action with a single query: the latest session is a
+    subquery served by tracksession_customer_idx, the action by
+    trackdata_session_type_idx.
+    """
+
+    last_session = TrackSession.objects.filter(
+        shop_id=shop_id,
+        customer_id=customer_id
+    )
+
+    if exclude_session_id:
+        last_session = last_session.exclude(session_id=exclude_session_id)
+
+    last_session = last_session.order_by('-created_at')
+
+    analytic = TrackData.objects.filter(
+        session=Subquery(last_session.values('pk')[:1]),
+        type__in=types
+    ).values('data').order_by('-created_at').first()
+
+    return analytic['data'] if analytic else None
+
+
+def load_entry(shop_id, customer_id):
+    """
+    Cache entry of a customer from the database
+    :return: entry dict
+    """
+
+    sessions = [
+        {
+            'pk': session['pk'],
+            'session_id': session['session_id'],
+            'created_at': session['created_at'].timestamp() if session['created_at'] else None,
+            'actions': {},
+        }
+        for session in TrackSession.objects.filter(
+            shop_id=shop_id,
+            customer_id=customer_id
+        ).order_by('-created_at').values('pk', 'session_id', 'created_at')[:SESSIONS_PER_CUSTOMER]
+    ]
+
+    if sessions:
+        by_pk = {session['pk']: session for session in sessions}
+        for action in TrackData.objects.filter(session_id__in=by_pk).order_by(
+            'session_id', 'type', '-created_at'
+        ).distinct('session_id', 'type').values('id', 'session_id', 'type', 'created_at', 'data'):
+            by_pk[action['session_id']]['actions'][action['type']] = {
+                'id': action['id'],
+                'created_at': action['created_at'].timestamp() if action['created_at'] else None,
+                'data': action['data'],
+            }
+
+    for session in sessions:
+        del session['pk']
+
+    return {'sessions': sessions}
+
+
+def invalidate_latest_actions(keys):
+    """
+    Outdate cached entries once the current transaction is committed, must be
+    called whenever TrackData or sessions of a customer are changed.
+    :param keys: iterable of (shop_id, customer_id)
+    :return: None
+    """
+
+    cache = get_latest_action_cache()
+    if cache is None:
+        return
+
+    keys = set(keys)
+    if keys:
+        transaction.on_commit(lambda: cache.invalidate_many(keys))
+
+
+def write_latest_actions(events, track_data, view_times=None):
+    """
+    Add stored actions to the cached entries of their customers once the
+    current transaction is committed.
+    :param events: store_events events, in the order of track_data
+    :param track_data: created TrackData objects
+    :param view_times: dict TrackData.pk -> view_time of earlier actions updated in the database
+    :return: None
+    """
+
+    cache = get_latest_action_cache()
+    if cache is None:
+        return
+
+    actions = defaultdict(list)
+    for event, item in zip(events, track_data):
+        actions[(event['shop_id'], event['customer_id'])].append((str(event['session_id']), item))
+
+    def write():
+        for key, items in actions.items():
+            cache.update(key, lambda entry: merge_actions(entry, items, view_times or {}))
+
+    transaction.on_commit(write)
+
+
+def merge_actions(entry, items, view_times):
+    """
+    :param entry: cached entry
+    :param items: list of (session_id, created TrackData)
+    :param view_times: dict TrackData.pk -> view_time
+    :return: updated entry, None if an item belongs to a session which is not cached
+    """
+
+    sessions = {session['session_id']: session for session in entry['sessions']}
+
+    for session_id, item in items:
+        session = sessions.get(session_id)
+        if session is None:
+            # a new session, or an older one, the entry can't tell their order
+            return None
+
+        created_at = item.created_at.timestamp() if item.created_at else None
+        current = session['actions'].get(item.type)
+        if current is None or (current['created_at'] or 0) <= (created_at or 0):
+            session['actions'][item.type] = {'id': item.pk, 'created_at': created_at, 'data': item.data}
+
+    for session in entry['sessions']:
+        for action in session['actions'].values():
+            if action['id'] in view_times:
+                action['data'] = dict(action['data'] or {}, view_time=view_times[action['id']])
+
+    return entry
@@ -0,0 +1,26 @@
+from django.db import connection
+
+from apps.analytics.models import TrackData
+from apps.core.chunked import ChunkedCommand
+
+# same rules as TrackData.typed_fields, non numeric values and too long ids stay NULL
+BACKFILL_SQL = '''
+UPDATE analytics_trackdata SET
+    article_id = CASE WHEN length(data ->> 'articleID') <= 255 THEN NULLIF(data ->> 'articleID', '') END,
+    view_time = CASE WHEN data ->> 'view_time' ~ '^[0-9]{1,9}$' THEN (data ->> 'view_time')::integer END,
+    duration = CASE WHEN data ->> 'duration' ~ '^[0-9]{1,9}$' THEN (data ->> 'duration')::integer END
+WHERE id >= %s AND id < %s
+    AND data IS NOT NULL
+    AND article_id IS NULL AND view_time IS NULL AND duration IS NULL
+    AND (data ? 'articleID' OR data ? 'view_time' OR data ? 'duration')
+'''
+
+
+class Command(ChunkedCommand):
+    help = 'Copy articleID, view_time and duration from TrackData.data into the typed columns'
+    model = TrackData
+
+    def process_chunk(self, queryset, start, end):
+        with connection.cursor() as cursor:
+            cursor.execute(BACKFILL_SQL, [start, end])
+            return cursor.rowcount
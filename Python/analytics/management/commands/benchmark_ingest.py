@@ -0,0 +1,74 @@
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+
+from apps.analytics.ingest import IngestBuffer, invalidate_sessions
+from apps.analytics.latest_actions import invalidate_latest_actions
+from apps.analytics.models import TrackData
+from apps.analytics.views import TrackAnalyticData
+
+
+class Command(BaseCommand):
+    help = 'Compare events/sec of direct and buffered track-data ingest. All written rows are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=2000)
+        parser.add_argument('--sessions', type=int, default=50)
+        parser.add_argument('--flush-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        events = self.generate_events(options['events'], options['sessions'])
+
+        direct = TrackAnalyticData.as_view(buffered=False)
+        buffer = IngestBuffer(flush_size=options['flush_size'], flush_interval=None)
+        buffered = TrackAnalyticData.as_view(buffered=True, buffer=buffer)
+
+        results = [
+            ('direct', self.run(direct, events)),
+            ('buffered', self.run(buffered, events, buffer)),
+        ]
+
+        for name, seconds in results:
+            self.stdout.write('%-10s %8d events %8.2fs %10.1f events/sec' % (
+                name, len(events), seconds, len(events) / seconds
+            ))
+
+    def generate_events(self, count, sessions):
+        session_ids = [uuid.uuid4().hex for _ in range(sessions)]
+        types = [TrackData.types['other'], TrackData.types['product'], TrackData.types['category']]
+
+        return [
+            {
+                'customer_id': index % sessions + 1,
+                'shop_id': 1,
+                'session_id': session_ids[index % sessions],
+                'uuid': uuid.uuid4().hex,
+                'url': 'https://example.com/item/%d' % index,
+                'type': random.choice(types),
+                'data': {'articleID': str(random.randint(1, 1000))},
+            }
+            for index in range(count)
+        ]
+
+    def run(self, view, events, buffer=None):
+        factory = APIRequestFactory()
+
+        # ids cached by a previous run point to rolled back sessions
+        invalidate_sessions(set((event['shop_id'], event['customer_id'], event['session_id']) for event in events))
+        invalidate_latest_actions(set((event['shop_id'], event['customer_id']) for event in events))
+
+        with transaction.atomic():
+            start = time.perf_counter()
+            for event in events:
+                view(factory.post('/analytics/track-data/', event, format='json'))
+            if buffer is not None:
+                buffer.flush()
+            seconds = time.perf_counter() - start
+
+            transaction.set_rollback(True)
+
+        return seconds
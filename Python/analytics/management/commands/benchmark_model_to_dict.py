@@ -0,0 +1,85 @@
+import json
+import time
+import uuid
+
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from apps.analytics.models import TrackData
+from apps.core.utils import model_to_dict, models_to_dicts
+
+
+def serializer_model_to_dict(instance):
+    # previous model_to_dict, serialize to json and load it again
+    serialized_instance = json.loads(serializers.serialize('json', [instance, ]))[0]
+    instance_dict = serialized_instance['fields']
+    instance_dict['id'] = serialized_instance['pk']
+
+    return instance_dict
+
+
+class Command(BaseCommand):
+    help = 'Compare model_to_dict implementations on TrackData with large JSON data. All written rows are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000)
+        parser.add_argument('--data-keys', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        items = self.generate_items(options['rows'], options['data_keys'])
+
+        if model_to_dict(items[0]) != serializer_model_to_dict(items[0]):
+            self.stderr.write('model_to_dict differs from the serializer output')
+
+        with transaction.atomic():
+            TrackData.objects.bulk_create(items)
+            queryset = TrackData.objects.filter(pk__in=[item.pk for item in items])
+
+            results = [
+                ('serializer', self.run(lambda: [serializer_model_to_dict(item) for item in items], options['repeat'])),
+                ('instances', self.run(lambda: [model_to_dict(item) for item in items], options['repeat'])),
+                ('serializer+query', self.run(lambda: [serializer_model_to_dict(item) for item in queryset.all()], options['repeat'])),
+                ('instances+query', self.run(lambda: [model_to_dict(item) for item in queryset.all()], options['repeat'])),
+                ('values+query', self.run(lambda: models_to_dicts(queryset.all()), options['repeat'])),
+            ]
+
+            transaction.set_rollback(True)
+
+        baseline = results[0][1]
+        for name, seconds in results:
+            self.stdout.write('%-18s %8d rows %8.1f ms %10.1f rows/sec %6.1fx' % (
+                name, len(items), seconds * 1000, len(items) / seconds, baseline / seconds
+            ))
+
+    def generate_items(self, count, data_keys):
+        now = timezone.now()
+
+        return [
+            TrackData(
+                uuid=uuid.uuid4().hex,
+                url='https://example.com/item/%d' % index,
+                type=TrackData.types['product'],
+                data={
+                    'articleID': str(index),
+                    'attributes': {'attribute_%d' % key: 'value %d' % key for key in range(data_keys)},
+                    'history': [{'articleID': str(key), 'view_time': key} for key in range(data_keys // 10)],
+                },
+                article_id=str(index),
+                created_at=now,
+                updated_at=now
+            )
+            for index in range(count)
+        ]
+
+    def run(self, function, repeat):
+        total = 0
+
+        for index in range(repeat):
+            start = time.perf_counter()
+            function()
+            total += time.perf_counter() - start
+
+        return total / repeat
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+
+from apps.analytics.views import PopUpShowVsClick, PopUpClickVsPurchase, PopUpClicks, PopUpPurchases, PopUpRevenue, PopItems, PopupMetrics
+
+
+class Command(BaseCommand):
+    help = 'Compare the popup dashboard endpoint fan-out with the combined popup-metrics endpoint'
+
+    fan_out = [PopUpShowVsClick, PopUpClickVsPurchase, PopUpClicks, PopUpPurchases, PopUpRevenue, PopItems]
+
+    def add_arguments(self, parser):
+        parser.add_argument('shop_id', type=int)
+        parser.add_argument('--start-date', default=None)
+        parser.add_argument('--end-date', default=None)
+        parser.add_argument('--group-type', default='day')
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        data = {
+            'shop_id': options['shop_id'],
+            'start_date': options['start_date'],
+            'end_date': options['end_date'],
+            'group_type': options['group_type'],
+        }
+
+        results = [
+            ('fan-out', self.run([view.as_view(permission_classes=[]) for view in self.fan_out], data, options['repeat'])),
+            ('combined', self.run([PopupMetrics.as_view(permission_classes=[])], data, options['repeat'])),
+        ]
+
+        for name, (seconds, queries) in results:
+            self.stdout.write('%-10s %8.1f ms/dashboard %4d queries' % (name, seconds * 1000, queries))
+
+    def run(self, views, data, repeat):
+        factory = APIRequestFactory()
+        total = 0
+
+        with CaptureQueriesContext(connection) as context:
+            for index in range(repeat):
+                start = time.perf_counter()
+                for view in views:
+                    response = view(factory.post('/', data, format='json'))
+                    response.render()
+                total += time.perf_counter() - start
+
+        return total / repeat, len(context.captured_queries) // repeat
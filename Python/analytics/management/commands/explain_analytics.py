@@ -0,0 +1,130 @@
+import random
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory
+
+from apps.analytics.models import TrackSession, TrackData
+from apps.analytics.top_products import product_row, update_top_products
+from apps.analytics.views import LastActionByType, LastSessionMostPopular, GetSessionLastVoucher, GetAnalyticDataByType
+from apps.core.models import BulkCreateManager
+
+
+class QueryCollector(object):
+    """
+    Database execute wrapper which keeps all executed SELECT statements.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith('SELECT'):
+            self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN ANALYZE for the queries of the analytics read endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Number of sessions to generate, rolled back afterwards')
+        parser.add_argument('--events', type=int, default=30, help='Events per generated session')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['seed']:
+                self.seed(options['seed'], options['events'])
+
+            session = TrackSession.objects.order_by('-created_at').first()
+            if session is None:
+                self.stderr.write('No track sessions found, use --seed')
+                return
+
+            for name, view, data in self.endpoints(session):
+                self.explain(name, view, data)
+
+            transaction.set_rollback(True)
+
+    def endpoints(self, session):
+        customer = {
+            'shop_id': session.shop_id,
+            'customer_id': session.customer_id,
+        }
+
+        return [
+            ('LastActionByType', LastActionByType.as_view(), dict(customer, type=TrackData.types['product'])),
+            ('LastSessionMostPopular', LastSessionMostPopular.as_view(), dict(customer, exclude_id='1')),
+            ('GetSessionLastVoucher', GetSessionLastVoucher.as_view(), dict(
+                customer, type=TrackData.types['other'], session_id=session.session_id
+            )),
+            ('GetAnalyticDataByType', GetAnalyticDataByType.as_view(), {
+                'shop_id': session.shop_id,
+                'type': TrackData.types['product'],
+            }),
+        ]
+
+    def explain(self, name, view, data):
+        collector = QueryCollector()
+        request = APIRequestFactory().post('/', data, format='json')
+
+        with connection.execute_wrapper(collector):
+            view(request)
+
+        self.stdout.write(self.style.MIGRATE_HEADING('%s: %d queries' % (name, len(collector.queries))))
+
+        with connection.cursor() as cursor:
+            for sql, params in collector.queries:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+                self.stdout.write(sql % tuple(repr(param) for param in params or ()))
+                for row in cursor.fetchall():
+                    self.stdout.write('    ' + row[0])
+                self.stdout.write('')
+
+    def seed(self, sessions, events):
+        types = [TrackData.types['other'], TrackData.types['product'], TrackData.types['category']]
+        manager = BulkCreateManager(chunk_size=5000, copy_models=[TrackData])
+
+        track_sessions = TrackSession.objects.bulk_create([
+            TrackSession(
+                shop_id=random.randint(1, 10),
+                customer_id=index + 1,
+                session_id=uuid.uuid4().hex
+            )
+            for index in range(sessions)
+        ])
+
+        for session in track_sessions:
+            for index in range(events):
+                data = {'articleID': str(random.randint(1, 5000))}
+                if index < events - 1:
+                    data['view_time'] = random.randint(1, 300)
+
+                manager.add(TrackData(
+                    session=session,
+                    uuid=uuid.uuid4().hex,
+                    url='https://example.com/item/%s' % data['articleID'],
+                    type=random.choice(types),
+                    data=data,
+                    **TrackData.typed_fields(data)
+                ))
+        manager.done()
+
+        # top_products / last_product_at like ingest fills them, read by LastSessionMostPopular
+        session_pks = [session.pk for session in track_sessions]
+        for index in range(0, len(session_pks), 1000):
+            update_top_products([
+                product_row(row) for row in TrackData.objects.filter(
+                    session_id__in=session_pks[index:index + 1000],
+                    type=TrackData.types['product']
+                ).values('id', 'session_id', 'created_at', 'data', 'article_id', 'view_time')
+            ])
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE analytics_tracksession')
+            cursor.execute('ANALYZE analytics_trackdata')
+
+        self.stdout.write('Seeded %d sessions with %d events' % (sessions, sessions * events))
+        for model, stats in manager.stats.items():
+            self.stdout.write('    %s: %d rows in %.2fs' % (model, stats['rows'], stats['seconds']))
@@ -0,0 +1,30 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.analytics.ingest import store_events, read_spool_file, orphaned_spool_files
+
+
+class Command(BaseCommand):
+    help = 'Store track events left in spool files by failed flushes or stopped workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spool-dir', default=None, help='Defaults to ANALYTICS_INGEST["SPOOL_DIR"]')
+
+    def handle(self, *args, **options):
+        spool_dir = options['spool_dir'] or getattr(settings, 'ANALYTICS_INGEST', {}).get('SPOOL_DIR')
+        if not spool_dir:
+            raise CommandError('Spool directory is not configured')
+
+        total = 0
+        for path in orphaned_spool_files(spool_dir):
+            events = read_spool_file(path)
+            if events:
+                store_events(events)
+            os.remove(path)
+
+            total += len(events)
+            self.stdout.write('%s: %d events' % (os.path.basename(path), len(events)))
+
+        self.stdout.write(self.style.SUCCESS('Stored %d events' % total))
@@ -0,0 +1,28 @@
+from django.core.management.base import CommandError
+
+from apps.analytics.models import TrackData
+from apps.core.chunked import ChunkedCommand
+
+
+class Command(ChunkedCommand):
+    help = 'Delete TrackData rows of a type, optionally only rows created before a date'
+    model = TrackData
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('type', help='TrackData type name, e.g. first_viewed_page')
+        parser.add_argument('--before', default=None, help='Only rows created before this date (YYYY-MM-DD)')
+
+    def get_queryset(self):
+        if self.options['type'] not in TrackData.types:
+            raise CommandError('Unknown type "%s"' % self.options['type'])
+
+        queryset = TrackData.objects.filter(type=TrackData.types[self.options['type']])
+
+        if self.options['before']:
+            queryset = queryset.filter(created_at__lt=self.options['before'])
+
+        return queryset
+
+    def process_chunk(self, queryset, start, end):
+        return queryset.delete()[0]
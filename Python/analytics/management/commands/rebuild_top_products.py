@@ -0,0 +1,37 @@
+from apps.analytics.models import TrackSession, TrackData
+from apps.analytics.top_products import product_row, update_top_products
+from apps.core.chunked import ChunkedCommand
+
+
+class Command(ChunkedCommand):
+    help = 'Build TrackSession.top_products from product views for sessions tracked before it existed, ' \
+           'run backfill_track_columns first'
+    model = TrackSession
+    chunk_size = 500
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--all', action='store_true', help='Rebuild all sessions, not only missing ones')
+
+    def get_queryset(self):
+        sessions = TrackSession.objects.all()
+
+        if not self.options['all']:
+            sessions = sessions.filter(top_products__isnull=True)
+
+        return sessions
+
+    def process_chunk(self, queryset, start, end):
+        session_pks = list(queryset.values_list('pk', flat=True))
+        if not session_pks:
+            return 0
+
+        TrackSession.objects.filter(pk__in=session_pks).update(top_products=None, last_product_at=None)
+        update_top_products([
+            product_row(row) for row in TrackData.objects.filter(
+                session_id__in=session_pks,
+                type=TrackData.types['product']
+            ).values('id', 'session_id', 'created_at', 'data', 'article_id', 'view_time')
+        ])
+
+        return len(session_pks)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from apps.analytics.catalog import refresh_article_titles
+
+
+class Command(BaseCommand):
+    help = 'Update article title index with articles of TransactionItems since the last run'
+
+    def handle(self, *args, **options):
+        count = refresh_article_titles()
+        self.stdout.write(self.style.SUCCESS('Refreshed %d articles' % count))
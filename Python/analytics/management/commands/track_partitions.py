@@ -0,0 +1,47 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from apps.analytics import partitions
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming analytics_trackdata partitions and detach expired ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true', help='Convert the plain table into a partitioned one first')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows per UPDATE when filling NULL created_at before --convert')
+        parser.add_argument('--margin-hours', type=int, default=24, help='Minimum hours until the legacy partition of --convert ends')
+        parser.add_argument('--lock-timeout', default='5s', help='Max wait for the table lock of --convert')
+        parser.add_argument('--ahead', type=int, default=None, help='Periods to create ahead, defaults to ANALYTICS_PARTITIONS["AHEAD"]')
+        parser.add_argument('--retention', type=int, default=None, help='Periods to keep, defaults to ANALYTICS_PARTITIONS["RETENTION"]')
+        parser.add_argument('--drop', action='store_true', help='Drop expired partitions instead of keeping them as detached tables')
+
+    def handle(self, *args, **options):
+        config = partitions.get_config()
+        interval = config['INTERVAL']
+        ahead = options['ahead'] if options['ahead'] is not None else config['AHEAD']
+        retention = options['retention'] if options['retention'] is not None else config['RETENTION']
+        now = timezone.now()
+
+        if options['convert']:
+            if partitions.is_partitioned():
+                raise CommandError('%s is already partitioned' % partitions.TABLE)
+
+            boundary = partitions.convert(
+                now, interval, options['batch_size'],
+                datetime.timedelta(hours=options['margin_hours']), options['lock_timeout']
+            )
+            self.stdout.write('Converted %s, legacy partition ends at %s' % (partitions.TABLE, boundary))
+
+        if not partitions.is_partitioned():
+            raise CommandError('%s is not partitioned, use --convert' % partitions.TABLE)
+
+        for name in partitions.create_partitions(now, interval, ahead):
+            self.stdout.write('Created %s' % name)
+
+        if retention:
+            for name in partitions.expired_partitions(now, interval, retention):
+                partitions.detach_partition(name, drop=options['drop'])
+                self.stdout.write('%s %s' % ('Dropped' if options['drop'] else 'Detached', name))
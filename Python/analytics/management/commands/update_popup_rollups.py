@@ -0,0 +1,20 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from apps.analytics.rollups import update_popup_rollups
+
+
+class Command(BaseCommand):
+    help = 'Roll up PopupData and PopupRevenue of all closed hours since the last run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lag', type=int, default=10, help='Minutes to wait after the end of an hour')
+
+    def handle(self, *args, **options):
+        rolled_up_to = update_popup_rollups(lag=datetime.timedelta(minutes=options['lag']))
+
+        if rolled_up_to is None:
+            self.stdout.write('Nothing to roll up')
+        else:
+            self.stdout.write(self.style.SUCCESS('Rolled up to %s' % rolled_up_to))
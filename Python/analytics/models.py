@@ -21,9 +21,43 @@ class TrackSession(AbstractBaseModel):
         blank=False
     )
 
+    # latest TrackData of a view_time type, kept up to date by track-data ingest
+    last_action_id = models.PositiveIntegerField(
+        null=True,
+        blank=True
+    )
+
+    last_action_at = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
+    last_action_has_view_time = models.BooleanField(
+        default=False
+    )
+
+    # top products by view_time and latest products, see apps.analytics.top_products
+    top_products = JSONField(
+        null=True,
+        blank=True
+    )
+
+    last_product_at = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
     class Meta:
         verbose_name_plural = 'Analytics Session'
         unique_together = ('customer_id', 'shop_id', 'session_id')
+        indexes = [
+            # latest session of a customer, covers session_id and id for index only scans
+            models.Index(fields=['shop_id', 'customer_id', '-created_at', 'session_id', 'id'], name='tracksession_customer_idx'),
+            # lookups and merges by session_id only
+            models.Index(fields=['session_id', ], name='tracksession_session_idx'),
+            # latest session of a customer with a product view
+            models.Index(fields=['shop_id', 'customer_id', '-last_product_at'], name='tracksession_product_idx'),
+        ]
 
 
 class TrackData(AbstractBaseModel):
@@ -61,8 +95,168 @@ class TrackData(AbstractBaseModel):
 
     data = JSONField(null=True, blank=True)
 
+    # copies of the data keys used in queries, see TrackData.typed_fields
+    article_id = models.CharField(
+        max_length=255,
+        null=True,
+        blank=True
+    )
+
+    view_time = models.PositiveIntegerField(
+        null=True,
+        blank=True
+    )
+
+    duration = models.PositiveIntegerField(
+        null=True,
+        blank=True
+    )
+
     class Meta:
         verbose_name_plural = 'Analytics Data'
         indexes = [
             models.Index(fields=['created_at', ]),
+            # latest action of a type in a session
+            models.Index(fields=['session', 'type', '-created_at'], name='trackdata_session_type_idx'),
+            # all actions of a type ordered by time
+            models.Index(fields=['type', 'created_at'], name='trackdata_type_created_idx'),
+            # product views of a session
+            models.Index(
+                fields=['session', '-created_at'],
+                name='trackdata_session_product_idx',
+                condition=models.Q(type=1)
+            ),
+            # product views of a session by article / view_time,
+            # replace the expression indexes dropped by apps.analytics.indexes
+            models.Index(
+                fields=['session', 'article_id'],
+                name='trackdata_prd_articleid_idx',
+                condition=models.Q(type=1)
+            ),
+            models.Index(
+                fields=['session', '-view_time'],
+                name='trackdata_product_vtime_idx',
+                condition=models.Q(type=1, view_time__isnull=False)
+            ),
         ]
+
+    @staticmethod
+    def typed_fields(data):
+        """
+        Values of the typed columns for a data dict
+        :param data: dict or None
+        :return: dict with article_id, view_time and duration
+        """
+
+        data = data or {}
+
+        return {
+            'article_id': _article_id(data.get('articleID')),
+            'view_time': _positive_int(data.get('view_time')),
+            'duration': _positive_int(data.get('duration')),
+        }
+
+
+def _article_id(value):
+    if value in (None, ''):
+        return None
+
+    # longer ids are rejected by TrackDataSerializer, old rows are not cut off
+    value = str(value)
+    return value if len(value) <= 255 else None
+
+
+def _positive_int(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+
+    # out of range values would fail the whole insert
+    return value if 0 <= value <= 2147483647 else None
+
+
+class PopupRollup(models.Model):
+    """
+    PopupData / PopupRevenue pre-aggregated per shop, popup type and time bucket.
+    Maintained by the update_popup_rollups command.
+    """
+
+    periods = ['hour', 'day', 'month']
+
+    sources = {
+        'data': 0,
+        'revenue': 1
+    }
+
+    shop_id = models.PositiveIntegerField(
+        validators=[MinValueValidator(1)]
+    )
+
+    source = models.PositiveSmallIntegerField()
+
+    # PopupData.type, 0 for revenue
+    type = models.IntegerField(
+        default=0
+    )
+
+    period = models.CharField(
+        max_length=5
+    )
+
+    # start of the bucket, hours are truncated in UTC, days and months in TIME_ZONE
+    bucket = models.DateTimeField()
+
+    # sum of PopupData.data_count or number of PopupRevenue rows
+    count = models.BigIntegerField(
+        default=0
+    )
+
+    amount = models.DecimalField(
+        max_digits=16,
+        decimal_places=4,
+        default=0
+    )
+
+    class Meta:
+        verbose_name_plural = 'Popup Rollups'
+        unique_together = ('shop_id', 'source', 'type', 'period', 'bucket')
+
+
+class ArticleTitle(models.Model):
+    """
+    Canonical article name per shop, from the TransactionItems title with the lowest
+    number without size variant. Maintained by the refresh_article_titles command.
+    """
+
+    shop_id = models.PositiveIntegerField(
+        validators=[MinValueValidator(1)]
+    )
+
+    articleID = models.CharField(
+        max_length=255
+    )
+
+    name = models.CharField(
+        max_length=255
+    )
+
+    class Meta:
+        verbose_name_plural = 'Article Titles'
+        unique_together = ('shop_id', 'articleID')
+
+
+class RollupState(models.Model):
+    """
+    Raw rows created before `rolled_up_to` are included in the rollup `name`.
+    """
+
+    name = models.CharField(
+        max_length=32,
+        unique=True
+    )
+
+    rolled_up_to = models.DateTimeField(
+        null=True,
+        blank=True
+    )
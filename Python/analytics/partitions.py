@@ -0,0 +1,326 @@
+"""
+Range partitioning of analytics_trackdata by created_at.
+
+The table is converted once with `track_partitions --convert`: the existing table
+becomes the `analytics_trackdata_legacy` partition holding everything before the
+first managed partition, new partitions are created ahead of time and old ones
+are detached (and optionally dropped) instead of deleting rows.
+
+The conversion only holds the exclusive lock for catalog changes: NULL
+created_at values are filled in batches and the partition bound is validated
+as a CHECK constraint beforehand, so ATTACH PARTITION needs no table scan.
+The final step renames the table, creates the partitioned parent with its
+indexes and attaches the legacy table in one statement. It holds an ACCESS
+EXCLUSIVE lock on analytics_trackdata until it commits, so reads and ingest
+wait for it. That's usually well below a second, but waiting for the lock
+behind long running queries is bounded by `lock_timeout` and the conversion
+fails instead of blocking the table.
+
+Rows outside of the created ranges go to the `analytics_trackdata_default`
+partition instead of failing the insert. create_partitions moves rows of a
+new range from there into the new partition before attaching it.
+The legacy partition is detached by the retention as a whole, once its
+upper bound is older than the retention period.
+"""
+import contextlib
+import datetime
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+
+from apps.analytics.models import TrackData
+
+TABLE = TrackData._meta.db_table
+LEGACY_TABLE = TABLE + '_legacy'
+DEFAULT_TABLE = TABLE + '_default'
+
+CONVERT_SQL = '''
+DO $$
+DECLARE
+    idx record;
+BEGIN
+    ALTER TABLE {table} RENAME TO {legacy};
+
+    CREATE TABLE {table} (
+        LIKE {legacy} INCLUDING DEFAULTS INCLUDING STORAGE
+    ) PARTITION BY RANGE (created_at);
+
+    ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id;
+
+    -- recreate indexes with their original names on the parent, the renamed
+    -- legacy indexes are attached to them instead of being rebuilt
+    FOR idx IN
+        SELECT indexname, indexdef FROM pg_indexes
+        WHERE tablename = '{legacy}' AND indexdef NOT LIKE 'CREATE UNIQUE%'
+    LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', idx.indexname, left(idx.indexname, 55) || '_legacy');
+        EXECUTE regexp_replace(idx.indexdef, '{legacy} USING', '{table} USING');
+    END LOOP;
+
+    ALTER TABLE {table} ADD CONSTRAINT {table}_session_id_fk
+        FOREIGN KEY (session_id) REFERENCES analytics_tracksession (id) DEFERRABLE INITIALLY DEFERRED;
+
+    -- implied by the validated {constraint}, so no validation scan
+    ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ('{boundary}');
+
+    ALTER TABLE {legacy} DROP CONSTRAINT {constraint};
+
+    CREATE TABLE {default} PARTITION OF {table} DEFAULT;
+    ALTER TABLE {default} ADD PRIMARY KEY (id);
+END $$;
+'''
+
+# rows of the range are moved out of the default partition, ATTACH PARTITION fails on them
+CREATE_PARTITION_SQL = [
+    'CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING STORAGE)',
+    'ALTER TABLE {name} ADD PRIMARY KEY (id)',
+    'WITH moved AS (DELETE FROM {default} WHERE created_at >= %(start)s AND created_at < %(end)s RETURNING *) '
+    'INSERT INTO {name} SELECT * FROM moved',
+    'ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%(start)s) TO (%(end)s)',
+]
+
+# range partitions do not accept NULL keys
+BACKFILL_SQL = '''
+UPDATE {table} SET created_at = COALESCE(updated_at, now())
+WHERE id IN (SELECT id FROM {table} WHERE created_at IS NULL LIMIT %s)
+'''
+
+BOUND_CONSTRAINT = TABLE + '_legacy_bound'
+
+
+def get_config():
+    config = {
+        'INTERVAL': 'month',
+        'AHEAD': 3,
+        'RETENTION': None,
+    }
+    config.update(getattr(settings, 'ANALYTICS_PARTITIONS', {}))
+
+    return config
+
+
+def period_start(value, interval):
+    """
+    Start of the month or week (monday) containing value, in TIME_ZONE.
+    :param value: aware datetime
+    :param interval: 'month' or 'week'
+    :return: aware datetime
+    """
+
+    tz = pytz.timezone(settings.TIME_ZONE)
+    value = value.astimezone(tz)
+
+    if interval == 'week':
+        day = value.date() - datetime.timedelta(days=value.weekday())
+    else:
+        day = value.date().replace(day=1)
+
+    return tz.localize(datetime.datetime(day.year, day.month, day.day))
+
+
+def next_period(start, interval):
+    tz = pytz.timezone(settings.TIME_ZONE)
+
+    if interval == 'week':
+        day = start.date() + datetime.timedelta(days=7)
+    elif start.month == 12:
+        day = datetime.date(start.year + 1, 1, 1)
+    else:
+        day = datetime.date(start.year, start.month + 1, 1)
+
+    return tz.localize(datetime.datetime(day.year, day.month, day.day))
+
+
+def partition_name(start, interval):
+    if interval == 'week':
+        year, week, weekday = start.isocalendar()
+        return '%s_p%dw%02d' % (TABLE, year, week)
+
+    return '%s_p%d_%02d' % (TABLE, start.year, start.month)
+
+
+def is_partitioned():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [TABLE])
+        row = cursor.fetchone()
+
+    return row is not None and row[0] == 'p'
+
+
+def get_partitions():
+    """
+    Partitions attached to analytics_trackdata
+    :return: dict name -> bound expression
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) '
+            'FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = %s::regclass',
+            [TABLE]
+        )
+        return dict(cursor.fetchall())
+
+
+def convert(now, interval, batch_size=10000, margin=datetime.timedelta(days=1), lock_timeout='5s'):
+    """
+    Turn plain analytics_trackdata into a partitioned table.
+    Rows before the period following `now + margin` stay in the legacy
+    partition. The bound constraint rejects newer rows until the conversion
+    is done, so it must finish within `margin`.
+    Must run outside of a transaction, every step commits on its own.
+    :param now: aware datetime
+    :param interval: 'month' or 'week'
+    :param batch_size: rows per UPDATE of NULL created_at values
+    :param margin: timedelta, minimum time until the legacy partition ends
+    :param lock_timeout: postgres lock_timeout of the statements taking the table lock
+    :return: start of the first managed partition
+    """
+
+    boundary = next_period(period_start(now + margin, interval), interval)
+
+    with connection.cursor() as cursor:
+        # NOT VALID only checks new rows and takes the lock for a moment
+        with _lock_timeout(cursor, lock_timeout):
+            cursor.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s' % (TABLE, BOUND_CONSTRAINT))
+            cursor.execute(
+                'ALTER TABLE %s ADD CONSTRAINT %s CHECK (created_at IS NOT NULL AND created_at < %%s) NOT VALID' % (TABLE, BOUND_CONSTRAINT),
+                [boundary]
+            )
+
+        while True:
+            cursor.execute(BACKFILL_SQL.replace('{table}', TABLE), [batch_size])
+            if cursor.rowcount < batch_size:
+                break
+
+        # scans the table without blocking writes
+        cursor.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (TABLE, BOUND_CONSTRAINT))
+
+        with _lock_timeout(cursor, lock_timeout):
+            cursor.execute(
+                CONVERT_SQL.replace('{table}', TABLE).replace('{legacy}', LEGACY_TABLE)
+                .replace('{default}', DEFAULT_TABLE).replace('{constraint}', BOUND_CONSTRAINT)
+                .replace('{boundary}', boundary.isoformat())
+            )
+
+    return boundary
+
+
+def create_partitions(now, interval, ahead):
+    """
+    Create partitions for the current and `ahead` following periods, and the
+    default partition if it is missing.
+    Periods already covered by the legacy partition are skipped.
+    :return: list of created partition names
+    """
+
+    existing = get_partitions()
+    legacy_bound = existing.get(LEGACY_TABLE)
+
+    created = []
+    if DEFAULT_TABLE not in existing:
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE %s PARTITION OF %s DEFAULT' % (DEFAULT_TABLE, TABLE))
+            cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (id)' % DEFAULT_TABLE)
+        created.append(DEFAULT_TABLE)
+
+    start = period_start(now, interval)
+    for index in range(ahead + 1):
+        end = next_period(start, interval)
+        name = partition_name(start, interval)
+
+        if name not in existing and not (legacy_bound and _covered_by_legacy(legacy_bound, end)):
+            with transaction.atomic(), connection.cursor() as cursor:
+                for sql in CREATE_PARTITION_SQL:
+                    cursor.execute(
+                        sql.replace('{table}', TABLE).replace('{default}', DEFAULT_TABLE).replace('{name}', name),
+                        {'start': start, 'end': end}
+                    )
+            created.append(name)
+
+        start = end
+
+    return created
+
+
+def expired_partitions(now, interval, retention):
+    """
+    Partitions which end before `retention` periods ago, including the
+    legacy partition once its upper bound is before that.
+    :return: list of partition names
+    """
+
+    cutoff = period_start(now, interval)
+    for index in range(retention):
+        cutoff = _previous_period(cutoff, interval)
+
+    expired = []
+    for name, bound in get_partitions().items():
+        if name == LEGACY_TABLE:
+            if _legacy_ends_by(bound, cutoff):
+                expired.append(name)
+            continue
+
+        start = _partition_start(name, interval)
+        if start is not None and next_period(start, interval) <= cutoff:
+            expired.append(name)
+
+    # the legacy partition holds the oldest rows
+    return sorted(expired, key=lambda name: (name != LEGACY_TABLE, name))
+
+
+def detach_partition(name, drop=False):
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (TABLE, name))
+        if drop:
+            cursor.execute('DROP TABLE %s' % name)
+
+
+@contextlib.contextmanager
+def _lock_timeout(cursor, timeout):
+    cursor.execute('SET lock_timeout = %s', [timeout])
+    try:
+        yield
+    finally:
+        cursor.execute('RESET lock_timeout')
+
+
+def _previous_period(start, interval):
+    return period_start(start - datetime.timedelta(days=1), interval)
+
+
+def _partition_start(name, interval):
+    if not name.startswith(TABLE + '_p'):
+        return None
+
+    tz = pytz.timezone(settings.TIME_ZONE)
+    suffix = name[len(TABLE) + 2:]
+
+    try:
+        if interval == 'week':
+            day = datetime.datetime.strptime(suffix + '-1', '%Gw%V-%u')
+        else:
+            day = datetime.datetime.strptime(suffix, '%Y_%m')
+    except ValueError:
+        return None
+
+    return tz.localize(day)
+
+
+def _legacy_upper(legacy_bound):
+    # FOR VALUES FROM (MINVALUE) TO ('2020-01-01 00:00:00+01')
+    return legacy_bound.rsplit("('", 1)[-1].rstrip("')")
+
+
+def _covered_by_legacy(legacy_bound, end):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT %s::timestamptz >= %s', [_legacy_upper(legacy_bound), end])
+        return cursor.fetchone()[0]
+
+
+def _legacy_ends_by(legacy_bound, cutoff):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT %s::timestamptz <= %s', [_legacy_upper(legacy_bound), cutoff])
+        return cursor.fetchone()[0]
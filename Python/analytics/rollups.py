@@ -0,0 +1,256 @@
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min, Q, Subquery, Sum
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce, Trunc
+from django.utils import timezone
+from django.utils.timezone import utc
+
+from apps.aggregations.models import PopupData, PopupRevenue
+from apps.analytics.models import PopupRollup, RollupState, TrackData
+from apps.core.models import BulkCreateManager
+from apps.core.timeseries import Source, shop_timezone, time_series
+
+STATE_NAME = 'popup'
+
+
+def hour_start(value):
+    # in UTC, local hours are ambiguous when the clocks go back
+    return value.astimezone(utc).replace(minute=0, second=0, microsecond=0)
+
+
+def day_start(value):
+    value = timezone.localtime(value)
+    return timezone.make_aware(datetime.datetime(value.year, value.month, value.day))
+
+
+def next_day(value):
+    value = timezone.localtime(value).date() + datetime.timedelta(days=1)
+    return timezone.make_aware(datetime.datetime(value.year, value.month, value.day))
+
+
+def month_start(value):
+    value = timezone.localtime(value)
+    return timezone.make_aware(datetime.datetime(value.year, value.month, 1))
+
+
+def next_month(value):
+    if value.month == 12:
+        return timezone.make_aware(datetime.datetime(value.year + 1, 1, 1))
+
+    return timezone.make_aware(datetime.datetime(value.year, value.month + 1, 1))
+
+
+def rolled_up_to_expression():
+    """
+    RollupState.rolled_up_to as subquery, -infinity before the first run.
+    Read in the same statement as the rollups, so a concurrent
+    update_popup_rollups can't move it between the two reads.
+    """
+
+    return Coalesce(
+        Subquery(RollupState.objects.filter(name=STATE_NAME).values('rolled_up_to')[:1]),
+        RawSQL("'-infinity'::timestamptz", [])
+    )
+
+
+def update_popup_rollups(now=None, step=datetime.timedelta(days=7), lag=datetime.timedelta(minutes=10)):
+    """
+    Roll up all closed hours since the last run.
+    An hour is closed `lag` after its end, so rows committed late are not skipped.
+    Hourly buckets are built from raw rows, day and month buckets touched by
+    the new range are rebuilt from the hourly buckets. Every step is one
+    transaction together with the state, so the command can be stopped and rerun.
+    :param now: aware datetime, defaults to now
+    :param step: max time range per transaction
+    :param lag: time to wait after the end of an hour
+    :return: new rolled_up_to
+    """
+
+    until = hour_start((now or timezone.now()) - lag)
+
+    state, created = RollupState.objects.get_or_create(name=STATE_NAME)
+    start = state.rolled_up_to
+    if start is None:
+        first = [
+            PopupData.objects.aggregate(first=Min('created_at'))['first'],
+            PopupRevenue.objects.aggregate(first=Min('created_at'))['first'],
+        ]
+        first = [value for value in first if value is not None]
+        if not first:
+            return None
+        start = hour_start(min(first))
+
+    while start < until:
+        end = min(start + step, until)
+
+        with transaction.atomic():
+            RollupState.objects.select_for_update().get(pk=state.pk)
+
+            rollup_hours(start, end)
+            rebuild_buckets('day', day_start(start), next_day(end - datetime.timedelta(microseconds=1)))
+            rebuild_buckets('month', month_start(start), next_month(month_start(end - datetime.timedelta(microseconds=1))))
+
+            RollupState.objects.filter(pk=state.pk).update(rolled_up_to=end)
+
+        start = end
+
+    return until
+
+
+def rollup_hours(start, end):
+    PopupRollup.objects.filter(period='hour', bucket__gte=start, bucket__lt=end).delete()
+
+    manager = BulkCreateManager(chunk_size=5000, copy_models=[PopupRollup])
+
+    data = PopupData.objects.filter(created_at__gte=start, created_at__lt=end) \
+        .annotate(hour=Trunc('created_at', 'hour', tzinfo=utc)) \
+        .values('shop_id', 'type', 'hour') \
+        .annotate(count=Sum('data_count'))
+
+    for row in data:
+        manager.add(PopupRollup(
+            shop_id=row['shop_id'],
+            source=PopupRollup.sources['data'],
+            type=row['type'],
+            period='hour',
+            bucket=row['hour'],
+            count=row['count'] or 0
+        ))
+
+    revenue = PopupRevenue.objects.filter(created_at__gte=start, created_at__lt=end) \
+        .annotate(hour=Trunc('created_at', 'hour', tzinfo=utc)) \
+        .values('shop_id', 'hour') \
+        .annotate(count=Count('id'), amount=Sum('amount'))
+
+    for row in revenue:
+        manager.add(PopupRollup(
+            shop_id=row['shop_id'],
+            source=PopupRollup.sources['revenue'],
+            period='hour',
+            bucket=row['hour'],
+            count=row['count'],
+            amount=row['amount'] or 0
+        ))
+
+    manager.done()
+
+
+def rebuild_buckets(period, start, end):
+    PopupRollup.objects.filter(period=period, bucket__gte=start, bucket__lt=end).delete()
+
+    manager = BulkCreateManager(chunk_size=5000, copy_models=[PopupRollup])
+
+    buckets = PopupRollup.objects.filter(period='hour', bucket__gte=start, bucket__lt=end) \
+        .annotate(period_bucket=Trunc('bucket', period)) \
+        .values('shop_id', 'source', 'type', 'period_bucket') \
+        .annotate(sum_count=Sum('count'), sum_amount=Sum('amount'))
+
+    for row in buckets:
+        manager.add(PopupRollup(
+            shop_id=row['shop_id'],
+            source=row['source'],
+            type=row['type'],
+            period=period,
+            bucket=row['period_bucket'],
+            count=row['sum_count'],
+            amount=row['sum_amount']
+        ))
+
+    manager.done()
+
+
+def rollup_period(group_type, start_date, end_date, tz=None):
+    """
+    Coarsest rollup period which can answer the request exactly.
+    Month buckets are only used when the date range does not cut a month,
+    day and month buckets only for TIME_ZONE, they are built in it.
+    Hour buckets are UTC hours, which don't align with the local days of
+    zones with a non whole hour offset (e.g. Asia/Kolkata), those are
+    answered from the raw rows.
+    :return: PopupRollup period or None if no rollup fits
+    """
+
+    if tz is not None and not _whole_hour_offsets(tz, start_date, end_date):
+        return None
+
+    if group_type == 'hour' or (tz is not None and tz.zone != settings.TIME_ZONE):
+        return 'hour'
+
+    if group_type in ('month', 'year') \
+            and (start_date is None or start_date.day == 1) \
+            and (end_date is None or (end_date + datetime.timedelta(days=1)).day == 1):
+        return 'month'
+
+    return 'day'
+
+
+def _whole_hour_offsets(tz, start_date, end_date):
+    days = [day for day in (start_date, end_date, timezone.now().date()) if day is not None]
+
+    return all(
+        tz.utcoffset(datetime.datetime(day.year, day.month, day.day), is_dst=False).total_seconds() % 3600 == 0
+        for day in days
+    )
+
+
+def popup_aggregates():
+    """
+    Popup series with their aggregates on PopupRollup, PopupData and PopupRevenue
+    :return: dict name -> (rollup aggregate, source, raw aggregate)
+    """
+
+    data_source = Q(source=PopupRollup.sources['data'])
+    revenue_source = Q(source=PopupRollup.sources['revenue'])
+    show = TrackData.types['_show']
+    click = TrackData.types['_click']
+
+    return {
+        'shows': (Sum('count', filter=data_source & Q(type=show)), 'data', Sum('data_count', filter=Q(type=show))),
+        'clicks': (Sum('count', filter=data_source & Q(type=click)), 'data', Sum('data_count', filter=Q(type=click))),
+        'purchases': (Sum('count', filter=revenue_source), 'revenue', Count('id')),
+        'revenue': (Sum('amount', filter=revenue_source), 'revenue', Sum('amount')),
+    }
+
+
+def popup_series(shop_id, names, start_date=None, end_date=None, group_type='month'):
+    """
+    Popup time series from rollups plus the PopupData / PopupRevenue rows newer
+    than the last rollup run, in one statement.
+    Shops in zones with a non whole hour offset are summed from the raw rows.
+    :param shop_id:
+    :param names: series names, 'shows', 'clicks', 'purchases' and / or 'revenue'
+    :param start_date: date or None
+    :param end_date: date or None
+    :param group_type: 'hour', 'day', 'month' or 'year'
+    :return: time_series result {'buckets': [...], 'series': {name: [...]}}
+    """
+
+    tz = shop_timezone(shop_id)
+    period = rollup_period(group_type, start_date, end_date, tz)
+    aggregates = popup_aggregates()
+
+    raw = {
+        'data': PopupData.objects.filter(
+            shop_id=shop_id,
+            type__in=[TrackData.types['_show'], TrackData.types['_click']]
+        ),
+        'revenue': PopupRevenue.objects.filter(shop_id=shop_id),
+    }
+
+    sources = []
+    if period is not None:
+        rolled_up_to = rolled_up_to_expression()
+        rollups = PopupRollup.objects.filter(shop_id=shop_id, period=period, bucket__lt=rolled_up_to)
+        raw = {source: queryset.filter(created_at__gte=rolled_up_to) for source, queryset in raw.items()}
+
+        sources.append(Source(rollups, 'bucket', **{name: aggregates[name][0] for name in names}))
+
+    for source in ('data', 'revenue'):
+        source_aggregates = {name: aggregates[name][2] for name in names if aggregates[name][1] == source}
+        if source_aggregates:
+            sources.append(Source(raw[source], 'created_at', **source_aggregates))
+
+    return time_series(sources, group_type, start_date, end_date, tz)
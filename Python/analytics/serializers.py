@@ -1,6 +1,8 @@
+from django.utils.dateparse import parse_datetime
 from rest_framework import serializers
 
-from apps.analytics.models import TrackSession
+from apps.analytics.models import TrackSession, TrackData
+from apps.core.pagination import decode_cursor
 
 
 class SessionSerializer(serializers.ModelSerializer):
@@ -54,6 +56,21 @@ class TrackDataSerializer(serializers.Serializer):
 
     data = serializers.JSONField()
 
+    def validate_data(self, value):
+        article_id = value.get('articleID') if isinstance(value, dict) else None
+        if article_id is not None and len(str(article_id)) > TrackData._meta.get_field('article_id').max_length:
+            raise serializers.ValidationError('articleID is too long.')
+
+        return value
+
+
+class TrackDataBatchItemSerializer(TrackDataSerializer):
+    # client side event time in milliseconds, used for view_time / duration of batched events
+    timestamp = serializers.IntegerField(
+        required=False,
+        min_value=0
+    )
+
 
 class MergeCustomersSerializer(serializers.Serializer):
     master_id = serializers.IntegerField(
@@ -176,6 +193,41 @@ class BasketPopupSerializer(serializers.Serializer):
     )
 
 
+class PopupSerializer(serializers.Serializer):
+    types = [
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+        ('month', 'Month'),
+        ('year', 'Year')
+    ]
+
+    shop_id = serializers.IntegerField(
+        required=True,
+        min_value=1
+    )
+
+    start_date = serializers.DateField(
+        required=False,
+        allow_null=True
+    )
+
+    end_date = serializers.DateField(
+        required=False,
+        allow_null=True
+    )
+
+    group_type = serializers.ChoiceField(
+        choices=types,
+        required=False,
+        allow_null=True
+    )
+
+    # {'buckets': [...], 'series': {...}} instead of a list of rows per series
+    columnar = serializers.BooleanField(
+        default=False
+    )
+
+
 class SessionProductsAnalyzeSerializer(serializers.Serializer):
     customer_id = serializers.IntegerField(
         required=True,
@@ -204,6 +256,48 @@ class AnalyticDataByTypeSerializer(serializers.Serializer):
         min_value=0
     )
 
+    # stream all rows after `cursor` as NDJSON
+    stream = serializers.BooleanField(
+        required=False,
+        default=False
+    )
+
+    # return one page of `limit` rows after `cursor` with next_cursor
+    limit = serializers.IntegerField(
+        required=False,
+        min_value=1,
+        max_value=10000
+    )
+
+    cursor = serializers.CharField(
+        required=False,
+        allow_null=True,
+        allow_blank=True
+    )
+
+    def validate_cursor(self, value):
+        if not value:
+            return None
+
+        try:
+            created_at, pk = decode_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError('Invalid cursor')
+
+        if not isinstance(pk, int) or not isinstance(created_at, (str, type(None))):
+            raise serializers.ValidationError('Invalid cursor')
+
+        # rows without created_at have a null position
+        if created_at is not None:
+            try:
+                created_at = parse_datetime(created_at)
+            except ValueError:
+                created_at = None
+            if created_at is None:
+                raise serializers.ValidationError('Invalid cursor')
+
+        return created_at, pk
+
 
 class VouchersSerializer(serializers.Serializer):
     types = [
@@ -0,0 +1,425 @@
+import datetime
+import io
+import json
+import time
+import uuid
+from unittest import mock
+
+from django.core import serializers
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import utc
+from rest_framework.test import APIRequestFactory
+
+from apps.aggregations.models import PopupData
+from apps.analytics.cache import LatestActionCache, get_session_cache
+from apps.analytics.ingest import store_events
+from apps.analytics.management.commands.backfill_track_columns import Command as BackfillTrackColumns
+from apps.analytics.latest_actions import get_latest_action, query_latest_action
+from apps.analytics.models import PopupRollup, TrackSession, TrackData
+from apps.analytics.rollups import hour_start, popup_series, update_popup_rollups
+from apps.analytics.views import GetAnalyticDataByType, MergeCustomers, PopUpClicks
+from apps.core.cache import DjangoCache, latest_action_cache_stats
+from apps.core.chunked import ChunkedCommand
+from apps.core.models import BulkCreateManager, CommandCheckpoint
+from apps.core.utils import model_to_dict
+
+
+class BulkCreateManagerOrderTests(TestCase):
+
+    def test_sessions_are_written_before_track_data(self):
+        session = TrackSession(shop_id=1, customer_id=1, session_id='session')
+        items = [
+            TrackData(session=session, uuid=uuid.uuid4().hex, type=TrackData.types['product'], data={})
+            for index in range(3)
+        ]
+
+        with BulkCreateManager() as manager:
+            # queued first, flushed last
+            for item in items:
+                manager.add(item)
+            manager.upsert(session, ['updated_at'])
+
+        self.assertIsNotNone(session.pk)
+        self.assertEqual(TrackData.objects.filter(session_id=session.pk).count(), 3)
+
+    def test_auto_flush_writes_queued_sessions_first(self):
+        session = TrackSession(shop_id=1, customer_id=1, session_id='session')
+
+        manager = BulkCreateManager(chunk_size=3)
+        manager.upsert(session, ['updated_at'])
+        for index in range(3):
+            manager.add(TrackData(session=session, uuid=uuid.uuid4().hex, type=TrackData.types['product'], data={}))
+
+        # the third TrackData filled the chunk
+        self.assertIsNotNone(session.pk)
+        self.assertEqual(TrackData.objects.filter(session_id=session.pk).count(), 3)
+        manager.done()
+
+
+@override_settings(TIME_ZONE='Europe/Berlin')
+class RollupDaylightSavingTests(TestCase):
+    # 02:00 - 03:00 Europe/Berlin happens twice on 2026-10-25
+    first = datetime.datetime(2026, 10, 25, 0, 30, tzinfo=utc)
+    second = datetime.datetime(2026, 10, 25, 1, 30, tzinfo=utc)
+
+    def test_hour_start_of_repeated_hour(self):
+        self.assertEqual(hour_start(self.first), datetime.datetime(2026, 10, 25, 0, 0, tzinfo=utc))
+        self.assertEqual(hour_start(self.second), datetime.datetime(2026, 10, 25, 1, 0, tzinfo=utc))
+
+    def test_rollup_of_repeated_hour(self):
+        for created_at in (self.first, self.second):
+            popup = PopupData.objects.create(shop_id=1, type=1, data_count=2)
+            PopupData.objects.filter(pk=popup.pk).update(created_at=created_at)
+
+        rolled_up_to = update_popup_rollups(now=datetime.datetime(2026, 10, 25, 2, 5, tzinfo=utc))
+
+        # the hour ending 5 minutes ago is held back by the lag
+        self.assertEqual(rolled_up_to, datetime.datetime(2026, 10, 25, 1, 0, tzinfo=utc))
+        self.assertEqual(
+            list(PopupRollup.objects.filter(period='hour').order_by('bucket').values_list('bucket', 'count')),
+            [(datetime.datetime(2026, 10, 25, 0, 0, tzinfo=utc), 2)]
+        )
+
+        rolled_up_to = update_popup_rollups(now=datetime.datetime(2026, 10, 25, 3, 0, tzinfo=utc))
+
+        self.assertEqual(rolled_up_to, datetime.datetime(2026, 10, 25, 2, 0, tzinfo=utc))
+        self.assertEqual(
+            list(PopupRollup.objects.filter(period='hour').order_by('bucket').values_list('bucket', 'count')),
+            [
+                (datetime.datetime(2026, 10, 25, 0, 0, tzinfo=utc), 2),
+                (datetime.datetime(2026, 10, 25, 1, 0, tzinfo=utc), 2),
+            ]
+        )
+        self.assertEqual(PopupRollup.objects.get(period='day').count, 4)
+
+
+@override_settings(TIME_ZONE='Europe/Berlin', SHOP_TIME_ZONES={2: 'Asia/Kolkata'})
+class PopupSeriesTests(TestCase):
+
+    def setUp(self):
+        # popup event types which the type map of this tree does not list
+        missing = dict(
+            (name, 110 + index) for index, name in enumerate(['_show', '_click']) if name not in TrackData.types
+        )
+        patcher = mock.patch.dict(TrackData.types, missing)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def click(self, shop_id, created_at):
+        popup = PopupData.objects.create(shop_id=shop_id, type=TrackData.types['_click'], data_count=1)
+        PopupData.objects.filter(pk=popup.pk).update(created_at=created_at)
+
+    def test_rolled_up_and_newer_rows_are_counted_once(self):
+        for hour in (10, 11, 12):
+            self.click(1, datetime.datetime(2026, 3, 10, hour, 30, tzinfo=utc))
+
+        update_popup_rollups(now=datetime.datetime(2026, 3, 10, 12, 15, tzinfo=utc))
+
+        result = popup_series(1, ['clicks'], datetime.date(2026, 3, 10), datetime.date(2026, 3, 10), 'day')
+        self.assertEqual(result['series']['clicks'], [3])
+
+    def test_days_of_half_hour_zones_are_not_shifted(self):
+        # 23:45 on the 10th and 00:15 on the 11th in Asia/Kolkata, both in the 18:00 UTC hour
+        self.click(2, datetime.datetime(2026, 3, 10, 18, 15, tzinfo=utc))
+        self.click(2, datetime.datetime(2026, 3, 10, 18, 45, tzinfo=utc))
+
+        update_popup_rollups(now=datetime.datetime(2026, 3, 12, tzinfo=utc))
+
+        result = popup_series(2, ['clicks'], datetime.date(2026, 3, 10), datetime.date(2026, 3, 11), 'day')
+        self.assertEqual(result['series']['clicks'], [1, 1])
+
+
+def track_event(received_at, **kwargs):
+    event = {
+        'customer_id': 1,
+        'shop_id': 1,
+        'session_id': 'session',
+        'uuid': uuid.uuid4().hex,
+        'url': None,
+        'type': TrackData.types['product'],
+        'data': {'articleID': '1'},
+        'received_at': received_at,
+    }
+    event.update(kwargs)
+
+    return event
+
+
+class IngestTestMixin(object):
+
+    def setUp(self):
+        # ingest and merges check for event types which the type map of this tree does not list
+        missing = dict(
+            (name, 100 + index) for index, name in enumerate(['register', 'sign', 'first_viewed_page'])
+            if name not in TrackData.types
+        )
+        patcher = mock.patch.dict(TrackData.types, missing)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # session ids cached by other tests point to rolled back rows
+        session_cache = get_session_cache()
+        if session_cache is not None:
+            session_cache.cache.clear()
+
+
+class StoreEventsTests(IngestTestMixin, TestCase):
+
+    def test_track_data_in_input_order(self):
+        now = time.time()
+        events = [track_event(now - 10), track_event(now - 30), track_event(now - 20, session_id='other')]
+
+        track_data = store_events(events)
+
+        self.assertEqual([item.uuid for item in track_data], [event['uuid'] for event in events])
+        self.assertTrue(all(item.pk for item in track_data))
+        self.assertEqual(
+            [TrackData.objects.get(pk=item.pk).uuid for item in track_data],
+            [event['uuid'] for event in events]
+        )
+
+    def test_view_time_of_older_batch_is_not_negative(self):
+        now = time.time()
+        first = store_events([track_event(now)])[0]
+
+        store_events([track_event(now - 60)])
+
+        self.assertEqual(TrackData.objects.get(pk=first.pk).view_time, 0)
+
+
+@override_settings(RESPONSE_CACHE={'ALIAS': 'default'})
+class ResponseCacheTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def post(self, data):
+        request = APIRequestFactory().post(
+            '/analytics/popup-clicks/', data, format='json',
+            HTTP_AUTHORIZATION='9944b09199c62bcf9418ad846dd0e4bbdfc6ee4b'
+        )
+
+        return PopUpClicks.as_view()(request)
+
+    def test_second_request_is_served_from_cache(self):
+        data = {'shop_id': 1, 'start_date': '2026-01-01', 'end_date': '2026-01-31', 'group_type': 'day'}
+
+        first = self.post(data)
+        with self.assertNumQueries(0):
+            second = self.post(data)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.data, first.data)
+
+    def test_permissions_are_checked_before_the_cache(self):
+        data = {'shop_id': 1, 'start_date': '2026-01-01', 'end_date': '2026-01-31'}
+        self.post(data)
+
+        request = APIRequestFactory().post('/analytics/popup-clicks/', data, format='json')
+
+        self.assertIn(PopUpClicks.as_view()(request).status_code, (401, 403))
+
+
+class MergeCustomersTests(IngestTestMixin, TestCase):
+
+    def test_master_session_gets_the_moved_products_and_last_action(self):
+        now = time.time()
+        store_events([track_event(now - 60, session_id='1', data={'articleID': '1'})])
+        store_events([track_event(now - 30, session_id='2', data={'articleID': '2'})])
+        moved = TrackData.objects.get(session__session_id='2')
+        master_pk = TrackSession.objects.get(session_id='1').pk
+
+        request = APIRequestFactory().post('/analytics/merge-customers/', {'master_id': 1, 'slave_id': 2}, format='json')
+        response = MergeCustomers.as_view()(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(TrackSession.objects.filter(session_id='2').exists())
+
+        master = TrackSession.objects.get(pk=master_pk)
+        self.assertEqual(master.last_action_id, moved.pk)
+        self.assertEqual(master.last_product_at, moved.created_at)
+        self.assertEqual(master.top_products['latest'][0]['article_id'], '2')
+        self.assertEqual(query_latest_action(1, 1, [TrackData.types['product']])['articleID'], '2')
+
+
+class LatestActionWriteThroughTests(IngestTestMixin, TransactionTestCase):
+    # entries are written after commit
+
+    def setUp(self):
+        super().setUp()
+
+        self.cache = LatestActionCache(DjangoCache())
+        self.cache.cache.clear()
+        patcher = mock.patch('apps.analytics.latest_actions.get_latest_action_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hits(self):
+        return latest_action_cache_stats.snapshot().get('latest_action', {}).get('hit', 0)
+
+    def test_reads_between_ingest_batches_are_hits(self):
+        now = time.time()
+        product = TrackData.types['product']
+        store_events([track_event(now - 60)])
+        get_latest_action(1, 1, [product])
+
+        hits = self.hits()
+        for index in range(5):
+            store_events([track_event(now - 50 + index, data={'articleID': str(index + 2)})])
+            with self.assertNumQueries(0):
+                data = get_latest_action(1, 1, [product])
+            self.assertEqual(data['articleID'], str(index + 2))
+
+        self.assertEqual(self.hits() - hits, 5)
+
+    def test_view_time_of_the_previous_action_is_written_through(self):
+        now = time.time()
+        store_events([track_event(now - 60, session_id='first')])
+        get_latest_action(1, 1, [TrackData.types['product']])
+
+        store_events([track_event(now - 30, session_id='first', type=TrackData.types['category'])])
+
+        with self.assertNumQueries(0):
+            data = get_latest_action(1, 1, [TrackData.types['product']])
+        self.assertEqual(data['view_time'], 30)
+
+    def test_new_session_reloads_the_entry(self):
+        now = time.time()
+        store_events([track_event(now - 60, session_id='first')])
+        get_latest_action(1, 1, [TrackData.types['product']])
+
+        store_events([track_event(now - 30, session_id='second', data={'articleID': '2'})])
+
+        self.assertEqual(get_latest_action(1, 1, [TrackData.types['product']])['articleID'], '2')
+        self.assertEqual(get_latest_action(1, 1, [TrackData.types['product']], 'second')['articleID'], '1')
+
+
+class BackfillTrackColumnsTests(TestCase):
+
+    def test_columns_match_typed_fields(self):
+        session = TrackSession.objects.create(shop_id=1, customer_id=1, session_id='session')
+        values = [
+            {'articleID': '1', 'view_time': 30},
+            {'articleID': 42, 'duration': '7'},
+            {'articleID': 'x' * 255},
+            {'articleID': 'x' * 256, 'view_time': -1},
+            {'articleID': '', 'view_time': 'slow'},
+        ]
+        items = TrackData.objects.bulk_create([
+            TrackData(session=session, uuid=uuid.uuid4().hex, type=TrackData.types['product'], data=data)
+            for data in values
+        ])
+
+        BackfillTrackColumns().process_chunk(None, min(item.pk for item in items), max(item.pk for item in items) + 1)
+
+        for item, data in zip(items, values):
+            self.assertEqual(
+                TrackData.objects.filter(pk=item.pk).values('article_id', 'view_time', 'duration')[0],
+                TrackData.typed_fields(data)
+            )
+
+
+class GetAnalyticDataByTypeTests(TestCase):
+
+    def setUp(self):
+        session = TrackSession.objects.create(shop_id=1, customer_id=1, session_id='session')
+        self.items = TrackData.objects.bulk_create([
+            TrackData(session=session, uuid=uuid.uuid4().hex, type=TrackData.types['product'], data={'index': index})
+            for index in range(5)
+        ])
+        # rows from before created_at was set
+        TrackData.objects.filter(pk__in=[self.items[1].pk, self.items[3].pk]).update(created_at=None)
+
+    def post(self, data):
+        data = dict(data, shop_id=1, type=TrackData.types['product'])
+        request = APIRequestFactory().post('/analytics/get-analytic-data-by-type/', data, format='json')
+
+        return GetAnalyticDataByType.as_view()(request)
+
+    def test_pages_include_rows_without_created_at(self):
+        indexes = []
+        cursor = None
+        while True:
+            response = self.post({'limit': 2, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            indexes.extend(row['data']['index'] for row in response.data['results'])
+
+            cursor = response.data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(indexes, [0, 2, 4, 1, 3])
+
+    def test_stream_includes_rows_without_created_at(self):
+        response = self.post({'stream': True})
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['data']['index'] for line in lines], [0, 2, 4, 1, 3])
+
+
+class CountSessions(ChunkedCommand):
+    model = TrackSession
+
+    def __init__(self, fail_at=None, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_at = fail_at
+        self.seen = []
+
+    def process_chunk(self, queryset, start, end):
+        if self.fail_at is not None and start >= self.fail_at:
+            raise RuntimeError('interrupted')
+
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+        self.seen.extend(pks)
+        return len(pks)
+
+
+class ChunkedCommandTests(TestCase):
+
+    def setUp(self):
+        self.pks = [
+            TrackSession.objects.create(shop_id=1, customer_id=1, session_id='session-%d' % index).pk
+            for index in range(5)
+        ]
+
+    def run_command(self, command, **options):
+        call_command(command, chunk_size=2, checkpoint='count-sessions', stdout=io.StringIO(), **options)
+
+        return command.seen
+
+    def test_every_row_is_processed_once(self):
+        self.assertEqual(self.run_command(CountSessions()), self.pks)
+
+        checkpoint = CommandCheckpoint.objects.get(name='count-sessions')
+        self.assertTrue(checkpoint.done)
+        self.assertEqual(checkpoint.next_id, self.pks[0] + 6)
+
+    def test_interrupted_run_continues_after_the_last_chunk(self):
+        with self.assertRaises(RuntimeError):
+            self.run_command(CountSessions(fail_at=self.pks[0] + 2))
+
+        self.assertEqual(CommandCheckpoint.objects.get(name='count-sessions').next_id, self.pks[0] + 2)
+        self.assertEqual(self.run_command(CountSessions()), self.pks[2:])
+
+    def test_done_run_needs_restart(self):
+        self.run_command(CountSessions())
+
+        self.assertEqual(self.run_command(CountSessions()), [])
+        self.assertEqual(self.run_command(CountSessions(), restart=True), self.pks)
+
+
+class TrackDataToDictTests(TestCase):
+
+    def test_foreign_key_and_json_data(self):
+        session = TrackSession.objects.create(shop_id=1, customer_id=1, session_id='session')
+        item = TrackData.objects.create(
+            session=session, uuid=uuid.uuid4().hex, type=TrackData.types['product'],
+            data={'articleID': '1', 'nested': {'values': [1, 2.5, None]}}, article_id='1'
+        )
+
+        serialized = json.loads(serializers.serialize('json', [item, ]))[0]
+
+        self.assertEqual(model_to_dict(item), dict(serialized['fields'], id=serialized['pk']))
+        self.assertEqual(model_to_dict(item)['session'], session.pk)
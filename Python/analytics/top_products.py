@@ -0,0 +1,134 @@
+"""
+Per session top products for LastSessionMostPopular.
+
+TrackSession.top_products holds the TOP_PRODUCTS products of the session with
+the highest view_time and the TOP_PRODUCTS latest viewed products, each list
+with distinct articles:
+
+    {'top': [{'id', 'article_id', 'view_time', 'data'}],
+     'latest': [{'id', 'article_id', 'created_at', 'data'}]}
+
+Both are merged incrementally by track-data ingest. Keeping more than one
+article per list answers requests with `exclude_id` as well.
+"""
+from django.db import transaction
+
+from apps.analytics.models import TrackSession, TrackData
+
+TOP_PRODUCTS = 3
+
+# sessions fetched at once when looking for the latest session with a product other than exclude_id
+SESSION_SCAN = 10
+
+
+def product_row(item):
+    """
+    :param item: TrackData or dict with id, session_id, created_at, data, article_id and view_time
+    :return: dict used by merge_top_products
+    """
+
+    if isinstance(item, TrackData):
+        item = {
+            'id': item.pk,
+            'session_id': item.session_id,
+            'created_at': item.created_at,
+            'data': item.data,
+            'article_id': item.article_id,
+            'view_time': item.view_time,
+        }
+
+    return {
+        'id': item['id'],
+        'session_id': item['session_id'],
+        'article_id': item['article_id'],
+        'view_time': item['view_time'],
+        'created_at': item['created_at'],
+        'timestamp': item['created_at'].timestamp() if item['created_at'] else 0,
+        'data': item['data'] or {},
+    }
+
+
+def merge_top_products(top_products, rows, size=TOP_PRODUCTS):
+    """
+    :param top_products: TrackSession.top_products or None
+    :param rows: product_row dicts of one session
+    :param size: max length of the lists
+    :return: merged top_products
+    """
+
+    top = {entry['article_id']: entry for entry in (top_products or {}).get('top', [])}
+    latest = {entry['article_id']: entry for entry in (top_products or {}).get('latest', [])}
+
+    for row in rows:
+        if row['view_time'] is not None:
+            current = top.get(row['article_id'])
+            if current is None or current['id'] == row['id'] or current['view_time'] < row['view_time']:
+                top[row['article_id']] = {
+                    'id': row['id'],
+                    'article_id': row['article_id'],
+                    'view_time': row['view_time'],
+                    'data': row['data'],
+                }
+
+        current = latest.get(row['article_id'])
+        if current is None or current['id'] == row['id'] or current['created_at'] <= row['timestamp']:
+            latest[row['article_id']] = {
+                'id': row['id'],
+                'article_id': row['article_id'],
+                'created_at': row['timestamp'],
+                'data': row['data'],
+            }
+
+    return {
+        'top': sorted(top.values(), key=lambda entry: (-entry['view_time'], -entry['id']))[:size],
+        'latest': sorted(latest.values(), key=lambda entry: (-entry['created_at'], -entry['id']))[:size],
+    }
+
+
+def update_top_products(rows):
+    """
+    Merge product rows into their sessions. Sessions are locked while merging,
+    so concurrent ingest workers don't overwrite each other.
+    :param rows: list of product_row dicts
+    :return: None
+    """
+
+    if not rows:
+        return
+
+    by_session = {}
+    for row in rows:
+        by_session.setdefault(row['session_id'], []).append(row)
+
+    with transaction.atomic():
+        sessions = list(
+            TrackSession.objects.select_for_update().filter(pk__in=by_session).order_by('pk')
+            .only('pk', 'top_products', 'last_product_at')
+        )
+
+        for session in sessions:
+            session_rows = by_session[session.pk]
+            session.top_products = merge_top_products(session.top_products, session_rows)
+
+            last_row = max(session_rows, key=lambda row: row['timestamp'])
+            if last_row['created_at'] and (session.last_product_at is None or session.last_product_at < last_row['created_at']):
+                session.last_product_at = last_row['created_at']
+
+        TrackSession.objects.bulk_update(sessions, ['top_products', 'last_product_at'])
+
+
+def most_popular(top_products, exclude_id=None):
+    """
+    Data of the product with the highest view_time, the latest product if no
+    product has a view_time yet.
+    :return: TrackData.data or None if the session has no product other than exclude_id
+    """
+
+    exclude_id = str(exclude_id) if exclude_id else None
+
+    for key in ('top', 'latest'):
+        for entry in (top_products or {}).get(key, []):
+            if exclude_id is None or entry['article_id'] != exclude_id:
+                return entry['data']
+
+    return None
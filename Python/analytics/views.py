@@ -1,83 +1,108 @@
+import json
 import time
+from collections import OrderedDict
 
-from django.contrib.postgres.fields.jsonb import KeyTextTransform
-from django.db.models import Count, DateField, Avg, IntegerField, Q, Sum
-from django.db.models.functions import Trunc, Cast, TruncTime, TruncDate
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Avg, DateTimeField, F, OuterRef, Subquery, Sum, Value, Window
+from django.db.models.functions import Trunc
+from django.http import StreamingHttpResponse
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from apps.aggregations.models import RegisteredCustomers, PopupData, PopupRevenue, VoucherViews, VoucherOrders, TransactionItems, RecommendationData, RecommendationRevenue
-from apps.analytics.models import TrackSession, TrackData
-from apps.analytics.serializers import TrackDataSerializer, LastActionByTypeSerializer, AutocompleteRegisteredUsersSerializer, SessionProductsAnalyzeSerializer, AnalyticDataByTypeSerializer, VouchersSerializer, MergeCustomersSerializer, UserVouchersSerializer, LastSessionMostPopularSerializer, UserVouchersTimeSerializer, PopupSerializer, RecommendationSerializer
+from apps.aggregations.models import RegisteredCustomers, PopupRevenue, VoucherViews, VoucherOrders, TransactionItems, RecommendationData, RecommendationRevenue
+from apps.analytics.catalog import normalize_title
+from apps.analytics.ingest import store_events, get_ingest_buffer, invalidate_sessions, move_track_data
+from apps.analytics.latest_actions import get_latest_action, invalidate_latest_actions
+from apps.analytics.models import ArticleTitle, TrackSession, TrackData
+from apps.analytics.rollups import popup_series
+from apps.analytics.serializers import TrackDataSerializer, TrackDataBatchItemSerializer, LastActionByTypeSerializer, AutocompleteRegisteredUsersSerializer, SessionProductsAnalyzeSerializer, AnalyticDataByTypeSerializer, VouchersSerializer, MergeCustomersSerializer, UserVouchersSerializer, LastSessionMostPopularSerializer, UserVouchersTimeSerializer, PopupSerializer, RecommendationSerializer
+from apps.analytics.top_products import SESSION_SCAN, most_popular
+from apps.core.cache import ResponseCacheMixin
+from apps.core.db.routers import ReplicaReadMixin
+from apps.core.models import BulkCreateManager
+from apps.core.pagination import encode_cursor, keyset_filter
+from apps.core.permissions import IsTokenAuthenticated
+from apps.core.timeseries import filter_range, shop_timezone, to_rows
+from apps.core.parsers import GzipJSONParser
 
 
 class TrackAnalyticData(APIView):
     # permission_classes = [IsAuthenticated, ]
     serializer_class = TrackDataSerializer
 
+    # None means ANALYTICS_INGEST['BUFFERED'] / process wide buffer
+    buffered = None
+    buffer = None
+
     def get_serializer(self):
         return self.serializer_class()
 
+    def is_buffered(self):
+        if self.buffered is not None:
+            return self.buffered
+
+        return getattr(settings, 'ANALYTICS_INGEST', {}).get('BUFFERED', False)
+
+    def get_buffer(self):
+        return self.buffer or get_ingest_buffer()
+
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
-            session, created = TrackSession.objects.update_or_create(
-                shop_id=serializer.data['shop_id'],
-                customer_id=serializer.data['customer_id'],
-                session_id=serializer.data['session_id'],
-            )
+            if self.is_buffered():
+                self.get_buffer().add(serializer.data)
+                return Response({'success': True, 'queued': True}, status=status.HTTP_202_ACCEPTED)
 
-            if serializer.data['type'] == TrackData.types['register']:
-                last_action = TrackData.objects.filter(
-                    session__session_id=serializer.data['session_id'],
-                    type=TrackData.types['sign']
-                ).order_by('-created_at').values('created_at').first()
-                seconds_diff = round(time.time() - last_action['created_at'].timestamp())
-                serializer.data['data'].update({'duration': seconds_diff})
-
-            # track time customer spent on product
-            get_types = {
-                'other': 0,
-                'product': 1,
-                'category': 2,
-            }
-
-            compare_types = {
-                'other': 0,
-                'product': 1,
-                'category': 2,
-            }
-
-            # Turn list of values into list of Q objects
-            queries = [Q(type=type_id) for get_type, type_id in get_types.items()]
-            query = queries.pop()
-            for item in queries:
-                query |= item
-
-            if serializer.data['type'] in compare_types.values():
-                last_action = TrackData.objects.filter(
-                    session__session_id=serializer.data['session_id']
-                ).filter(query).order_by('-created_at').first()
-
-                if last_action and 'view_time' not in last_action.data:
-                    seconds_diff = round(time.time() - last_action.created_at.timestamp())
-                    last_action.data.update({'view_time': seconds_diff})
-                    last_action.save()
-
-            track_data = TrackData.objects.create(
-                session=session,
-                url=serializer.data['url'],
-                uuid=serializer.data['uuid'],
-                type=serializer.data['type'],
-                data=serializer.data['data']
-            )
+            event = dict(serializer.data, received_at=time.time())
+            track_data = store_events([event])[0]
 
             return Response({'success': True, 'track_id': track_data.pk}, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class TrackAnalyticDataBatch(TrackAnalyticData):
+    """
+    Track list of events with one request, body may be gzip compressed.
+    """
+    serializer_class = TrackDataBatchItemSerializer
+    parser_classes = [GzipJSONParser, ]
+
+    def post(self, request):
+        max_events = getattr(settings, 'ANALYTICS_INGEST', {}).get('BATCH_MAX_EVENTS', 500)
+        if not isinstance(request.data, list) or len(request.data) > max_events:
+            return Response(
+                {'non_field_errors': ['Expected a list of at most %d events.' % max_events]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        serializer = self.serializer_class(data=request.data, many=True)
+        if serializer.is_valid():
+            now = time.time()
+            # client clocks are not trusted further back than MAX_EVENT_AGE
+            oldest = now - getattr(settings, 'ANALYTICS_INGEST', {}).get('MAX_EVENT_AGE', 60 * 60)
+            events = []
+            for item in serializer.data:
+                event = dict(item, received_at=now)
+                if item.get('timestamp') is not None:
+                    event['received_at'] = max(min(item['timestamp'] / 1000, now), oldest)
+                events.append(event)
+
+            if self.is_buffered():
+                buffer = self.get_buffer()
+                for event in events:
+                    buffer.add(event)
+                return Response({'success': True, 'queued': len(events)}, status=status.HTTP_202_ACCEPTED)
+
+            track_data = store_events(events)
+
+            return Response({'success': True, 'track_ids': [item.pk for item in track_data]}, status=status.HTTP_200_OK)
+
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class MergeCustomers(APIView):
     # permission_classes = [IsAuthenticated, ]
     serializer_class = MergeCustomersSerializer
@@ -93,12 +118,39 @@ class MergeCustomers(APIView):
                 type=TrackData.types['first_viewed_page']
             ).delete()
 
-            TrackSession.objects.filter(
+            master_id = str(serializer.data['master_id'])
+            slave_sessions = list(TrackSession.objects.filter(
                 session_id=serializer.data['slave_id']
-            ).update(
-                session_id=serializer.data['master_id']
+            ).only('pk', 'shop_id', 'customer_id'))
+
+            # cached ids of renamed slave sessions and their master keys are stale
+            customers = [(session.shop_id, session.customer_id) for session in slave_sessions]
+
+            masters = dict(
+                ((shop_id, customer_id), pk)
+                for pk, shop_id, customer_id in TrackSession.objects.filter(
+                    session_id=master_id,
+                    customer_id__in=set(customer_id for shop_id, customer_id in customers)
+                ).values_list('pk', 'shop_id', 'customer_id')
             )
 
+            with transaction.atomic(), BulkCreateManager(chunk_size=500) as manager:
+                for session in slave_sessions:
+                    master = masters.get((session.shop_id, session.customer_id))
+                    if master is None:
+                        session.session_id = master_id
+                        manager.update(session, ['session_id'])
+                    else:
+                        # renaming would violate unique_together, move the actions instead
+                        move_track_data(session.pk, master)
+                        session.delete()
+
+            invalidate_sessions(
+                [(shop_id, customer_id, str(serializer.data['slave_id'])) for shop_id, customer_id in customers] +
+                [(shop_id, customer_id, str(serializer.data['master_id'])) for shop_id, customer_id in customers]
+            )
+            invalidate_latest_actions(customers)
+
             return Response({'success': True}, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -115,45 +167,54 @@ class LastActionByType(APIView):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
 
-            last_session = TrackSession.objects.filter(
-                shop_id=serializer.data['shop_id'],
-                customer_id=serializer.data['customer_id']
+            types = [serializer.data['type']]
+            if serializer.data.get('alt_type', None):
+                types.append(serializer.data['alt_type'])
+
+            data = get_latest_action(
+                serializer.data['shop_id'],
+                serializer.data['customer_id'],
+                types,
+                exclude_session_id=serializer.data.get('session_id', None)
             )
 
-            if serializer.data.get('session_id', None):
-                last_session = last_session.exclude(
-                    session_id=serializer.data['session_id']
-                )
+            if data is None:
+                return Response({}, status=status.HTTP_200_OK)
 
-            last_session = last_session.order_by('-created_at').first()
+            return Response(data, status=status.HTTP_200_OK)
 
-            if last_session is None:
-                return Response({}, status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            analytic_query = TrackData.objects.filter(
-                session=last_session
-            )
 
-            if serializer.data.get('alt_type', None):
-                analytic_query = analytic_query.filter(
-                    Q(type=serializer.data['type']) | Q(type=serializer.data['alt_type'])
-                )
-            else:
-                analytic_query = analytic_query.filter(
-                    type=serializer.data['type']
-                )
+def last_session_most_popular(data):
+    """
+    LastSessionMostPopular from TrackData, for customers with many sessions
+    which only contain the excluded product.
+    :param data: LastSessionMostPopularSerializer data
+    :return: TrackData.data or {}
+    """
 
-            analytic = analytic_query.values('data').order_by('-created_at').first()
+    last_product = TrackData.objects.filter(
+        session__shop_id=data['shop_id'],
+        session__customer_id=data['customer_id'],
+        type=TrackData.types['product']
+    )
 
-            if analytic is None:
-                return Response({}, status=status.HTTP_200_OK)
+    if data.get('session_id', None):
+        last_product = last_product.exclude(session__session_id=data['session_id'])
 
-            return Response(analytic['data'], status=status.HTTP_200_OK)
+    if data.get('exclude_id', None):
+        last_product = last_product.exclude(article_id=data['exclude_id'])
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    last_product = last_product.select_related('session').order_by('-created_at').first()
+
+    if last_product is None:
+        return {}
+
+    return most_popular(last_product.session.top_products, data.get('exclude_id', None)) or {}
 
 
-class LastSessionMostPopular(APIView):
+class LastSessionMostPopular(ReplicaReadMixin, APIView):
     # permission_classes = [IsAuthenticated, ]
     serializer_class = LastSessionMostPopularSerializer
 
@@ -164,56 +225,68 @@ class LastSessionMostPopular(APIView):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
 
-            last_product = TrackData.objects.filter(
-                session__shop_id=serializer.data['shop_id'],
-                session__customer_id=serializer.data['customer_id'],
-                type=TrackData.types['product']
+            sessions = TrackSession.objects.filter(
+                shop_id=serializer.data['shop_id'],
+                customer_id=serializer.data['customer_id'],
+                last_product_at__isnull=False
             )
 
             if serializer.data.get('session_id', None):
-                last_product = last_product.exclude(
-                    session__session_id=serializer.data['session_id']
+                sessions = sessions.exclude(
+                    session_id=serializer.data['session_id']
                 )
 
-            if serializer.data.get('exclude_id', None):
-                last_product = last_product.exclude(
-                    data__articleID=serializer.data['exclude_id']
-                )
+            sessions = list(sessions.order_by('-last_product_at').values_list('top_products', flat=True)[:SESSION_SCAN])
 
-            last_product = last_product.order_by('-created_at').first()
+            for top_products in sessions:
+                data = most_popular(top_products, serializer.data.get('exclude_id', None))
+                if data is not None:
+                    return Response(data, status=status.HTTP_200_OK)
 
-            if last_product is None:
+            if len(sessions) < SESSION_SCAN:
                 return Response({}, status=status.HTTP_200_OK)
 
-            last_session = last_product.session
+            # every scanned session only has the excluded product
+            return Response(last_session_most_popular(serializer.data), status=status.HTTP_200_OK)
 
-            analytic_query = TrackData.objects.filter(
-                session=last_session,
-                type=TrackData.types['product']
-            )
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            if serializer.data.get('exclude_id', None):
-                analytic_query = analytic_query.exclude(
-                    data__articleID=serializer.data['exclude_id']
-                )
 
-            analytic = analytic_query.annotate(view_time=Cast(KeyTextTransform('view_time', 'data'), IntegerField(default=0))) \
-                .filter(view_time__isnull=False) \
-                .values('data').order_by('-view_time').first()
 
-            if analytic is None:
-                analytic = analytic_query.values('data').order_by('-created_at').first()
+def trimmed_avg_duration(queryset, group_type=None, tz=None):
+    """
+    Average duration per with_autofill (and time bucket), without durations
+    above twice the group average, in one statement: the group average is a
+    window function in a subquery, the outer query averages the rest.
+    :param queryset: RegisteredCustomers queryset
+    :param group_type: None, 'hour', 'day', 'month' or 'year'
+    :param tz: time zone of the buckets
+    :return: list of (with_autofill, bucket, avg_time), bucket is None without group_type
+    """
 
-            if analytic is None:
-                return Response({}, status=status.HTTP_200_OK)
+    partition_by = [F('with_autofill')]
+    if group_type:
+        queryset = queryset.annotate(bucket=Trunc('created_at', group_type, tzinfo=tz))
+        partition_by.append(F('bucket'))
+    else:
+        queryset = queryset.annotate(bucket=Value(None, output_field=DateTimeField()))
 
-            return Response(analytic['data'], status=status.HTTP_200_OK)
+    queryset = queryset.annotate(
+        group_avg=Window(expression=Avg('duration'), partition_by=partition_by)
+    ).values('with_autofill', 'bucket', 'duration', 'group_avg')
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    sql, params = queryset.query.sql_with_params()
 
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(
+            'SELECT with_autofill, bucket, AVG(duration) FILTER (WHERE duration <= 2 * group_avg) '
+            'FROM (%s) AS registered GROUP BY with_autofill, bucket ORDER BY bucket' % sql,
+            params
+        )
+        return cursor.fetchall()
 
 
-class AutocompleteRegisteredUsersTimeSpent(APIView):
+class AutocompleteRegisteredUsersTimeSpent(ReplicaReadMixin, ResponseCacheMixin, APIView):
     permission_classes = [IsTokenAuthenticated, ]
     serializer_class = AutocompleteRegisteredUsersSerializer
 
@@ -227,37 +300,58 @@ class AutocompleteRegisteredUsersTimeSpent(APIView):
             registered_users = RegisteredCustomers.objects.filter(
                 shop_id=serializer.data['shop_id'],
                 duration__isnull=False
-            registered_users_with_autofill = registered_users.filter(with_autofill=True)
-            get_avg_with = registered_users_with_autofill \
-                .aggregate(avg_time=Avg('duration'))
-
-            if get_avg_with['avg_time']:
-                registered_users_with_autofill = registered_users_with_autofill.filter(duration__lte=2 * get_avg_with['avg_time'])
+            )
 
-            data_with_autofill = registered_users_with_autofill \
-                .aggregate(avg_time=Avg('duration'))
+            tz = shop_timezone(serializer.data['shop_id'])
+            registered_users = filter_range(
+                registered_users,
+                'created_at',
+                serializer.validated_data.get('start_date'),
+                serializer.validated_data.get('end_date'),
+                tz
+            )
 
-            registered_users_without_autofill = registered_users.filter(with_autofill=False)
-            get_avg_without = registered_users_without_autofill \
-                .aggregate(avg_time=Avg('duration'))
+            group_type = serializer.data.get('group_type')
 
-            if get_avg_without['avg_time']:
-                registered_users_without_autofill = registered_users_without_autofill.filter(duration__lte=2 * get_avg_without['avg_time'])
+            buckets = OrderedDict()
+            for with_autofill, bucket, avg_time in trimmed_avg_duration(registered_users, group_type, tz):
+                key = 'time_with_autofill' if with_autofill else 'time_without_autofill'
+                buckets.setdefault(bucket, {'time_with_autofill': 0, 'time_without_autofill': 0})
+                buckets[bucket][key] = round(avg_time) if avg_time else 0
 
-            data_without_autofill = registered_users_without_autofill \
-                .aggregate(avg_time=Avg('duration'))
+            if not group_type:
+                data = buckets.get(None, {'time_with_autofill': 0, 'time_without_autofill': 0})
+                return Response(data, status=status.HTTP_200_OK)
 
-            data = {
-                'time_with_autofill': round(data_with_autofill['avg_time']) if data_with_autofill['avg_time'] else 0,
-                'time_without_autofill': round(data_without_autofill['avg_time']) if data_without_autofill['avg_time'] else 0,
-            }
+            # buckets are local timestamps of the shop
+            data = [
+                dict(values, date=bucket if group_type == 'hour' else bucket.date())
+                for bucket, values in buckets.items()
+            ]
 
             return Response(data, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class PopUpShowVsClick(APIView):
+def get_popup_series(serializer, names):
+    """
+    popup_series for a validated PopupSerializer
+    :param serializer:
+    :param names: series names
+    :return: time_series result
+    """
+
+    return popup_series(
+        serializer.data['shop_id'],
+        names,
+        serializer.validated_data.get('start_date'),
+        serializer.validated_data.get('end_date'),
+        serializer.data.get('group_type') or 'month'
+    )
+
+
+class PopUpShowVsClick(ReplicaReadMixin, ResponseCacheMixin, APIView):
     permission_classes = [IsTokenAuthenticated, ]
     serializer_class = PopupSerializer
 
@@ -267,49 +361,20 @@ class PopUpShowVsClick(APIView):
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
+            result = get_popup_series(serializer, ['shows', 'clicks'])
 
-            popup_data = PopupData.objects.filter(
-                shop_id=serializer.data['shop_id'],
-            )
-
-            if serializer.data['start_date']:
-                popup_data = popup_data.filter(created_at__date__gte=serializer.data['start_date'])
-
-            if serializer.data['end_date']:
-                popup_data = popup_data.filter(created_at__date__lte=serializer.data['end_date'])
-
-            group_type = 'month'
-            if serializer.data['group_type']:
-                group_type = serializer.data['group_type']
-
-            if group_type == 'hour':
-                popup_data = popup_data.annotate(date=TruncTime('created_at'))
-            elif group_type == 'day':
-                popup_data = popup_data.annotate(date=TruncDate('created_at'))
-            else:
-                popup_data = popup_data.annotate(date=Trunc('created_at', group_type, output_field=DateField()))
-
-            number_shows = popup_data \
-                .values('date') \
-                .filter(type=TrackData.types['_show']) \
-                .annotate(count=Sum('data_count')) \
-                .values('date', 'count')
-
-            number_clicks = popup_data \
-                .values('date') \
-                .filter(type=TrackData.types['_click']) \
-                .annotate(count=Sum('data_count')) \
-                .values('date', 'count')
+            if serializer.data['columnar']:
+                return Response(result, status=status.HTTP_200_OK)
 
             return Response({
-                'number_shows': number_shows,
-                'number_clicks': number_clicks
+                'number_shows': to_rows(result, {'shows': 'count'}),
+                'number_clicks': to_rows(result, {'clicks': 'count'})
             }, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class PopUpClickVsPurchase(APIView):
+class PopUpClickVsPurchase(ReplicaReadMixin, ResponseCacheMixin, APIView):
     permission_classes = [IsTokenAuthenticated, ]
     serializer_class = PopupSerializer
 
@@ -319,57 +384,40 @@ class PopUpClickVsPurchase(APIView):
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
+            result = get_popup_series(serializer, ['clicks', 'purchases'])
 
-            popup_data = PopupData.objects.filter(
-                shop_id=serializer.data['shop_id'],
-            )
+            if serializer.data['columnar']:
+                return Response(result, status=status.HTTP_200_OK)
 
-            popup_revenue = PopupRevenue.objects.filter(
-                shop_id=serializer.data['shop_id'],
-            )
+            return Response({
+                'number_clicks': to_rows(result, {'clicks': 'count'}),
+                'number_purchases': to_rows(result, {'purchases': 'count'})
+            }, status=status.HTTP_200_OK)
 
-            if serializer.data['start_date']:
-                popup_data = popup_data.filter(created_at__date__gte=serializer.data['start_date'])
-                popup_revenue = popup_revenue.filter(created_at__date__gte=serializer.data['start_date'])
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            if serializer.data['end_date']:
-                popup_data = popup_data.filter(created_at__date__lte=serializer.data['end_date'])
-                popup_revenue = popup_revenue.filter(created_at__date__lte=serializer.data['end_date'])
 
-            group_type = 'month'
-            if serializer.data['group_type']:
-                group_type = serializer.data['group_type']
+class PopUpClicks(ReplicaReadMixin, ResponseCacheMixin, APIView):
+    permission_classes = [IsTokenAuthenticated, ]
+    serializer_class = PopupSerializer
 
-            if group_type == 'hour':
-                popup_data = popup_data.annotate(date=TruncTime('created_at'))
-                popup_revenue = popup_revenue.annotate(date=TruncTime('created_at'))
-            elif group_type == 'day':
-                popup_data = popup_data.annotate(date=TruncDate('created_at'))
-                popup_revenue = popup_revenue.annotate(date=TruncDate('created_at'))
-            else:
-                popup_data = popup_data.annotate(date=Trunc('created_at', group_type, output_field=DateField()))
-                popup_revenue = popup_revenue.annotate(date=Trunc('created_at', group_type, output_field=DateField()))
+    def get_serializer(self):
+        return self.serializer_class()
 
-            number_clicks = popup_data \
-                .values('date') \
-                .filter(type=TrackData.types['_click']) \
-                .annotate(count=Sum('data_count')) \
-                .values('date', 'count')
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data)
+        if serializer.is_valid():
+            result = get_popup_series(serializer, ['clicks'])
 
-            number_purchase = popup_revenue \
-                .values('date') \
-                .annotate(count=Count('id')) \
-                .values('date', 'count')
+            if serializer.data['columnar']:
+                return Response(result, status=status.HTTP_200_OK)
 
-            return Response({
-                'number_clicks': number_clicks,
-                'number_purchases': number_purchase
-            }, status=status.HTTP_200_OK)
+            return Response(to_rows(result, {'clicks': 'count'}), status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class PopUpClicks(APIView):
+class PopUpPurchases(ReplicaReadMixin, ResponseCacheMixin, APIView):
     permission_classes = [IsTokenAuthenticated, ]
     serializer_class = PopupSerializer
 
@@ -379,80 +427,91 @@ class PopUpClicks(APIView):
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
+            result = get_popup_series(serializer, ['purchases'])
 
-            popup_data = PopupData.objects.filter(
-                type=TrackData.types['_click'],
-                shop_id=serializer.data['shop_id']
-            )
+            if serializer.data['columnar']:
+                return Response(result, status=status.HTTP_200_OK)
 
-            if serializer.data['start_date']:
-                popup_data = popup_data.filter(created_at__date__gte=serializer.data['start_date'])
+            return Response(to_rows(result, {'purchases': 'count'}), status=status.HTTP_200_OK)
 
-            if serializer.data['end_date']:
-                popup_data = popup_data.filter(created_at__date__lte=serializer.data['end_date'])
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            group_type = 'month'
-            if serializer.data['group_type']:
-                group_type = serializer.data['group_type']
 
-            if group_type == 'hour':
-                popup_data = popup_data.annotate(date=TruncTime('created_at'))
-            elif group_type == 'day':
-                popup_data = popup_data.annotate(date=TruncDate('created_at'))
-            else:
-                popup_data = popup_data.annotate(date=Trunc('created_at', group_type, output_field=DateField()))
+def get_top_items(shop_id, start_date=None, end_date=None):
+    """
+    Top 10 articles bought from popup with their total purchases
+    :param shop_id:
+    :param start_date:
+    :param end_date:
+    :return: list of dicts
+    """
 
-            data = popup_data.values('date') \
-                .annotate(count=Sum('data_count')) \
-                .values('date', 'count')
+    popup_data = PopupRevenue.objects.filter(
+        articleID__isnull=False,
+        shop_id=shop_id
+    )
 
-            return Response(data, status=status.HTTP_200_OK)
+    tz = shop_timezone(shop_id)
+    popup_data = filter_range(popup_data, 'created_at', start_date, end_date, tz)
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    data = list(popup_data.values('articleID')
+                .annotate(count=Sum('quantity'))
+                .values('articleID', 'count')
+                .order_by('-count')[:10])
 
+    transaction_items = TransactionItems.objects.filter(
+        transaction__shop_id=shop_id,
+        articleID=OuterRef('articleID')
+    )
 
-class PopUpPurchases(APIView):
-    permission_classes = [IsTokenAuthenticated, ]
-    serializer_class = PopupSerializer
+    transaction_items = filter_range(transaction_items, 'transaction__created_at', start_date, end_date, tz)
 
-    def get_serializer(self):
-        return self.serializer_class()
+    transaction_count = transaction_items.values('articleID') \
+        .annotate(count=Sum('quantity')) \
+        .values('count')
 
-    def post(self, request):
-        serializer = self.serializer_class(data=request.data)
-        if serializer.is_valid():
+    # names and purchases of the top articles in one query
+    titles = ArticleTitle.objects.filter(shop_id=shop_id) \
+        .annotate(count=Subquery(transaction_count)) \
+        .values('articleID', 'name', 'count')
 
-            popup_data = PopupRevenue.objects.filter(
-                shop_id=serializer.data['shop_id']
-            )
+    articles = {
+        item['articleID']: item
+        for item in titles.filter(articleID__in=[item['articleID'] for item in data])
+    }
 
-            if serializer.data['start_date']:
-                popup_data = popup_data.filter(created_at__date__gte=serializer.data['start_date'])
+    missing = [item['articleID'] for item in data if item['articleID'] not in articles]
+    if missing:
+        # not indexed by refresh_article_titles yet, read their first title without writing the index
+        for item in TransactionItems.objects.filter(transaction__shop_id=shop_id, articleID__in=missing) \
+                .order_by('articleID', 'number').distinct('articleID') \
+                .annotate(count=Subquery(transaction_count)) \
+                .values('articleID', 'title', 'count'):
+            articles[item['articleID']] = dict(item, name=normalize_title(item['title'] or item['articleID']))
 
-            if serializer.data['end_date']:
-                popup_data = popup_data.filter(created_at__date__lte=serializer.data['end_date'])
+    response_data = []
 
-            group_type = 'month'
-            if serializer.data['group_type']:
-                group_type = serializer.data['group_type']
+    for item in data:
+        article = articles.get(item['articleID'], {})
 
-            if group_type == 'hour':
-                popup_data = popup_data.annotate(date=TruncTime('created_at'))
-            elif group_type == 'day':
-                popup_data = popup_data.annotate(date=TruncDate('created_at'))
-            else:
-                popup_data = popup_data.annotate(date=Trunc('created_at', group_type, output_field=DateField()))
+        name = article.get('name') or item['articleID']
+        count_purchases = article.get('count') or 0
 
-            data = popup_data.values('date') \
-                .annotate(count=Count('id')) \
-                .values('date', 'count')
+        count_popup = item['count']
+        if count_popup > count_purchases:
+            count_purchases = count_popup
 
-            return Response(data, status=status.HTTP_200_OK)
+        response = {
+            'name': name,
+            'count_popup': count_popup,
+            'count_purchases': count_purchases
+        }
+        response_data.append(response)
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    return response_data
 
 
-class PopItems(APIView):
+class PopItems(ReplicaReadMixin, ResponseCacheMixin, APIView):
     permission_classes = [IsTokenAuthenticated, ]
     serializer_class = PopupSerializer
 
@@ -462,72 +521,41 @@ class PopItems(APIView):
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
-            popup_data = PopupRevenue.objects.filter(
-                articleID__isnull=False,
-                shop_id=serializer.data['shop_id']
+            response_data = get_top_items(
+                serializer.data['shop_id'],
+                serializer.validated_data.get('start_date'),
+                serializer.validated_data.get('end_date')
             )
 
-            if serializer.data['start_date']:
-                popup_data = popup_data.filter(created_at__date__gte=serializer.data['start_date'])
-
-            if serializer.data['end_date']:
-                popup_data = popup_data.filter(created_at__date__lte=serializer.data['end_date'])
-
-            data = popup_data.values('articleID') \
-                       .annotate(count=Sum('quantity')) \
-                       .values('articleID', 'count') \
-                       .order_by('-count')[:10]
-
-            transaction_items = TransactionItems.objects.filter(
-                transaction__shop_id=serializer.data['shop_id'],
-                articleID__in=[item['articleID'] for item in data]
-            )
-
-            if serializer.data['start_date']:
-                transaction_items = transaction_items.filter(transaction__created_at__date__gte=serializer.data['start_date'])
-
-            if serializer.data['end_date']:
-                transaction_items = transaction_items.filter(transaction__created_at__date__lte=serializer.data['end_date'])
-
-            transaction_data = transaction_items.values('articleID') \
-                .annotate(count=Sum('quantity')) \
-                .values('articleID', 'count')
+            return Response(response_data, status=status.HTTP_200_OK)
 
-            response_data = []
-            variants = ['XS', 'S', 'M', 'L', 'XL', 'XXL', 'XS/S', 'S/M', 'M/L', 'L/XL', 'XL/XXL']
-            transaction_items = {item['articleID']: item['count'] for item in transaction_data}
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            for item in data:
-                item_name = TransactionItems.objects.filter(
-                    transaction__shop_id=serializer.data['shop_id'],
-                    articleID=item['articleID']
-                ).values('title').order_by('number').first()
 
-                name = item_name['title'] if item_name else item['articleID']
-                if name.split()[-1].upper() in variants:
-                    name = name.rsplit(' ', 1)[0]
+class PopUpRevenue(ReplicaReadMixin, ResponseCacheMixin, APIView):
+    permission_classes = [IsTokenAuthenticated, ]
+    serializer_class = PopupSerializer
 
-                count_purchases = 0
-                if item['articleID'] in transaction_items:
-                    count_purchases = transaction_items[item['articleID']]
+    def get_serializer(self):
+        return self.serializer_class()
 
-                count_popup = item['count']
-                if count_popup > count_purchases:
-                    count_purchases = count_popup
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data)
+        if serializer.is_valid():
+            result = get_popup_series(serializer, ['revenue'])
 
-                response = {
-                    'name': name,
-                    'count_popup': count_popup,
-                    'count_purchases': count_purchases
-                }
-                response_data.append(response)
+            if serializer.data['columnar']:
+                return Response(result, status=status.HTTP_200_OK)
 
-            return Response(response_data, status=status.HTTP_200_OK)
+            return Response(to_rows(result, {'revenue': 'sumAmount'}), status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class PopUpRevenue(APIView):
+class PopupMetrics(ReplicaReadMixin, ResponseCacheMixin, APIView):
+    """
+    Shows, clicks, purchases, revenue and top items for the popup dashboard in one request.
+    """
     permission_classes = [IsTokenAuthenticated, ]
     serializer_class = PopupSerializer
 
@@ -537,38 +565,33 @@ class PopUpRevenue(APIView):
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
-            popup_data = PopupRevenue.objects.filter(
-                shop_id=serializer.data['shop_id']
-            )
+            result = get_popup_series(serializer, ['shows', 'clicks', 'purchases', 'revenue'])
 
-            if serializer.data['start_date']:
-                popup_data = popup_data.filter(created_at__date__gte=serializer.data['start_date'])
-
-            if serializer.data['end_date']:
-                popup_data = popup_data.filter(created_at__date__lte=serializer.data['end_date'])
-
-            group_type = 'month'
-            if serializer.data['group_type']:
-                group_type = serializer.data['group_type']
-
-            if group_type == 'hour':
-                popup_data = popup_data.annotate(date=TruncTime('created_at'))
-            elif group_type == 'day':
-                popup_data = popup_data.annotate(date=TruncDate('created_at'))
+            if serializer.data['columnar']:
+                data = result
             else:
-                popup_data = popup_data.annotate(date=Trunc('created_at', group_type, output_field=DateField()))
+                data = {
+                    'number_shows': to_rows(result, {'shows': 'count'}),
+                    'number_clicks': to_rows(result, {'clicks': 'count'}),
+                    'number_purchases': to_rows(result, {'purchases': 'count'}),
+                    'revenue': to_rows(result, {'revenue': 'sumAmount'}),
+                }
 
-            data = popup_data.values('date') \
-                .annotate(sumAmount=Sum('amount')) \
-                .values('date', 'sumAmount')
+            data['top_items'] = get_top_items(
+                serializer.data['shop_id'],
+                serializer.validated_data.get('start_date'),
+                serializer.validated_data.get('end_date')
+            )
 
             return Response(data, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class GetAnalyticDataByType(APIView):
+
+class GetAnalyticDataByType(ReplicaReadMixin, APIView):
     # permission_classes = [IsAuthenticated, ]
     serializer_class = AnalyticDataByTypeSerializer
+    chunk_size = 2000
 
     def get_serializer(self):
         return self.serializer_class()
@@ -576,22 +599,49 @@ class GetAnalyticDataByType(APIView):
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
-            # print(serializer.data)
-
             analytic = TrackData.objects.filter(
                 type=serializer.data['type'],
                 session__shop_id=serializer.data['shop_id']
-            ).values('data').order_by('created_at')
+            )
 
-            if analytic:
-                return Response(analytic, status=status.HTTP_200_OK)
-            else:
-                return Response({}, status=status.HTTP_200_OK)
+            if not serializer.data['stream'] and not serializer.data.get('limit'):
+                analytic = list(analytic.values('data').order_by('created_at'))
+
+                if analytic:
+                    return Response(analytic, status=status.HTTP_200_OK)
+                else:
+                    return Response({}, status=status.HTTP_200_OK)
+
+            # keyset pagination over (created_at, id), rows without created_at come last
+            analytic = analytic.order_by('created_at', 'id')
+
+            if serializer.validated_data.get('cursor'):
+                analytic = keyset_filter(analytic, ['created_at', 'id'], serializer.validated_data['cursor'])
+
+            if serializer.data['stream']:
+                # rows are read while the response is sent, after ReplicaReadMixin has returned
+                analytic = analytic.using(analytic.db)
+                rows = analytic.values_list('data', flat=True).iterator(chunk_size=self.chunk_size)
+                return StreamingHttpResponse(
+                    (json.dumps({'data': data}) + '\n' for data in rows),
+                    content_type='application/x-ndjson'
+                )
+
+            rows = list(analytic.values('id', 'created_at', 'data')[:serializer.data['limit']])
+
+            next_cursor = None
+            if len(rows) == serializer.data['limit']:
+                next_cursor = encode_cursor([rows[-1]['created_at'], rows[-1]['id']])
+
+            return Response({
+                'results': [{'data': row['data']} for row in rows],
+                'next_cursor': next_cursor
+            }, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class GetSessionLastVoucher(APIView):
+class GetSessionLastVoucher(ReplicaReadMixin, APIView):
     # permission_classes = [IsAuthenticated, ]
     serializer_class = LastActionByTypeSerializer
 
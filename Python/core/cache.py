@@ -0,0 +1,261 @@
+import functools
+import hashlib
+import json
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from apps.core.timeseries import shop_timezone
+
+
+class LocalCache(object):
+    """
+    Thread safe in-process LRU cache with per key timeout.
+    Implements the subset of the django cache API used by the project,
+    so it can be swapped with DjangoCache.
+    """
+
+    def __init__(self, max_size=10000, timeout=300, **kwargs):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+
+        with self._lock:
+            for key in keys:
+                item = self._data.get(key)
+                if item is None:
+                    continue
+
+                value, expires = item
+                if expires is not None and expires <= now:
+                    del self._data[key]
+                    continue
+
+                self._data.move_to_end(key)
+                found[key] = value
+
+        return found
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, data, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        expires = time.monotonic() + timeout if timeout else None
+
+        with self._lock:
+            for key, value in data.items():
+                self._data[key] = (value, expires)
+                self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, timeout=None):
+        """
+        Set key unless it holds a value which has not expired.
+        :return: True if the value was stored
+        """
+
+        timeout = self.timeout if timeout is None else timeout
+        now = time.monotonic()
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[1] is None or item[1] > now):
+                return False
+
+            self._data[key] = (value, now + timeout if timeout else None)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+        return True
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCache(object):
+    """
+    Wrapper around django cache framework alias with own default timeout.
+    """
+
+    def __init__(self, alias='default', timeout=300, **kwargs):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, self.timeout if timeout is None else timeout)
+
+    def set_many(self, data, timeout=None):
+        self.cache.set_many(data, self.timeout if timeout is None else timeout)
+
+    def add(self, key, value, timeout=None):
+        return self.cache.add(key, value, self.timeout if timeout is None else timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+    def clear(self):
+        self.cache.clear()
+
+
+CACHE_BACKENDS = {
+    'local': LocalCache,
+    'django': DjangoCache,
+}
+
+
+def build_cache(config):
+    """
+    Create cache from config dict like
+    {'BACKEND': 'local', 'MAX_SIZE': 10000, 'TIMEOUT': 300, 'ALIAS': 'default'}
+    :param config: dict
+    :return: LocalCache or DjangoCache, None if BACKEND is empty
+    """
+
+    backend = config.get('BACKEND')
+    if not backend:
+        return None
+
+    if backend not in CACHE_BACKENDS:
+        raise ValueError('Unknown cache backend "%s"' % backend)
+
+    return CACHE_BACKENDS[backend](
+        max_size=config.get('MAX_SIZE', 10000),
+        timeout=config.get('TIMEOUT', 300),
+        alias=config.get('ALIAS', 'default'),
+    )
+
+
+class CacheStats(object):
+    """
+    In-process hit / miss counters per cache name.
+    """
+
+    def __init__(self):
+        self._counters = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def incr(self, name, event):
+        with self._lock:
+            self._counters[name][event] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(counter) for name, counter in self._counters.items()}
+
+
+response_cache_stats = CacheStats()
+
+latest_action_cache_stats = CacheStats()
+
+
+class ResponseCacheMixin(object):
+    """
+    Cache successful POST responses of APIView keyed by view name and validated
+    serializer data, configured with RESPONSE_CACHE settings.
+    Date ranges ending before today get PAST_TIMEOUT, ranges including today
+    TODAY_TIMEOUT. Only one worker recomputes a missing response, the others
+    wait up to WAIT seconds for its result.
+    The view's own post is wrapped after authentication and permission checks,
+    so the mixin can be anywhere before APIView in the bases.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        if request.method == 'POST':
+            # dispatch looks the handler up on the instance after initial
+            self.post = functools.partial(self.cached_post, self.post)
+
+    def cached_post(self, handler, request, *args, **kwargs):
+        """
+        :param handler: post method of the view
+        :param request:
+        :return: cached or computed Response
+        """
+
+        serializer = self.serializer_class(data=request.data)
+        if not serializer.is_valid():
+            return handler(request, *args, **kwargs)
+
+        config = getattr(settings, 'RESPONSE_CACHE', {})
+        cache = caches[config.get('ALIAS', 'default')]
+        name = self.__class__.__name__
+        key = self.get_cache_key(serializer.validated_data)
+
+        data = cache.get(key)
+        if data is not None:
+            response_cache_stats.incr(name, 'hit')
+            return Response(data, status=status.HTTP_200_OK)
+
+        lock_key = key + ':lock'
+        if not cache.add(lock_key, 1, config.get('LOCK_TIMEOUT', 30)):
+            deadline = time.monotonic() + config.get('WAIT', 10)
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                data = cache.get(key)
+                if data is not None:
+                    response_cache_stats.incr(name, 'wait')
+                    return Response(data, status=status.HTTP_200_OK)
+
+            response_cache_stats.incr(name, 'wait_timeout')
+            return handler(request, *args, **kwargs)
+
+        try:
+            response = handler(request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, self.get_cache_timeout(serializer.validated_data, config))
+        finally:
+            cache.delete(lock_key)
+
+        response_cache_stats.incr(name, 'miss')
+        return response
+
+    def get_cache_key(self, data):
+        payload = json.dumps(data, sort_keys=True, default=str)
+        return 'response:%s:%s' % (self.__class__.__name__, hashlib.md5(payload.encode('utf-8')).hexdigest())
+
+    def get_cache_timeout(self, data, config):
+        end_date = data.get('end_date')
+        # days are closed in the shop's time zone
+        today = timezone.localdate(timezone=shop_timezone(data['shop_id'])) if data.get('shop_id') else timezone.localdate()
+        if end_date and end_date < today:
+            return config.get('PAST_TIMEOUT', 24 * 60 * 60)
+
+        return config.get('TODAY_TIMEOUT', 60)
@@ -0,0 +1,166 @@
+"""
+Base class for maintenance commands which walk a table by primary key ranges.
+
+    class Command(ChunkedCommand):
+        help = 'Delete first_viewed_page rows'
+        model = TrackData
+
+        def process_chunk(self, queryset, start, end):
+            return queryset.filter(type=7).delete()[0]
+
+Every chunk runs in its own transaction, progress is checkpointed in
+CommandCheckpoint after each chunk so an interrupted run continues where it
+stopped, and the command sleeps between chunks (--sleep, --max-rate) to leave
+room for normal traffic. With --workers chunks are processed by a forked
+process pool and the checkpoint follows the last chunk finished in order.
+A chunk may run twice after a crash, so process_chunk must be idempotent.
+"""
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from apps.core.models import BulkCreateManager, CommandCheckpoint
+
+# command of the parent process, inherited by forked pool workers
+_worker_command = None
+
+
+def pk_ranges(start, end, size):
+    """
+    Half open ranges [start, start + size) up to end (inclusive)
+    :return: generator of (start, end)
+    """
+
+    while start <= end:
+        yield start, start + size
+        start += size
+
+
+def _run_chunk(chunk_range):
+    start, end = chunk_range
+    return start, end, _worker_command.run_chunk(start, end)
+
+
+class ChunkedCommand(BaseCommand):
+    model = None
+    chunk_size = 10000
+    # models written with COPY by get_manager()
+    copy_models = ()
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=self.chunk_size, help='Primary key range per chunk')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to sleep after every chunk')
+        parser.add_argument('--max-rate', type=float, default=None, help='Max rows per second')
+        parser.add_argument('--workers', type=int, default=1, help='Processes working on chunks in parallel')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of a previous run')
+        parser.add_argument('--checkpoint', default=None, help='Checkpoint name, defaults to the command name')
+
+    def get_queryset(self):
+        return self.model._default_manager.all()
+
+    def process_chunk(self, queryset, start, end):
+        """
+        Handle rows of one primary key range, called inside a transaction.
+        :param queryset: get_queryset() limited to the range
+        :param start: first pk of the range
+        :param end: first pk after the range
+        :return: number of handled rows
+        """
+
+        raise NotImplementedError('subclasses of ChunkedCommand must provide a process_chunk() method')
+
+    def get_manager(self):
+        """
+        BulkCreateManager for process_chunk implementations which create rows,
+        flushed at the end of every chunk.
+        """
+
+        if getattr(self, '_manager', None) is None:
+            self._manager = BulkCreateManager(chunk_size=5000, copy_models=self.copy_models)
+
+        return self._manager
+
+    def run_chunk(self, start, end):
+        queryset = self.get_queryset().filter(pk__gte=start, pk__lt=end)
+
+        with transaction.atomic():
+            rows = self.process_chunk(queryset, start, end) or 0
+            if getattr(self, '_manager', None) is not None:
+                self._manager.done()
+                self._manager = None
+
+        return rows
+
+    def handle(self, *args, **options):
+        if self.model is None:
+            raise CommandError('%s has no model' % self.__class__.__name__)
+
+        self.options = options
+        name = options['checkpoint'] or self.__module__.rsplit('.', 1)[-1]
+
+        checkpoint, created = CommandCheckpoint.objects.get_or_create(name=name)
+        if options['restart'] or checkpoint.done:
+            if checkpoint.done and not options['restart']:
+                self.stdout.write('%s is done, use --restart to run it again' % name)
+                return
+            checkpoint.next_id = checkpoint.end_id = None
+            checkpoint.rows = 0
+            checkpoint.done = False
+
+        if checkpoint.next_id is None:
+            bounds = self.get_queryset().aggregate(first=Min('pk'), last=Max('pk'))
+            if bounds['first'] is None:
+                self.stdout.write('Nothing to do')
+                return
+            checkpoint.next_id = bounds['first']
+            checkpoint.end_id = bounds['last']
+        checkpoint.save()
+
+        ranges = pk_ranges(checkpoint.next_id, checkpoint.end_id, options['chunk_size'])
+        self._last_chunk_at = time.monotonic()
+
+        if options['workers'] > 1:
+            self.run_pool(checkpoint, ranges, options['workers'])
+        else:
+            for start, end in ranges:
+                self.chunk_done(checkpoint, end, self.run_chunk(start, end), time.monotonic())
+
+        checkpoint.done = True
+        checkpoint.save()
+
+        self.stdout.write(self.style.SUCCESS('%s: %d rows' % (name, checkpoint.rows)))
+
+    def run_pool(self, checkpoint, ranges, workers):
+        global _worker_command
+
+        # forked workers must not share the parent's database connections
+        connections.close_all()
+        _worker_command = self
+
+        context = multiprocessing.get_context('fork')
+        with context.Pool(workers) as pool:
+            for start, end, rows in pool.imap(_run_chunk, ranges):
+                self.chunk_done(checkpoint, end, rows, time.monotonic())
+
+    def chunk_done(self, checkpoint, end, rows, finished_at):
+        checkpoint.next_id = end
+        checkpoint.rows += rows
+        checkpoint.save(update_fields=['next_id', 'rows', 'updated_at'])
+
+        self.stdout.write('%s: %d / %d, %d rows' % (checkpoint.name, min(end, checkpoint.end_id + 1), checkpoint.end_id + 1, checkpoint.rows))
+        self.throttle(rows, finished_at)
+
+    def throttle(self, rows, finished_at):
+        last = self._last_chunk_at
+        self._last_chunk_at = finished_at
+
+        delay = self.options['sleep']
+        if self.options['max_rate']:
+            delay = max(delay, rows / self.options['max_rate'] - (finished_at - last))
+
+        if delay > 0:
+            time.sleep(delay)
+            self._last_chunk_at = time.monotonic()
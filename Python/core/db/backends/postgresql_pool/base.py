@@ -0,0 +1,40 @@
+"""
+PostgreSQL backend which takes connections from an in-process pool.
+
+    'ENGINE': 'apps.core.db.backends.postgresql_pool',
+    'CONN_MAX_AGE': 0,
+    'POOL': {'MAX_SIZE': 8, 'TIMEOUT': 10},
+
+Closing the django connection at the end of the request returns it to the
+pool, so CONN_MAX_AGE should stay 0. MAX_SIZE should match the threads of a
+worker process. Connections above MIN_SIZE (defaults to MAX_SIZE) are closed
+when they are returned, so a lower MIN_SIZE means reconnecting.
+"""
+from django.db.backends.postgresql import base
+
+from apps.core.db.pool import get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_pool(self):
+        return get_pool(self.alias, self.get_connection_params(), self.settings_dict.get('POOL'))
+
+    def get_new_connection(self, conn_params):
+        connection = get_pool(self.alias, conn_params, self.settings_dict.get('POOL')).getconn()
+
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.get_pool().putconn(self.connection)
@@ -0,0 +1,114 @@
+import threading
+import time
+
+from psycopg2 import pool as psycopg2_pool
+
+
+class PoolTimeout(psycopg2_pool.PoolError):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Thread safe psycopg2 connection pool which waits up to `timeout` seconds
+    for a free connection instead of failing when all connections are in use.
+    Keeps counters for the pool metrics.
+    psycopg2 closes connections which are returned while `min_size` are idle,
+    so `min_size` defaults to `max_size` and the connections are reused.
+    """
+
+    def __init__(self, min_size=None, max_size=10, timeout=10, **conn_params):
+        min_size = max_size if min_size is None else min_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self._pool = psycopg2_pool.ThreadedConnectionPool(min_size, max_size, **conn_params)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'wait_time': 0.0,
+            'in_use': 0,
+        }
+
+    def getconn(self):
+        start = time.monotonic()
+        waited = not self._slots.acquire(blocking=False)
+        if waited and not self._slots.acquire(timeout=self.timeout):
+            self._incr(requests=1, waits=1, timeouts=1, wait_time=time.monotonic() - start)
+            raise PoolTimeout('No free connection after %s seconds' % self.timeout)
+
+        try:
+            connection = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        self._incr(requests=1, waits=int(waited), wait_time=time.monotonic() - start, in_use=1)
+        return connection
+
+    def putconn(self, connection, close=False):
+        try:
+            # rolls back open transactions and closes broken connections
+            self._pool.putconn(connection, close=close)
+        finally:
+            self._incr(in_use=-1)
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats.update({
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'idle': len(self._pool._pool),
+        })
+        return stats
+
+    def _incr(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self._stats[key] += value
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, conn_params=None, config=None):
+    """
+    Process wide pool of a database alias, created on first use
+    :param alias: DATABASES key
+    :param conn_params: psycopg2 connect kwargs
+    :param config: DATABASES[alias]['POOL'] dict with MAX_SIZE, TIMEOUT and MIN_SIZE (defaults to MAX_SIZE)
+    :return: ConnectionPool
+    """
+
+    with _pools_lock:
+        if alias not in _pools:
+            config = config or {}
+            _pools[alias] = ConnectionPool(
+                min_size=config.get('MIN_SIZE'),
+                max_size=config.get('MAX_SIZE', 10),
+                timeout=config.get('TIMEOUT', 10),
+                **conn_params
+            )
+
+        return _pools[alias]
+
+
+def pool_stats():
+    """
+    :return: dict alias -> pool stats for all pools created in this process
+    """
+
+    with _pools_lock:
+        pools = dict(_pools)
+
+    return {alias: pool.stats() for alias, pool in pools.items()}
@@ -0,0 +1,127 @@
+import contextlib
+import contextvars
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+# set for the duration of a view which may read from replicas
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+# set after the first write in that view, later reads go to the primary
+_pinned = contextvars.ContextVar('replica_pinned', default=False)
+
+LAG_SQL = '''
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+'''
+
+
+def get_config():
+    config = {
+        'ALIASES': [],
+        'MAX_LAG': 5,
+        'LAG_CHECK_INTERVAL': 5,
+    }
+    config.update(getattr(settings, 'DATABASE_REPLICAS', {}))
+
+    return config
+
+
+class ReplicaLag(object):
+    """
+    Replication lag per replica alias in seconds, queried at most once per
+    LAG_CHECK_INTERVAL per process. Unreachable replicas count as lagging.
+    """
+
+    def __init__(self):
+        self._lags = {}
+        self._lock = threading.Lock()
+
+    def get(self, alias, interval):
+        now = time.monotonic()
+
+        with self._lock:
+            lag, checked_at = self._lags.get(alias, (None, None))
+            if checked_at is not None and now - checked_at < interval:
+                return lag
+
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(LAG_SQL)
+                lag = float(cursor.fetchone()[0] or 0)
+        except DatabaseError:
+            lag = float('inf')
+
+        with self._lock:
+            self._lags[alias] = (lag, now)
+
+        return lag
+
+
+replica_lag = ReplicaLag()
+
+
+@contextlib.contextmanager
+def read_from_replica():
+    """
+    Route reads inside the block to a replica within MAX_LAG seconds of the
+    primary. Reads after a write in the same block stay on the primary.
+    """
+
+    replica_token = _replica_reads.set(True)
+    pinned_token = _pinned.set(False)
+    try:
+        yield
+    finally:
+        _pinned.reset(pinned_token)
+        _replica_reads.reset(replica_token)
+
+
+class ReplicaReadMixin(object):
+    """
+    APIView mixin for read only endpoints which tolerate replication lag.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with read_from_replica():
+            return super().dispatch(request, *args, **kwargs)
+
+
+class ReplicaRouter(object):
+    """
+    Sends reads of views using ReplicaReadMixin to DATABASE_REPLICAS aliases,
+    everything else (writes, transactions, other views, commands) to default.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not _replica_reads.get() or _pinned.get():
+            return DEFAULT_DB_ALIAS
+
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+
+        config = get_config()
+        aliases = [
+            alias for alias in config['ALIASES']
+            if replica_lag.get(alias, config['LAG_CHECK_INTERVAL']) <= config['MAX_LAG']
+        ]
+        if not aliases:
+            return DEFAULT_DB_ALIAS
+
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        if _replica_reads.get():
+            _pinned.set(True)
+
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
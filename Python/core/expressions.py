@@ -0,0 +1,21 @@
+import json
+
+from django.contrib.postgres.fields import JSONField
+from django.db.models import F, Func
+
+
+class JSONBMerge(Func):
+    """
+    Merge dict into jsonb column in the database, without loading the row:
+    `Model.objects.filter(pk=pk).update(data=JSONBMerge('data', {'key': 'value'}))`
+    """
+
+    template = "(COALESCE(%(expressions)s, '{}'::jsonb) || %%s::jsonb)"
+
+    def __init__(self, field, value, **extra):
+        self.value = value
+        super().__init__(F(field) if isinstance(field, str) else field, output_field=JSONField(), **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = super().as_sql(compiler, connection, **extra_context)
+        return sql, tuple(params) + (json.dumps(self.value), )
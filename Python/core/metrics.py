@@ -0,0 +1,190 @@
+"""
+In-process request metrics in Prometheus text format.
+
+RequestMetricsMiddleware records one RequestStats per request, the
+histograms are kept per process, so every worker has to be scraped on its own
+(or run with a single worker per exporter target).
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+from rest_framework.serializers import BaseSerializer
+
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+QUERY_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200]
+
+_local = threading.local()
+
+
+class Histogram(object):
+    """
+    Cumulative histogram per label values, not thread safe on its own.
+    """
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # label values -> [counts per bucket + Inf, sum]
+        self._values = {}
+
+    def observe(self, labels, value):
+        item = self._values.get(labels)
+        if item is None:
+            item = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+
+        item[0][bisect.bisect_left(self.buckets, value)] += 1
+        item[1] += value
+
+    def render(self, label_names):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help_text),
+            '# TYPE %s histogram' % self.name,
+        ]
+
+        for labels, (counts, total) in sorted(self._values.items()):
+            label_text = _labels(label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label_text, bound, cumulative))
+            lines.append('%s_sum{%s} %s' % (self.name, label_text, _number(total)))
+            lines.append('%s_count{%s} %d' % (self.name, label_text, cumulative))
+
+        return lines
+
+
+class RequestStats(object):
+    """
+    Measurements of the current request, collected by the database execute
+    wrapper and the serializer instrumentation.
+    """
+
+    def __init__(self, max_queries=50):
+        self.start = time.perf_counter()
+        self.view = None
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.serializer_depth = 0
+        self.max_queries = max_queries
+        # (seconds, sql) of the first max_queries statements
+        self.captured = []
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start
+            self.queries += 1
+            self.db_seconds += seconds
+            if len(self.captured) < self.max_queries:
+                self.captured.append((seconds, sql))
+
+
+class RequestMetrics(object):
+    """
+    Histograms per view of wall time, database time, serializer time,
+    query count and response size, and a request counter per view, method
+    and status code.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.histograms = [
+            ('duration', Histogram('http_request_duration_seconds', 'Wall time of the request.', DURATION_BUCKETS)),
+            ('db_seconds', Histogram('http_request_db_duration_seconds', 'Time spent in database queries.', DURATION_BUCKETS)),
+            ('serializer_seconds', Histogram('http_request_serializer_duration_seconds', 'Time spent in DRF serializers.', DURATION_BUCKETS)),
+            ('queries', Histogram('http_request_db_queries', 'Number of database queries.', QUERY_BUCKETS)),
+            ('size', Histogram('http_response_size_bytes', 'Size of the response body.', SIZE_BUCKETS)),
+        ]
+
+    def record(self, view, method, status_code, values):
+        """
+        :param view: view name
+        :param method: HTTP method
+        :param status_code: response status code
+        :param values: dict histogram key -> observed value, missing keys are skipped
+        :return: None
+        """
+
+        with self._lock:
+            self.requests[(view, method, str(status_code))] += 1
+            for key, histogram in self.histograms:
+                if values.get(key) is not None:
+                    histogram.observe((view, ), values[key])
+
+    def render(self):
+        with self._lock:
+            lines = [
+                '# HELP http_requests_total Number of requests.',
+                '# TYPE http_requests_total counter',
+            ]
+            for labels, count in sorted(self.requests.items()):
+                lines.append('http_requests_total{%s} %d' % (_labels(('view', 'method', 'status'), labels), count))
+
+            for key, histogram in self.histograms:
+                lines.extend(histogram.render(('view', )))
+
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+def get_request_stats():
+    return getattr(_local, 'stats', None)
+
+
+def set_request_stats(stats):
+    _local.stats = stats
+
+
+def instrument_serializers():
+    """
+    Time BaseSerializer.is_valid and BaseSerializer.data for the request stats,
+    nested serializers are counted once. Idempotent.
+    """
+
+    if getattr(BaseSerializer, '_metrics_instrumented', False):
+        return
+
+    BaseSerializer.is_valid = _timed(BaseSerializer.is_valid)
+    BaseSerializer.data = property(_timed(BaseSerializer.data.fget))
+    BaseSerializer._metrics_instrumented = True
+
+
+def _timed(function):
+    def wrapper(*args, **kwargs):
+        stats = get_request_stats()
+        if stats is None or stats.serializer_depth:
+            return function(*args, **kwargs)
+
+        stats.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.serializer_seconds += time.perf_counter() - start
+            stats.serializer_depth -= 1
+
+    return wrapper
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value))
@@ -0,0 +1,150 @@
+import contextlib
+import logging
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+from apps.core.metrics import RequestStats, instrument_serializers, request_metrics, set_request_stats
+
+logger = logging.getLogger(__name__)
+
+
+class StatementTimeoutMiddleware(object):
+    """
+    statement_timeout per view from STATEMENT_TIMEOUTS settings, so slow
+    dashboard queries are cancelled by the server before they hold the
+    connections needed by track-data ingest.
+    The timeout is set with a separate statement before the first query of the
+    view on each alias, including replicas, and reset after the response.
+    Views which don't query and views without a timeout cost no round trips.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # aliases whose session has the view's timeout
+        applied = set()
+
+        def execute_wrapper(execute, sql, params, many, context):
+            timeout = getattr(request, '_statement_timeout', None)
+            connection = context['connection']
+            if timeout is not None and connection.alias not in applied:
+                applied.add(connection.alias)
+                # not part of the query, server side cursors and executemany keep their SQL
+                with connection.wrap_database_errors, connection.connection.cursor() as cursor:
+                    cursor.execute("SELECT set_config('statement_timeout', %s, false)", [str(timeout)])
+
+            return execute(sql, params, many, context)
+
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(execute_wrapper))
+                return self.get_response(request)
+        finally:
+            for alias in applied:
+                self.reset(connections[alias])
+
+    def reset(self, connection):
+        """
+        Back to the timeout of the alias OPTIONS, connections which can't run
+        the RESET are closed instead of being reused by the next request.
+        :param connection: DatabaseWrapper
+        :return: None
+        """
+
+        if connection.connection is None:
+            return
+
+        try:
+            with connection.wrap_database_errors, connection.connection.cursor() as cursor:
+                cursor.execute('RESET statement_timeout')
+        except DatabaseError:
+            connection.close()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timeout = self.get_timeout(view_func)
+        if timeout is not None:
+            request._statement_timeout = int(timeout)
+
+        return None
+
+    def get_timeout(self, view_func):
+        config = getattr(settings, 'STATEMENT_TIMEOUTS', {})
+        name = getattr(view_func, 'view_class', view_func).__name__
+
+        return config.get('VIEWS', {}).get(name)
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Record view name, wall time, query count, database time, serializer time
+    and response size of every request into apps.core.metrics.request_metrics,
+    exposed at /metrics. Requests slower than REQUEST_METRICS['SLOW_REQUEST']
+    seconds are logged with their SQL statements.
+    Should be placed first in MIDDLEWARE.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = {
+            'ENABLED': True,
+            'SLOW_REQUEST': None,
+            'MAX_QUERIES': 50,
+            'EXCLUDE': [],
+        }
+        self.config.update(getattr(settings, 'REQUEST_METRICS', {}))
+
+        if self.config['ENABLED']:
+            instrument_serializers()
+
+    def __call__(self, request):
+        if not self.config['ENABLED']:
+            return self.get_response(request)
+
+        stats = RequestStats(max_queries=self.config['MAX_QUERIES'])
+        set_request_stats(stats)
+
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats.execute_wrapper))
+                response = self.get_response(request)
+        finally:
+            set_request_stats(None)
+
+        self.record(request, response, stats)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = getattr(view_func, 'view_class', view_func).__name__
+
+        return None
+
+    def record(self, request, response, stats):
+        view = getattr(request, '_metrics_view', '<unresolved>')
+        if view in self.config['EXCLUDE']:
+            return
+
+        seconds = time.perf_counter() - stats.start
+        size = None if response.streaming else len(response.content)
+
+        request_metrics.record(view, request.method, response.status_code, {
+            'duration': seconds,
+            'db_seconds': stats.db_seconds,
+            'serializer_seconds': stats.serializer_seconds,
+            'queries': stats.queries,
+            'size': size,
+        })
+
+        slow_request = self.config['SLOW_REQUEST']
+        if slow_request is not None and seconds >= slow_request:
+            logger.warning(
+                'Slow request %s %s view=%s status=%s %.3fs queries=%d db=%.3fs serializer=%.3fs size=%s\n%s',
+                request.method, request.path, view, response.status_code, seconds, stats.queries,
+                stats.db_seconds, stats.serializer_seconds, size,
+                '\n'.join('%8.1fms %s' % (query_seconds * 1000, sql) for query_seconds, sql in stats.captured)
+            )
@@ -1,8 +1,12 @@
-from collections import defaultdict
+import datetime
+import io
+import time
+from collections import OrderedDict, defaultdict
 
 from django.apps import apps
-from django.db import models
+from django.db import connections, models, router
 from django.utils import timezone
+from psycopg2.extras import Json
 
 
 class AbstractBaseModel(models.Model):
@@ -24,34 +28,295 @@ class BulkCreateManager(object):
     when the number of objects accumulated for a given model class exceeds
     `chunk_size`.
     Upon completion of the loop that's `add()`ing objects, the developer must
-    call `done()` to ensure the final set of objects is created for all models.
+    call `done()` to ensure the final set of objects is created for all models,
+    or use the manager as a context manager.
+
+    Objects can also be queued for `bulk_update` with `update()` and for
+    INSERT ... ON CONFLICT DO UPDATE with `upsert()`. Queues of models which
+    others point to with a foreign key are written first, so the related
+    objects have their primary key when the dependent rows are written.
+
+    Models in `copy_models` are written with postgres COPY FROM STDIN instead,
+    which is much faster for large amounts of rows. Those models also accept
+    dicts of field values in `add()`. Objects written with COPY don't get
+    their primary key set, so use it only when the caller doesn't need it.
+    `stats` holds rows, flushes and seconds spent per model.
     """
 
-    def __init__(self, chunk_size=100):
-        self._create_queues = defaultdict(list)
+    operations = ['upsert', 'create', 'update']
+
+    def __init__(self, chunk_size=100, copy_models=()):
+        # (model label, operation, fields) -> objects
+        self._queues = OrderedDict()
         self.chunk_size = chunk_size
+        self.copy_models = set(
+            model if isinstance(model, str) else model._meta.label
+            for model in copy_models
+        )
+        self.stats = defaultdict(lambda: {'rows': 0, 'flushes': 0, 'seconds': 0.0})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.done()
+
+    def _queue(self, model_class, operation, fields, obj):
+        key = (model_class._meta.label, operation, fields)
+        self._queues.setdefault(key, []).append(obj)
+        if len(self._queues[key]) >= self.chunk_size:
+            self._commit(key)
+
+    def _commit(self, key):
+        model_key, operation, fields = key
+        model_class = apps.get_model(model_key)
+
+        for dependency in _dependencies(model_class):
+            self._flush_model(dependency)
+
+        objs = self._queues.pop(key, [])
+        if not objs:
+            return
 
-    def _commit(self, model_class):
-        model_key = model_class._meta.label
-        model_class.objects.bulk_create(self._create_queues[model_key])
-        self._create_queues[model_key] = []
+        _resolve_relations(objs)
 
-    def add(self, obj):
+        start = time.monotonic()
+        if operation == 'update':
+            model_class.objects.bulk_update(objs, list(fields))
+        elif operation == 'upsert':
+            upsert_rows(model_class, objs, fields[0], fields[1])
+        elif model_key in self.copy_models:
+            copy_rows(model_class, objs)
+        else:
+            model_class.objects.bulk_create(objs)
+
+        stats = self.stats[model_key]
+        stats['rows'] += len(objs)
+        stats['flushes'] += 1
+        stats['seconds'] += time.monotonic() - start
+
+    def _flush_model(self, model_key):
+        for operation in self.operations:
+            for key in [key for key in self._queues if key[0] == model_key and key[1] == operation]:
+                self._commit(key)
+
+    def add(self, obj, model_class=None):
         """
         Add an object to the queue to be created, and call bulk_create if we
         have enough objs.
+        :param obj: model instance, or dict of field values for copy_models
+        :param model_class: required for dicts
+        """
+        self._queue(model_class or type(obj), 'create', (), obj)
+
+    def update(self, obj, fields):
+        """
+        Add an object to the queue to be saved with bulk_update.
+        Field values may be expressions, e.g. F('count') + 1.
+        :param obj: model instance with pk
+        :param fields: names of the fields to update
+        """
+        self._queue(type(obj), 'update', tuple(fields), obj)
+
+    def upsert(self, obj, update_fields, conflict_fields=None):
+        """
+        Add an object to the queue to be inserted, or to update `update_fields`
+        of the existing row with the same `conflict_fields`. The objects get
+        the primary key of the inserted or updated row.
+        :param obj: model instance
+        :param update_fields: names of the fields to update on conflict
+        :param conflict_fields: unique field names, defaults to the model's unique_together
         """
         model_class = type(obj)
-        model_key = model_class._meta.label
-        self._create_queues[model_key].append(obj)
-        if len(self._create_queues[model_key]) >= self.chunk_size:
-            self._commit(model_class)
+        if conflict_fields is None:
+            conflict_fields = model_class._meta.unique_together[0]
+        self._queue(model_class, 'upsert', (tuple(update_fields), tuple(conflict_fields)), obj)
 
     def done(self):
         """
         Always call this upon completion to make sure the final partial chunk
         is saved.
         """
-        for model_name, objs in self._create_queues.items():
-            if len(objs) > 0:
-                self._commit(apps.get_model(model_name))
+        for model_key in _model_order(set(key[0] for key in self._queues)):
+            self._flush_model(model_key)
+
+
+def upsert_rows(model_class, objs, update_fields, conflict_fields):
+    """
+    INSERT ... ON CONFLICT (conflict_fields) DO UPDATE SET update_fields,
+    sets the primary key of all objects from RETURNING.
+    :return: None
+    """
+
+    connection = connections[router.db_for_write(model_class)]
+    quote = connection.ops.quote_name
+    opts = model_class._meta
+
+    fields = [field for field in opts.concrete_fields if not isinstance(field, models.AutoField)]
+    conflict = [opts.get_field(name) for name in conflict_fields]
+    # DO NOTHING would not return existing rows, so update at least one column with itself
+    update = [opts.get_field(name) for name in update_fields] or conflict[:1]
+
+    # a row can't be updated twice by one statement, the last object of a key wins
+    unique = dict((tuple(getattr(obj, field.attname) for field in conflict), obj) for obj in objs)
+    # rows are locked in key order, so concurrent upserts of overlapping keys can't deadlock
+    unique = OrderedDict(sorted(unique.items(), key=lambda item: item[0]))
+
+    params = []
+    for obj in unique.values():
+        params.extend(field.get_db_prep_save(field.pre_save(obj, add=True), connection) for field in fields)
+
+    row = '(%s)' % ', '.join(['%s'] * len(fields))
+    sql = 'INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s) DO UPDATE SET %s RETURNING %s, %s' % (
+        quote(opts.db_table),
+        ', '.join(quote(field.column) for field in fields),
+        ', '.join([row] * len(unique)),
+        ', '.join(quote(field.column) for field in conflict),
+        ', '.join('%s = EXCLUDED.%s' % (quote(field.column), quote(field.column)) for field in update),
+        quote(opts.pk.column),
+        ', '.join(quote(field.column) for field in conflict),
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        pks = {tuple(values[1:]): values[0] for values in cursor.fetchall()}
+
+    for obj in objs:
+        obj.pk = pks.get(tuple(getattr(obj, field.attname) for field in conflict))
+        obj._state.adding = False
+        obj._state.db = connection.alias
+
+
+def _dependencies(model_class):
+    return set(
+        field.related_model._meta.label
+        for field in model_class._meta.concrete_fields
+        if field.is_relation and field.related_model is not model_class
+    )
+
+
+def _model_order(model_keys):
+    """
+    Model labels ordered so models come after the models they point to
+    """
+
+    ordered = []
+    pending = set(model_keys)
+
+    while pending:
+        ready = sorted(key for key in pending if not (_dependencies(apps.get_model(key)) & pending))
+        # foreign key cycles are written in any order
+        ready = ready or sorted(pending)
+        ordered.extend(ready)
+        pending.difference_update(ready)
+
+    return ordered
+
+
+def _resolve_relations(objs):
+    # foreign key ids of related objects saved after they were assigned
+    for obj in objs:
+        if isinstance(obj, dict):
+            continue
+
+        for field in obj._meta.concrete_fields:
+            if field.is_relation and field.is_cached(obj) and getattr(obj, field.attname) is None:
+                related = getattr(obj, field.name)
+                if related is not None:
+                    setattr(obj, field.attname, related.pk)
+
+
+def copy_rows(model_class, rows):
+    """
+    Insert rows with COPY FROM STDIN, the rows are encoded into an in-memory
+    buffer in the COPY text format and sent with one statement.
+    :param model_class:
+    :param rows: model instances or dicts of field values (attname or name keys)
+    :return: None
+    """
+
+    connection = connections[router.db_for_write(model_class)]
+    fields = [field for field in model_class._meta.concrete_fields if not isinstance(field, models.AutoField)]
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(
+            _copy_value(field.get_db_prep_save(_field_value(field, row), connection))
+            for field in fields
+        ))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (
+            connection.ops.quote_name(model_class._meta.db_table),
+            ', '.join(connection.ops.quote_name(field.column) for field in fields)
+        ), buffer)
+
+
+def _field_value(field, row):
+    if not isinstance(row, dict):
+        return field.pre_save(row, add=True)
+
+    if field.attname in row:
+        return row[field.attname]
+    if field.name in row:
+        value = row[field.name]
+        return value.pk if field.is_relation and isinstance(value, models.Model) else value
+
+    if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+        return timezone.now()
+
+    return field.get_default()
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, Json):
+        value = value.dumps(value.adapted)
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat()
+    else:
+        value = str(value)
+
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CommandCheckpoint(models.Model):
+    """
+    Progress of a ChunkedCommand run, see apps.core.chunked.
+    """
+
+    name = models.CharField(
+        max_length=100,
+        unique=True
+    )
+
+    # primary key ranges below next_id are processed
+    next_id = models.BigIntegerField(
+        null=True,
+        blank=True
+    )
+
+    # upper bound of the run, fixed when the run starts
+    end_id = models.BigIntegerField(
+        null=True,
+        blank=True
+    )
+
+    rows = models.BigIntegerField(
+        default=0
+    )
+
+    done = models.BooleanField(
+        default=False
+    )
+
+    updated_at = models.DateTimeField(
+        auto_now=True
+    )
@@ -1,4 +1,242 @@
-from rest_framework.pagination import PageNumberPagination as DefaultPageNumberPagination
+import base64
+import binascii
+import datetime
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination as DefaultPageNumberPagination
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(values):
+    """
+    Build opaque cursor token from position values
+    :param values: list of json serializable values
+    :return: str
+    """
+
+    return base64.urlsafe_b64encode(json.dumps(values, default=_cursor_value).encode('utf-8')).decode('ascii')
+
+
+def _cursor_value(value):
+    # full precision, DjangoJSONEncoder cuts microseconds
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+
+    return str(value)
+
+
+def decode_cursor(token):
+    """
+    Get position values back from cursor token
+    :param token: str
+    :return: list
+    :raises ValueError: if the token is not valid
+    """
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+
+    return values
+
+
+def keyset_filter(queryset, fields, values):
+    """
+    Filter queryset to rows after position `values` in the order of `fields`,
+    e.g. (created_at, id) > (x, y) as created_at > x OR (created_at = x AND id > y).
+    Descending fields are prefixed with "-" like in order_by.
+    NULLs are ordered like postgres does by default, after all values for
+    ascending and before them for descending fields.
+    :param queryset:
+    :param fields: list of field names
+    :param values: list of values, same length as fields
+    :return: queryset
+    """
+
+    query = Q()
+    for index in range(len(fields) - 1, -1, -1):
+        name = fields[index].lstrip('-')
+        descending = fields[index].startswith('-')
+        value = values[index]
+
+        if value is None:
+            # only non NULL values follow NULLs, in descending order
+            position = Q(**{name + '__isnull': False}) if descending else Q(pk__in=[])
+            equal = Q(**{name + '__isnull': True})
+        else:
+            position = Q(**{name + ('__lt' if descending else '__gt'): value})
+            if not descending and _is_nullable(queryset.model, name):
+                position |= Q(**{name + '__isnull': True})
+            equal = Q(**{name: value})
+
+        if index < len(fields) - 1:
+            position |= equal & query
+        query = position
+
+    return queryset.filter(query)
+
+
+def _is_nullable(model, name):
+    try:
+        return model._meta.get_field(name).null
+    except FieldDoesNotExist:
+        return True
+
+
+class CursorPagination(BasePagination):
+    """
+    Keyset pagination with opaque cursor tokens.
+    `ordering` must be unique (end with the pk) and backed by an index, pages
+    are read with one indexed range query and no COUNT(*) is executed.
+
+    With `?export` query param the whole queryset, bounded by `export_max_rows`,
+    can be streamed as JSON array from a view:
+
+        if self.paginator.is_export(request):
+            return self.paginator.get_export_response(queryset, self.serializer_class)
+    """
+
+    ordering = ('-created_at', '-id')
+    page_size = 100
+    max_page_size = 1000
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    export_query_param = 'export'
+    export_max_rows = 100000
+    export_chunk_size = 2000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+
+        token = request.query_params.get(self.cursor_query_param)
+        if token:
+            try:
+                position = decode_cursor(token)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+
+            if len(position) != len(self.ordering):
+                raise NotFound('Invalid cursor')
+
+            queryset = keyset_filter(queryset, self.ordering, self.to_position(queryset.model, position))
+
+        # one extra row tells if there is a next page
+        rows = list(queryset[:page_size + 1])
+        self.page = rows[:page_size]
+        self.next_position = self.get_position(self.page[-1]) if len(rows) > page_size else None
+
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encode_cursor(self.next_position))
+
+    def to_position(self, model, values):
+        """
+        Convert decoded cursor values with the ordering fields, so a tampered
+        cursor is a 404 instead of a database error.
+        :param model:
+        :param values: decoded cursor values
+        :return: list of values
+        :raises NotFound: if a value doesn't fit its field
+        """
+
+        position = []
+        for field_name, value in zip(self.ordering, values):
+            try:
+                field = model._meta.get_field(field_name.lstrip('-'))
+            except FieldDoesNotExist:
+                # annotations are passed as they are
+                position.append(value)
+                continue
+
+            try:
+                position.append(None if value is None else field.to_python(value))
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound('Invalid cursor')
+
+        return position
+
+    def get_position(self, row):
+        if isinstance(row, dict):
+            return [row[field.lstrip('-')] for field in self.ordering]
+
+        return [getattr(row, field.lstrip('-')) for field in self.ordering]
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, ''))
+        except ValueError:
+            return self.page_size
+
+        if page_size > 0:
+            return min(page_size, self.max_page_size)
+
+        return self.page_size
+
+    def is_export(self, request):
+        return self.export_query_param in request.query_params
+
+    def get_export_response(self, queryset, serializer_class):
+        """
+        Stream queryset as JSON array, serialized in chunks from a server-side cursor.
+        :param queryset:
+        :param serializer_class: serializer class of the rows
+        :return: StreamingHttpResponse
+        """
+
+        rows = queryset.order_by(*self.ordering)[:self.export_max_rows].iterator(chunk_size=self.export_chunk_size)
+
+        return StreamingHttpResponse(
+            self.stream_json(rows, serializer_class),
+            content_type='application/json'
+        )
+
+    def stream_json(self, rows, serializer_class):
+        renderer = JSONRenderer()
+        separator = b'['
+
+        for chunk in self.chunks(rows):
+            data = serializer_class(chunk, many=True).data
+            for item in data:
+                yield separator + renderer.render(item)
+                separator = b','
+
+        yield b'[]' if separator == b'[' else b']'
+
+    def chunks(self, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.export_chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
 
 
 class PageNumberPagination(DefaultPageNumberPagination):
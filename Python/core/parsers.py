@@ -0,0 +1,36 @@
+import gzip
+import io
+import zlib
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+
+class GzipJSONParser(JSONParser):
+    """
+    JSONParser which also accepts request bodies sent with `Content-Encoding: gzip`.
+    Decompressed size is limited by DATA_UPLOAD_MAX_MEMORY_SIZE.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        request = parser_context.get('request')
+
+        if request is not None and request.META.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+            stream = self.decompress(stream)
+
+        return super().parse(stream, media_type, parser_context)
+
+    def decompress(self, stream):
+        max_size = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+
+        try:
+            data = gzip.GzipFile(fileobj=stream).read(max_size + 1 if max_size else -1)
+        except (OSError, EOFError, zlib.error) as exc:
+            raise ParseError('Gzip parse error - %s' % exc)
+
+        if max_size and len(data) > max_size:
+            raise ParseError('Decompressed request body is too large')
+
+        return io.BytesIO(data)
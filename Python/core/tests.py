@@ -0,0 +1,193 @@
+import json
+from urllib.parse import parse_qs, urlparse
+
+from django.core import serializers
+from django.db import connection
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from apps.core.middleware import StatementTimeoutMiddleware
+from apps.core.models import BulkCreateManager, CommandCheckpoint
+from apps.core.pagination import CursorPagination, encode_cursor
+from apps.core.utils import model_to_dict, models_to_dicts
+
+
+class BulkCreateManagerTests(TestCase):
+
+    def test_upsert_inserts_and_updates(self):
+        existing_pk = CommandCheckpoint.objects.create(name='existing', rows=1).pk
+
+        existing = CommandCheckpoint(name='existing', rows=5)
+        new = CommandCheckpoint(name='new', rows=2)
+        with BulkCreateManager() as manager:
+            manager.upsert(existing, ['rows'], ['name'])
+            manager.upsert(new, ['rows'], ['name'])
+
+        self.assertEqual(existing.pk, existing_pk)
+        self.assertEqual(new.pk, CommandCheckpoint.objects.get(name='new').pk)
+        self.assertEqual(dict(CommandCheckpoint.objects.values_list('name', 'rows')), {'existing': 5, 'new': 2})
+
+    def test_upsert_duplicate_keys_in_one_flush(self):
+        first = CommandCheckpoint(name='duplicate', rows=1)
+        second = CommandCheckpoint(name='duplicate', rows=2)
+        with BulkCreateManager() as manager:
+            manager.upsert(first, ['rows'], ['name'])
+            manager.upsert(second, ['rows'], ['name'])
+
+        checkpoint = CommandCheckpoint.objects.get(name='duplicate')
+        self.assertEqual(checkpoint.rows, 2)
+        self.assertEqual(first.pk, checkpoint.pk)
+        self.assertEqual(second.pk, checkpoint.pk)
+
+    def test_upsert_without_update_fields_returns_existing_pk(self):
+        existing_pk = CommandCheckpoint.objects.create(name='existing', rows=1).pk
+
+        existing = CommandCheckpoint(name='existing', rows=5)
+        with BulkCreateManager() as manager:
+            manager.upsert(existing, [], ['name'])
+
+        self.assertEqual(existing.pk, existing_pk)
+        self.assertEqual(CommandCheckpoint.objects.get(pk=existing_pk).rows, 1)
+
+    def test_update_with_expressions(self):
+        checkpoints = [CommandCheckpoint.objects.create(name='checkpoint-%d' % index, rows=index) for index in range(3)]
+
+        with BulkCreateManager(chunk_size=2) as manager:
+            for checkpoint in checkpoints:
+                manager.update(CommandCheckpoint(pk=checkpoint.pk, rows=F('rows') + 10), ['rows'])
+
+        self.assertEqual(sorted(CommandCheckpoint.objects.values_list('rows', flat=True)), [10, 11, 12])
+        self.assertEqual(manager.stats[CommandCheckpoint._meta.label]['flushes'], 2)
+
+    def test_copy_instances_and_dicts(self):
+        manager = BulkCreateManager(chunk_size=2, copy_models=[CommandCheckpoint])
+        manager.add(CommandCheckpoint(name='instance', rows=1))
+        manager.add({'name': 'dict', 'rows': 2, 'done': True}, CommandCheckpoint)
+        manager.add({'name': 'tab\tand\nnewline', 'rows': 3, 'done': False}, CommandCheckpoint)
+        manager.done()
+
+        self.assertEqual(
+            dict(CommandCheckpoint.objects.values_list('name', 'rows')),
+            {'instance': 1, 'dict': 2, 'tab\tand\nnewline': 3}
+        )
+        self.assertTrue(CommandCheckpoint.objects.get(name='dict').done)
+        self.assertIsNotNone(CommandCheckpoint.objects.get(name='dict').updated_at)
+        self.assertEqual(manager.stats[CommandCheckpoint._meta.label]['rows'], 3)
+
+
+class CheckpointPagination(CursorPagination):
+    page_size = 2
+
+
+class CursorPaginationTests(TestCase):
+
+    def setUp(self):
+        # nullable next_id, with NULLs at page borders
+        values = [None, None, 5, 3, None, 3, 1]
+        self.checkpoints = [
+            CommandCheckpoint.objects.create(name='checkpoint-%d' % index, next_id=value)
+            for index, value in enumerate(values)
+        ]
+
+    def paginate(self, ordering):
+        paginator = CheckpointPagination()
+        paginator.ordering = ordering
+
+        pks = []
+        params = {}
+        while True:
+            request = Request(APIRequestFactory().get('/checkpoints/', params))
+            page = paginator.paginate_queryset(CommandCheckpoint.objects.all(), request)
+            pks.extend(checkpoint.pk for checkpoint in page)
+
+            link = paginator.get_next_link()
+            if link is None:
+                return pks
+            params = {'cursor': parse_qs(urlparse(link).query)['cursor'][0]}
+
+    def test_descending_with_nulls(self):
+        expected = list(CommandCheckpoint.objects.order_by('-next_id', '-id').values_list('pk', flat=True))
+
+        self.assertEqual(self.paginate(('-next_id', '-id')), expected)
+        self.assertEqual(len(expected), len(self.checkpoints))
+
+    def test_cursor_with_values_of_the_wrong_type(self):
+        paginator = CheckpointPagination()
+        paginator.ordering = ('-next_id', '-id')
+
+        for values in (['x', 'y'], [None, 'y'], [[1], 1], [{}, 1]):
+            request = Request(APIRequestFactory().get('/checkpoints/', {'cursor': encode_cursor(values)}))
+            with self.assertRaises(NotFound):
+                paginator.paginate_queryset(CommandCheckpoint.objects.all(), request)
+
+    def test_ascending_with_nulls(self):
+        expected = list(CommandCheckpoint.objects.order_by('next_id', 'id').values_list('pk', flat=True))
+
+        self.assertEqual(self.paginate(('next_id', 'id')), expected)
+        self.assertEqual(len(expected), len(self.checkpoints))
+
+
+def show_statement_timeout():
+    with connection.cursor() as cursor:
+        cursor.execute('SHOW statement_timeout')
+        return cursor.fetchone()[0]
+
+
+def timed_view(request):
+    timeout = show_statement_timeout()
+    # server side cursor, the query is sent as DECLARE ... CURSOR FOR
+    names = list(CommandCheckpoint.objects.values_list('name', flat=True).iterator())
+
+    return HttpResponse('%s %d' % (timeout, len(names)))
+
+
+@override_settings(STATEMENT_TIMEOUTS={'VIEWS': {'timed_view': 1500}})
+class StatementTimeoutMiddlewareTests(TestCase):
+
+    def get(self, view):
+        request = RequestFactory().get('/')
+        middleware = StatementTimeoutMiddleware(view)
+        middleware.process_view(request, view, (), {})
+
+        return middleware(request)
+
+    def test_timeout_of_view_is_reset_after_the_response(self):
+        CommandCheckpoint.objects.create(name='checkpoint')
+        default = show_statement_timeout()
+
+        response = self.get(timed_view)
+
+        self.assertEqual(response.content, b'1500ms 1')
+        self.assertEqual(show_statement_timeout(), default)
+
+    def test_view_without_timeout_keeps_default(self):
+        default = show_statement_timeout()
+
+        response = self.get(lambda request: HttpResponse(show_statement_timeout()))
+
+        self.assertEqual(response.content.decode(), default)
+
+
+class ModelToDictTests(TestCase):
+
+    def setUp(self):
+        CommandCheckpoint.objects.create(name='first', next_id=10, end_id=20, rows=5)
+        CommandCheckpoint.objects.create(name='second', done=True)
+
+    def serialized(self, instance):
+        # json serializer output, which model_to_dict replaced
+        serialized_instance = json.loads(serializers.serialize('json', [instance, ]))[0]
+        return dict(serialized_instance['fields'], id=serialized_instance['pk'])
+
+    def test_same_values_as_the_json_serializer(self):
+        for checkpoint in CommandCheckpoint.objects.all():
+            self.assertEqual(model_to_dict(checkpoint), self.serialized(checkpoint))
+
+    def test_models_to_dicts_matches_model_to_dict(self):
+        queryset = CommandCheckpoint.objects.order_by('pk')
+
+        self.assertEqual(models_to_dicts(queryset), [model_to_dict(checkpoint) for checkpoint in queryset])
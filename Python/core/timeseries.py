@@ -0,0 +1,227 @@
+"""
+Time bucketed aggregates for dashboard endpoints.
+
+Date ranges are turned into half open timestamp ranges in the shop's time
+zone (`created_at >= start AND created_at < end`), which can use plain
+indexes on the timestamp column, unlike `created_at__date` lookups which
+convert every row. Buckets are built in the shop's time zone and empty
+buckets are filled by the database with generate_series.
+
+    result = time_series(
+        [Source(PopupRevenue.objects.filter(shop_id=1), 'created_at', purchases=Count('id'))],
+        'day', start_date, end_date, tz
+    )
+    # {'buckets': ['2020-01-01', ...], 'series': {'purchases': [3, 0, ...]}}
+
+'hour' groups by hour of the day like the dashboard always did.
+"""
+import datetime
+
+import pytz
+from django.conf import settings
+from django.db import connections
+from django.db.models.functions import Trunc
+
+GROUP_TYPES = ['hour', 'day', 'month', 'year']
+
+INTEGER_FIELDS = ['IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField', 'PositiveSmallIntegerField', 'AutoField', 'BigAutoField']
+
+INTERVALS = {
+    'hour': '1 hour',
+    'day': '1 day',
+    'month': '1 month',
+    'year': '1 year',
+}
+
+SERIES_SQL = '''
+WITH data AS ({data}),
+bounds AS (
+    SELECT COALESCE(%s::timestamp, MIN(bucket)) AS first, COALESCE(%s::timestamp, MAX(bucket)) AS last FROM data
+)
+SELECT series.bucket, {columns}
+FROM bounds, generate_series(date_trunc(%s, bounds.first), bounds.last, %s::interval) AS series (bucket)
+LEFT JOIN data ON data.bucket = series.bucket
+GROUP BY series.bucket
+ORDER BY series.bucket
+'''
+
+HOUR_SERIES_SQL = '''
+WITH data AS ({data})
+SELECT series.bucket, {columns}
+FROM (
+    SELECT CAST(value AS time) AS bucket
+    FROM generate_series('2000-01-01 00:00'::timestamp, '2000-01-01 23:00'::timestamp, '1 hour') AS hours (value)
+) AS series
+LEFT JOIN data ON data.bucket = series.bucket
+GROUP BY series.bucket
+ORDER BY series.bucket
+'''
+
+
+class Source(object):
+    """
+    Queryset aggregated into time buckets.
+    :param queryset: rows to aggregate
+    :param field: timestamp field used for the range filter and the buckets
+    :param aggregates: name -> aggregate expression, e.g. count=Sum('data_count')
+    """
+
+    def __init__(self, queryset, field, **aggregates):
+        self.queryset = queryset
+        self.field = field
+        self.aggregates = aggregates
+
+
+def shop_timezone(shop_id):
+    """
+    :param shop_id:
+    :return: pytz timezone from SHOP_TIME_ZONES, TIME_ZONE for other shops
+    """
+
+    return pytz.timezone(getattr(settings, 'SHOP_TIME_ZONES', {}).get(shop_id, settings.TIME_ZONE))
+
+
+def date_range(start_date=None, end_date=None, tz=None):
+    """
+    Half open timestamp range covering the dates in tz
+    :param start_date: date or None
+    :param end_date: date or None, included
+    :param tz: pytz timezone, defaults to TIME_ZONE
+    :return: (start, end) aware datetimes or None for open ends
+    """
+
+    tz = tz or pytz.timezone(settings.TIME_ZONE)
+
+    start = end = None
+    if start_date:
+        start = tz.localize(datetime.datetime(start_date.year, start_date.month, start_date.day))
+    if end_date:
+        end_date = end_date + datetime.timedelta(days=1)
+        end = tz.localize(datetime.datetime(end_date.year, end_date.month, end_date.day))
+
+    return start, end
+
+
+def filter_range(queryset, field, start_date=None, end_date=None, tz=None):
+    """
+    Filter queryset to the dates with index friendly timestamp comparisons
+    """
+
+    start, end = date_range(start_date, end_date, tz)
+
+    if start is not None:
+        queryset = queryset.filter(**{field + '__gte': start})
+    if end is not None:
+        queryset = queryset.filter(**{field + '__lt': end})
+
+    return queryset
+
+
+def time_series(sources, group_type, start_date=None, end_date=None, tz=None):
+    """
+    Sum the aggregates of all sources per bucket in one statement.
+    Without start_date / end_date the series starts / ends with the data.
+    :param sources: list of Source, aggregates with the same name are added up
+    :param group_type: 'hour', 'day', 'month' or 'year'
+    :param start_date: date or None
+    :param end_date: date or None, included
+    :param tz: pytz timezone of the buckets, defaults to TIME_ZONE
+    :return: {'buckets': [iso date / time], 'series': {name: [value]}}, missing values are 0
+    """
+
+    if group_type not in GROUP_TYPES:
+        raise ValueError('Unknown group type "%s"' % group_type)
+
+    tz = tz or pytz.timezone(settings.TIME_ZONE)
+
+    names = []
+    for source in sources:
+        names.extend(name for name in source.aggregates if name not in names)
+
+    selects = []
+    params = []
+    integers = set()
+    using = sources[0].queryset.db
+    quote = connections[using].ops.quote_name
+
+    for index, source in enumerate(sources):
+        queryset = filter_range(source.queryset, source.field, start_date, end_date, tz) \
+            .annotate(series_bucket=Trunc(source.field, group_type, tzinfo=tz)) \
+            .values('series_bucket') \
+            .annotate(**source.aggregates) \
+            .order_by()
+
+        sql, source_params = queryset.query.sql_with_params()
+
+        for name in source.aggregates:
+            if queryset.query.annotations[name].output_field.get_internal_type() in INTEGER_FIELDS:
+                integers.add(name)
+
+        bucket = 'series_bucket::time' if group_type == 'hour' else 'series_bucket'
+        columns = ', '.join(quote(name) if name in source.aggregates else 'NULL AS %s' % quote(name) for name in names)
+        selects.append('SELECT %s AS bucket, %s FROM (%s) AS source_%d' % (bucket, columns, sql, index))
+        params.extend(source_params)
+
+    data = ' UNION ALL '.join(selects)
+    # SUM over bigint returns numeric, integer series are converted back below
+    columns = ', '.join('SUM(data.%s)' % quote(name) for name in names)
+
+    if group_type == 'hour':
+        sql = HOUR_SERIES_SQL.format(data=data, columns=columns)
+    else:
+        first = _local_timestamp(start_date, group_type)
+        last = _local_timestamp(end_date, group_type)
+        sql = SERIES_SQL.format(data=data, columns=columns)
+        params.extend([first, last, group_type, INTERVALS[group_type]])
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    return {
+        'buckets': [_format_bucket(row[0], group_type) for row in rows],
+        'series': {
+            name: [_value(row[index + 1], name in integers) for row in rows]
+            for index, name in enumerate(names)
+        },
+    }
+
+
+def to_rows(result, names, date_key='date'):
+    """
+    Row layout of a time_series result, [{'date': ..., key: value}]
+    :param result: time_series result
+    :param names: dict series name -> key in the rows
+    :return: list of dicts
+    """
+
+    return [
+        dict([(date_key, bucket)] + [(key, result['series'][name][index]) for name, key in names.items()])
+        for index, bucket in enumerate(result['buckets'])
+    ]
+
+
+def _local_timestamp(value, group_type):
+    if value is None:
+        return None
+
+    if group_type == 'month':
+        value = value.replace(day=1)
+    elif group_type == 'year':
+        value = value.replace(month=1, day=1)
+
+    return datetime.datetime(value.year, value.month, value.day).isoformat()
+
+
+def _value(value, integer):
+    if value is None:
+        return 0
+
+    return int(value) if integer else value
+
+
+def _format_bucket(value, group_type):
+    if group_type == 'hour':
+        return value.isoformat()
+
+    return value.date().isoformat()
@@ -3,6 +3,8 @@
 from django.conf import settings
 from django.conf.urls import url
 
+from . import views
+
 
 def generate_url(regex, view, name=None):
     """
@@ -19,4 +21,5 @@ def generate_url(regex, view, name=None):
 
 
 urlpatterns = [
+    url(r'db-stats/', views.DatabasePoolStats.as_view(), name='db-stats'),
 ]
@@ -1,9 +1,10 @@
 import hashlib
-import json
 import random
 import string
 
-from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.duration import duration_string
+from django.utils.encoding import is_protected_type
 
 
 def generate_unique_key(value, length=40):
@@ -23,15 +24,95 @@ def generate_unique_key(value, length=40):
 
 def model_to_dict(instance):
     """
-    Generate dict object from received model instance
+    Generate dict object from received model instance, with the same values
+    as the json serializer: foreign keys as ids, dates and decimals as strings.
+    JSON field values are returned as is, not copied.
     :param instance:
     :return: dict
     """
 
-    serialized_instance = json.loads(serializers.serialize('json', [instance, ]))[0]
-    instance_dict = serialized_instance['fields']
+    instance_dict = {name: convert(getattr(instance, attname)) for name, attname, convert in _get_accessors(type(instance))}
+
+    for field in instance._meta.concrete_model._meta.local_many_to_many:
+        if field.serialize:
+            instance_dict[field.name] = [_json_value(pk) for pk in getattr(instance, field.name).values_list('pk', flat=True)]
 
     # add instance pk to the fields dict
-    instance_dict['id'] = serialized_instance['pk']
+    instance_dict['id'] = _json_value(instance.pk)
 
     return instance_dict
+
+
+def models_to_dicts(queryset):
+    """
+    model_to_dict for all rows of a queryset, built from `.values()` rows
+    without creating model instances. Many to many fields are not included.
+    :param queryset:
+    :return: list of dicts
+    """
+
+    model = queryset.model
+    accessors = _get_accessors(model)
+    pk = model._meta.pk.attname
+
+    instance_dicts = []
+    for row in queryset.values(pk, *[attname for name, attname, convert in accessors]):
+        instance_dict = {name: convert(row[attname]) for name, attname, convert in accessors}
+        instance_dict['id'] = _json_value(row[pk])
+        instance_dicts.append(instance_dict)
+
+    return instance_dicts
+
+
+_json_encoder = DjangoJSONEncoder()
+
+# model class -> [(key, attname, value converter)]
+_accessors = {}
+
+
+def _get_accessors(model):
+    accessors = _accessors.get(model)
+    if accessors is None:
+        accessors = _accessors[model] = [
+            (field.name, field.attname, _converter(field))
+            for field in model._meta.concrete_model._meta.local_fields
+            if field.serialize
+        ]
+
+    return accessors
+
+
+def _converter(field):
+    if field.is_relation:
+        return _converter(field.target_field)
+
+    internal_type = field.get_internal_type()
+    if internal_type in ('DateTimeField', 'DateField', 'TimeField', 'DecimalField'):
+        return _encode
+    if internal_type == 'DurationField':
+        return _duration
+    if internal_type == 'JSONField':
+        return _identity
+
+    return _json_value
+
+
+def _identity(value):
+    return value
+
+
+def _encode(value):
+    return None if value is None else _json_encoder.default(value)
+
+
+def _duration(value):
+    return None if value is None else duration_string(value)
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if is_protected_type(value):
+        return _json_encoder.default(value)
+
+    return str(value)
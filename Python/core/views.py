@@ -0,0 +1,30 @@
+from django.http import HttpResponse
+from django.views import View
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from apps.core.cache import latest_action_cache_stats, response_cache_stats
+from apps.core.db.pool import pool_stats
+from apps.core.metrics import request_metrics
+from apps.core.permissions import IsTokenAuthenticated
+
+
+class DatabasePoolStats(APIView):
+    permission_classes = [IsTokenAuthenticated, ]
+
+    def get(self, request):
+        return Response({
+            'pools': pool_stats(),
+            'response_cache': response_cache_stats.snapshot(),
+            'latest_action_cache': latest_action_cache_stats.snapshot(),
+        }, status=status.HTTP_200_OK)
+
+
+class Metrics(View):
+    """
+    Request metrics of this process in Prometheus text format
+    """
+
+    def get(self, request):
+        return HttpResponse(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -51,6 +51,7 @@ THIRD_PARTY_APPS = [
 ]
 
 MIDDLEWARE = [
+    'apps.core.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -59,10 +60,13 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'apps.core.middleware.StatementTimeoutMiddleware',
 ]
 
 ROOT_URLCONF = 'project.urls'
 
+DATABASE_ROUTERS = ['apps.core.db.routers.ReplicaRouter']
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -139,6 +143,11 @@ LOGGING = {
             'level': 'ERROR',
             'class': 'logging.FileHandler',
             'filename': os.path.join(BASE_DIR, '../logs/ur.log'),
+        },
+        'slow': {
+            'level': 'WARNING',
+            'class': 'logging.FileHandler',
+            'filename': os.path.join(BASE_DIR, '../logs/slow.log'),
         }
     },
     'loggers': {
@@ -151,6 +160,11 @@ LOGGING = {
             'handlers': ['cron', 'ur'],
             'level': 'INFO',
             'propagate': False,
+        },
+        'apps.core.middleware': {
+            'handlers': ['slow'],
+            'level': 'WARNING',
+            'propagate': False,
         }
     }
 }
@@ -172,6 +186,112 @@ CORS_ALLOW_HEADERS = (
     'Token',
 )
 
+# Analytics track-data ingest
+# BUFFERED: acknowledge events immediately and store them in batches
+# FLUSH_SIZE: number of queued events which triggers a flush
+# FLUSH_INTERVAL: max seconds between flushes
+# SPOOL_DIR: directory for per-process spool files, None keeps events in memory only
+# BATCH_MAX_EVENTS: max number of events accepted by track-data/batch/
+# MAX_EVENT_AGE: seconds, older client timestamps of batched events are moved up to it
+ANALYTICS_INGEST = {
+    'BUFFERED': False,
+    'FLUSH_SIZE': 500,
+    'FLUSH_INTERVAL': 2,
+    'SPOOL_DIR': None,
+    'BATCH_MAX_EVENTS': 500,
+    'MAX_EVENT_AGE': 60 * 60,
+}
+
+# (shop_id, customer_id, session_id) -> TrackSession.pk cache used by track-data ingest
+# BACKEND: 'local' (per process LRU), 'django' (CACHES alias from ALIAS) or None to disable
+ANALYTICS_SESSION_CACHE = {
+    'BACKEND': 'local',
+    'MAX_SIZE': 100000,
+    'TIMEOUT': 30 * 60,
+    'ALIAS': 'default',
+}
+
+# (shop_id, customer_id) -> latest action per type, read by LastActionByType and
+# updated by track-data ingest. Must be shared by all workers, so 'django' with
+# a CACHES alias like memcached or redis, None disables it
+ANALYTICS_LATEST_ACTION_CACHE = {
+    'BACKEND': None,
+    'TIMEOUT': 5 * 60,
+    'ALIAS': 'default',
+}
+
+# analytics_trackdata partitioning, maintained by the track_partitions command
+# INTERVAL: 'month' or 'week'
+# AHEAD: number of future partitions to keep created
+# RETENTION: number of past partitions to keep attached, None keeps everything.
+# The legacy partition from --convert is detached once its upper bound is older too
+# Rows outside of the created partitions are kept in analytics_trackdata_default
+ANALYTICS_PARTITIONS = {
+    'INTERVAL': 'month',
+    'AHEAD': 3,
+    'RETENTION': None,
+}
+
+# Time zone of dashboard buckets and date ranges per shop_id (apps.core.timeseries),
+# shops not listed use TIME_ZONE
+SHOP_TIME_ZONES = {}
+
+# Dashboard response cache (apps.core.cache.ResponseCacheMixin)
+# PAST_TIMEOUT: seconds for date ranges ending before today
+# TODAY_TIMEOUT: seconds for ranges including today
+# LOCK_TIMEOUT / WAIT: single-flight lock lifetime and max wait for another worker
+RESPONSE_CACHE = {
+    'ALIAS': 'default',
+    'PAST_TIMEOUT': 24 * 60 * 60,
+    'TODAY_TIMEOUT': 60,
+    'LOCK_TIMEOUT': 30,
+    'WAIT': 10,
+}
+
+# Read replicas for views using apps.core.db.routers.ReplicaReadMixin
+# ALIASES: DATABASES keys of the replicas, empty routes everything to default
+# MAX_LAG: max replication lag in seconds, lagging replicas are skipped
+# LAG_CHECK_INTERVAL: seconds between lag checks per replica and process
+DATABASE_REPLICAS = {
+    'ALIASES': [],
+    'MAX_LAG': 5,
+    'LAG_CHECK_INTERVAL': 5,
+}
+
+# statement_timeout in ms per view class name (apps.core.middleware.StatementTimeoutMiddleware)
+# Other views and management commands keep the server default, aliases only used
+# by the web workers (like replicas) can set one in DATABASES OPTIONS, e.g.
+# 'OPTIONS': {'options': '-c statement_timeout=15000'}
+STATEMENT_TIMEOUTS = {
+    'VIEWS': {
+        'TrackAnalyticData': 5000,
+        'TrackAnalyticDataBatch': 10000,
+        'LastActionByType': 2000,
+        'LastSessionMostPopular': 2000,
+        'GetSessionLastVoucher': 2000,
+        'AutocompleteRegisteredUsersTimeSpent': 15000,
+        'PopUpShowVsClick': 15000,
+        'PopUpClickVsPurchase': 15000,
+        'PopUpClicks': 15000,
+        'PopUpPurchases': 15000,
+        'PopItems': 15000,
+        'PopUpRevenue': 15000,
+        'PopupMetrics': 15000,
+    },
+}
+
+# Per view request metrics (apps.core.middleware.RequestMetricsMiddleware), exposed at /metrics
+# ENABLED: record metrics and time serializers
+# SLOW_REQUEST: seconds after which a request is logged with its SQL to logs/slow.log, None disables
+# MAX_QUERIES: SQL statements kept per request for the slow request log
+# EXCLUDE: view names which are not recorded
+REQUEST_METRICS = {
+    'ENABLED': True,
+    'SLOW_REQUEST': 2,
+    'MAX_QUERIES': 50,
+    'EXCLUDE': ['Metrics'],
+}
+
 SWAGGER_SETTINGS = {
     "exclude_url_names": ["schema_view"]
 }
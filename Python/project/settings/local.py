@@ -22,3 +22,9 @@ DATABASES = {
         'PORT': '5432'
     }
 }
+
+# To try replica routing locally add a second database (e.g. a streaming or
+# logical replica of the first one) and list it in DATABASE_REPLICAS:
+# DATABASES['replica'] = dict(DATABASES['default'], NAME='project_replica', TEST={'MIRROR': 'default'},
+#                             OPTIONS={'options': '-c statement_timeout=15000'})
+# DATABASE_REPLICAS['ALIASES'] = ['replica']
@@ -15,6 +15,12 @@ UR_ENGINE = 'engine_1'
 INSTALLED_APPS = INSTALLED_APPS + THIRD_PARTY_APPS + PROJECT_APPS
 
 # Database
+# Persistent connections, django closes connections which had errors and are
+# no longer usable at the start and end of each request.
+# No statement_timeout in the OPTIONS of default, it is shared with migrations
+# and maintenance commands, views get theirs from STATEMENT_TIMEOUTS.
+# For an in-process pool use ENGINE 'apps.core.db.backends.postgresql_pool',
+# CONN_MAX_AGE 0 and POOL {'MAX_SIZE': <threads per worker>, 'TIMEOUT': 10}
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql_psycopg2',
@@ -22,6 +28,7 @@ DATABASES = {
         'USER': 'project_user',
         'PASSWORD': '',
         'HOST': '127.0.0.1',
-        'PORT': '5432'
+        'PORT': '5432',
+        'CONN_MAX_AGE': 600,
     }
 }
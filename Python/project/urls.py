@@ -21,6 +21,8 @@ from django.views.static import serve
 from rest_framework.routers import DefaultRouter
 from rest_framework_swagger.views import get_swagger_view
 
+from apps.core.views import Metrics
+
 schema_view = get_swagger_view(title='Api')
 
 router = DefaultRouter()
@@ -29,6 +31,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
 
     url(r'^docs/$', schema_view, name='schema_view'),
+    url(r'^metrics$', Metrics.as_view(), name='metrics'),
 
     url(r'^core/', include('apps.core.urls')),
     url(r'^analytics/', include('apps.analytics.urls')),